@@ -0,0 +1 @@
+"""Offline benchmark and evaluation tools for the face lambdas"""
@@ -0,0 +1,415 @@
+"""
+Offline benchmark for the face lambdas.
+
+Drives a lambda's `handler` with synthetic SQS batches over a local image
+corpus, with S3, DynamoDB, SSM, Pinecone and Rekognition replaced by the
+in-process fakes in face_bench.fakes. Reports batch and image latency
+percentiles, faces/sec and where the time goes, and writes the results as
+JSON so runs can be compared between commits.
+
+Run from src/lambdas:
+
+    python -m face_bench.benchmark --lambda face_recognition --corpus ~/faces \\
+        --set FACE_DETECTION_MODEL=cnn --output cnn.json
+    python -m face_bench.benchmark compare hog.json cnn.json
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from face_pipeline.loader import LAMBDAS_DIR, load_lambda
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+BENCH_BUCKET = "face-bench"
+BENCH_TABLE = "face-bench"
+BENCH_USER = "bench@example.com"
+
+# Functions whose time is attributed to a stage, as (module, attribute)
+# names. Missing attributes are skipped, so one list covers every lambda.
+STAGE_FUNCTIONS = {
+    "matching": [
+        ("lambda", "prefetch_face_matches"),
+        ("lambda", "assign_match_decisions"),
+        ("lambda", "search_face_by_image"),
+        ("rekognition", "search_face_by_image"),
+        ("rekognition", "search_face_by_id"),
+    ],
+    "persistence": [
+        ("core", "reserve_person_ids"),
+        ("core", "store_new_persons"),
+        ("core", "get_original_s3_keys"),
+        ("core", "associate_profile_picture"),
+        ("core.PersistenceBuffer", "flush"),
+    ],
+}
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile; None for an empty list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 2) if values else None,
+        "p50": round(percentile(values, 0.5), 2) if values else None,
+        "p95": round(percentile(values, 0.95), 2) if values else None,
+        "max": round(max(values), 2) if values else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=LAMBDAS_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def load_corpus(corpus_dir):
+    """
+    Image files of the corpus, plus face boxes for the fake Rekognition
+    from an optional manifest.json: {"<file name>": {"faces": [{"Left": ..,
+    "Top": .., "Width": .., "Height": ..}, ...]}}, ratios as in Rekognition.
+    """
+    corpus_dir = Path(corpus_dir)
+    images = sorted(
+        path for path in corpus_dir.iterdir() if path.suffix.lower() in IMAGE_EXTENSIONS
+    )
+    if not images:
+        raise SystemExit(f"No images found in {corpus_dir}")
+
+    manifest_path = corpus_dir / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+    return images, manifest
+
+
+class StageTimer:
+    """Accumulates time spent inside wrapped functions, summed across threads"""
+
+    def __init__(self):
+        self.totals = {}
+
+    def wrap(self, owner, attribute, stage):
+        original = getattr(owner, attribute)
+        self.totals.setdefault(stage, 0.0)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.totals[stage] += time.perf_counter() - start
+
+        setattr(owner, attribute, timed)
+
+    def reset(self):
+        self.totals = dict.fromkeys(self.totals, 0.0)
+
+
+def large_variant(image_bytes):
+    """processed/<id>_large.webp bytes, made the way image_thumbnail_generation makes them"""
+    from PIL import Image, ImageOps
+
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+    image.thumbnail((1920, 1920))
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, "WEBP", quality=95)
+    return buffer.getvalue()
+
+
+def install_fakes(args, images, manifest):
+    """Load the lambda with the fakes installed in place of every client"""
+    os.environ.setdefault("DDB_TABLE_NAME", BENCH_TABLE)
+    os.environ.setdefault("S3_BUCKET_NAME", BENCH_BUCKET)
+    for setting in args.set:
+        key, _, value = setting.partition("=")
+        os.environ[key] = value
+
+    from face_bench import fakes
+
+    sys.path.insert(0, str(LAMBDAS_DIR))
+    from face_pipeline import core
+
+    s3 = fakes.FakeS3(args.s3_latency_ms / 1000)
+    dynamodb = fakes.FakeDynamoDB(
+        args.ddb_latency_ms / 1000, unprocessed_rate=args.ddb_unprocessed_rate
+    )
+    table = dynamodb.Table(core.config.DDB_TABLE_NAME)
+
+    keys = []
+    for path in images:
+        key = f"originals/{path.name}"
+        s3.objects[(BENCH_BUCKET, key)] = path.read_bytes()
+        if args.variants:
+            s3.objects[(BENCH_BUCKET, f"processed/{path.stem}_large.webp")] = large_variant(
+                s3.objects[(BENCH_BUCKET, key)]
+            )
+        keys.append(key)
+        # IMAGE items are what get_original_s3_keys resolves tags against
+        table.items[(path.stem, f"UPLOADED_BY#{BENCH_USER}")] = {
+            "PK": path.stem,
+            "SK": f"UPLOADED_BY#{BENCH_USER}",
+            "entityType": "IMAGE",
+            "s3Key": key,
+        }
+
+    face_boxes = {
+        f"originals/{name}": entry["faces"]
+        for name, entry in manifest.items()
+        if "faces" in entry
+    }
+    rekognition = fakes.FakeRekognition(
+        s3,
+        args.rekognition_latency_ms / 1000,
+        face_boxes=face_boxes,
+        default_faces=args.default_faces,
+    )
+    pinecone = fakes.FakePineconeIndex(args.pinecone_latency_ms / 1000)
+
+    module = load_lambda(args.lambda_name)
+
+    # Registered after the lambda's own factories so these replace them, and
+    # created lazily like the real clients so cold start paths still run
+    fake_resources = {
+        "dynamodb": dynamodb,
+        "table": table,
+        "s3": s3,
+        "ssm": fakes.FakeSSM(),
+        "pinecone_index": pinecone,
+        "rekognition": rekognition,
+    }
+    for name, fake in fake_resources.items():
+        core.register_resource(name, lambda fake=fake: fake)
+    services = {
+        "s3": s3,
+        "dynamodb": dynamodb,
+        "pinecone": pinecone,
+        "rekognition": rekognition,
+    }
+    return module, core, keys, services
+
+
+def build_batches(keys, batch_size, batch_count):
+    """SQS events cycling through the corpus keys"""
+    batches = []
+    position = 0
+    for batch_number in range(batch_count):
+        records = []
+        for i in range(batch_size):
+            key = keys[position % len(keys)]
+            position += 1
+            records.append(
+                {
+                    "messageId": f"{batch_number}-{i}",
+                    "body": json.dumps(
+                        {
+                            "bucketName": BENCH_BUCKET,
+                            "objectKey": key,
+                            "fileNameWithoutExt": Path(key).stem,
+                        }
+                    ),
+                }
+            )
+        batches.append({"Records": records})
+    return batches
+
+
+def run(args):
+    images, manifest = load_corpus(args.corpus)
+    module, core, keys, services = install_fakes(args, images, manifest)
+
+    modules = {"lambda": module, "core": core, "core.PersistenceBuffer": core.PersistenceBuffer}
+    if "face_pipeline.rekognition" in sys.modules:
+        modules["rekognition"] = sys.modules["face_pipeline.rekognition"]
+    timer = StageTimer()
+    for stage, functions in STAGE_FUNCTIONS.items():
+        for owner_name, attribute in functions:
+            owner = modules.get(owner_name)
+            if owner is not None and hasattr(owner, attribute):
+                timer.wrap(owner, attribute, stage)
+
+    batches = build_batches(keys, args.batch_size, args.warmup + args.batches)
+    batch_latencies, image_latencies = [], []
+    detection, encoding = [], []
+    faces = failures = images_processed = 0
+    total_time = 0.0
+
+    for number, event in enumerate(batches):
+        if number == args.warmup:
+            timer.reset()
+            for service in services.values():
+                service.calls.clear()
+            services["s3"].bytes_read = 0
+
+        start = time.perf_counter()
+        response = module.handler(event, None)
+        elapsed = time.perf_counter() - start
+        if number < args.warmup:
+            continue
+
+        body = json.loads(response["body"])
+        total_time += elapsed
+        batch_latencies.append(elapsed * 1000)
+        failures += len(response.get("batchItemFailures", []))
+        for result in body.get("results", []):
+            images_processed += 1
+            if "error" in result:
+                continue
+            image_latencies.append(result["time_taken"] * 1000)
+            detection.append(result.get("detection_time", 0) * 1000)
+            encoding.append(result.get("encoding_time", 0) * 1000)
+            faces += result.get("faces_detected", 0)
+
+    measured = len(batch_latencies)
+    stage_ms = {
+        "detection": round(sum(detection) / max(images_processed, 1), 2),
+        "encoding": round(sum(encoding) / max(images_processed, 1), 2),
+        **{
+            stage: round(total * 1000 / max(images_processed, 1), 2)
+            for stage, total in timer.totals.items()
+        },
+    }
+
+    return {
+        "revision": git_revision(),
+        "lambda": args.lambda_name,
+        "corpus_images": len(images),
+        "settings": dict(setting.partition("=")[::2] for setting in args.set),
+        "configuration": body.get("configuration", {}) if measured else {},
+        "latency_ms": {
+            "s3": args.s3_latency_ms,
+            "dynamodb": args.ddb_latency_ms,
+            "pinecone": args.pinecone_latency_ms,
+            "rekognition": args.rekognition_latency_ms,
+        },
+        "batch_size": args.batch_size,
+        "batches": measured,
+        "images": images_processed,
+        "faces": faces,
+        "failures": failures,
+        "batch_latency_ms": summarize(batch_latencies),
+        "image_latency_ms": summarize(image_latencies),
+        "images_per_second": round(images_processed / total_time, 2) if total_time else None,
+        "faces_per_second": round(faces / total_time, 2) if total_time else None,
+        # Per image; matching and persistence are summed across threads
+        "stage_ms_per_image": stage_ms,
+        "service_calls": {
+            name: dict(sorted(service.calls.items())) for name, service in services.items()
+        },
+        "s3_kb_read_per_image": round(
+            services["s3"].bytes_read / 1024 / max(images_processed, 1), 1
+        ),
+    }
+
+
+def flatten(results, prefix=""):
+    """Numeric leaves of a results document as {"a.b.c": value}"""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(baseline_path, candidate_path):
+    baseline = flatten(json.loads(Path(baseline_path).read_text()))
+    candidate = flatten(json.loads(Path(candidate_path).read_text()))
+    print(f"{'metric':<48} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    for metric in sorted(baseline.keys() | candidate.keys()):
+        old, new = baseline.get(metric), candidate.get(metric)
+        change = ""
+        if old and new is not None:
+            change = f"{(new - old) / old * 100:+.1f}%"
+        print(f"{metric:<48} {str(old):>12} {str(new):>12} {change:>9}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--lambda",
+        dest="lambda_name",
+        choices=["face_recognition", "face_rekognition"],
+        default="face_recognition",
+    )
+    parser.add_argument("--corpus", required=True, help="Directory of images")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Environment setting for the lambda, repeatable",
+    )
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--batches", type=int, default=5)
+    parser.add_argument(
+        "--warmup", type=int, default=1, help="Batches run before measuring (cold start)"
+    )
+    parser.add_argument("--s3-latency-ms", type=float, default=20.0)
+    parser.add_argument("--ddb-latency-ms", type=float, default=5.0)
+    parser.add_argument("--ddb-unprocessed-rate", type=float, default=0.0)
+    parser.add_argument("--pinecone-latency-ms", type=float, default=30.0)
+    parser.add_argument("--rekognition-latency-ms", type=float, default=150.0)
+    parser.add_argument(
+        "--default-faces",
+        type=int,
+        default=1,
+        help="Faces the fake Rekognition detects in images missing from the manifest",
+    )
+    parser.add_argument(
+        "--variants",
+        action="store_true",
+        help="Also serve a processed/<file>_large.webp variant of every image",
+    )
+    parser.add_argument("--output", help="Write results JSON here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Keep the lambda's INFO logs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "compare":
+        if len(argv) != 3:
+            raise SystemExit("usage: benchmark compare BASELINE.json CANDIDATE.json")
+        compare(argv[1], argv[2])
+        return
+
+    args = parse_args(argv)
+    results = run_quietly(args) if not args.verbose else run(args)
+    document = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(document + "\n")
+    else:
+        print(document)
+
+
+def run_quietly(args):
+    # The lambdas set the root logger to INFO at import
+    logging.disable(logging.WARNING)
+    try:
+        return run(args)
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+"""
+In-process stand-ins for the services the face lambdas call: S3,
+DynamoDB, SSM, Pinecone and Rekognition. They implement only the calls
+the pipeline makes, keep state in memory and sleep for a configurable
+latency per call, so runs are repeatable without AWS or Pinecone.
+"""
+
+import io
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from types import SimpleNamespace
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class FakeService:
+    """Base class: counts calls per operation and simulates latency"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+# -------- S3 --------
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeS3(FakeService):
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.objects = {}
+        self.bytes_read = 0
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call("put_object")
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.read()
+        return {"ETag": uuid.uuid4().hex}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call("get_object")
+        if (Bucket, Key) not in self.objects:
+            raise client_error("NoSuchKey", "GetObject")
+        data = self.objects[(Bucket, Key)]
+        if "Range" in kwargs:
+            first, last = re.fullmatch(r"bytes=(\d+)-(\d+)", kwargs["Range"]).groups()
+            data = data[int(first) : int(last) + 1]
+        with self._lock:
+            self.bytes_read += len(data)
+        return {"Body": FakeBody(data)}
+
+
+# -------- DynamoDB --------
+
+
+def condition_matches(condition, item):
+    """Evaluate the subset of boto3 key conditions the pipeline uses (=, >, AND)"""
+    expression = condition.get_expression()
+    operator = expression["operator"]
+    if operator == "AND":
+        return all(condition_matches(value, item) for value in expression["values"])
+    if operator == "=":
+        attribute, value = expression["values"]
+        return item.get(attribute.name) == value
+    if operator == ">":
+        attribute, value = expression["values"]
+        return attribute.name in item and item[attribute.name] > value
+    raise NotImplementedError(f"Key condition operator {operator}")
+
+
+class FakeTable:
+    """Items keyed by (PK, SK); GSIs are answered by scanning"""
+
+    # Commas between assignments, not inside if_not_exists(...)
+    _SEPARATOR = re.compile(r",(?![^()]*\))")
+    _ASSIGNMENT = re.compile(r"^\s*([#\w]+)\s*=\s*(.+?)\s*$")
+    _INCREMENT = re.compile(r"^(?:if_not_exists\(\s*([#\w]+)\s*,\s*(:\w+)\s*\)|([#\w]+))\s*\+\s*(:\w+)$")
+
+    def __init__(self, service, name):
+        self.service = service
+        self.name = name
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def get_item(self, Key, **kwargs):
+        self.service._call("get_item")
+        item = self.items.get((Key["PK"], Key["SK"]))
+        return {"Item": dict(item)} if item is not None else {}
+
+    def put_item(self, Item, **kwargs):
+        self.service._call("put_item")
+        with self._lock:
+            self.items[(Item["PK"], Item["SK"])] = dict(Item)
+        return {}
+
+    def update_item(
+        self,
+        Key,
+        UpdateExpression,
+        ExpressionAttributeValues,
+        ExpressionAttributeNames=None,
+        ReturnValues="NONE",
+        **kwargs,
+    ):
+        """Supports SET with plain values and `if_not_exists(a, :s) + :v` increments"""
+        self.service._call("update_item")
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues
+
+        if not UpdateExpression.startswith("SET "):
+            raise NotImplementedError(f"Update expression {UpdateExpression}")
+
+        with self._lock:
+            item = self.items.setdefault(
+                (Key["PK"], Key["SK"]), {"PK": Key["PK"], "SK": Key["SK"]}
+            )
+            for assignment in self._SEPARATOR.split(UpdateExpression[4:]):
+                target, source = self._ASSIGNMENT.match(assignment).groups()
+                attribute = names.get(target, target)
+                increment = self._INCREMENT.match(source)
+                if increment:
+                    default_name, default_value, base_name, amount = increment.groups()
+                    base = names.get(default_name or base_name, default_name or base_name)
+                    current = item.get(base, values[default_value] if default_value else 0)
+                    item[attribute] = current + values[amount]
+                else:
+                    item[attribute] = values[source]
+            updated = dict(item)
+
+        return {"Attributes": updated} if ReturnValues == "ALL_NEW" else {}
+
+    def query(
+        self, KeyConditionExpression, IndexName=None, ScanIndexForward=True, Limit=None, **kwargs
+    ):
+        self.service._call("query")
+        with self._lock:
+            items = [
+                dict(item)
+                for item in self.items.values()
+                if condition_matches(KeyConditionExpression, item)
+            ]
+        items.sort(key=lambda item: str(item.get("SK", "")), reverse=not ScanIndexForward)
+        if Limit:
+            items = items[:Limit]
+        return {"Items": items, "Count": len(items)}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return FakeBatchWriter(self)
+
+
+class FakeBatchWriter:
+    def __init__(self, table):
+        self.table = table
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for start in range(0, len(self.pending), 25):
+            self.table.service.batch_write_item(
+                RequestItems={
+                    self.table.name: [
+                        {"PutRequest": {"Item": item}}
+                        for item in self.pending[start : start + 25]
+                    ]
+                }
+            )
+        return False
+
+    def put_item(self, Item):
+        self.pending.append(Item)
+
+
+class FakeDynamoDB(FakeService):
+    """
+    Stands in for the boto3 DynamoDB resource. `unprocessed_rate` is the
+    fraction of BatchWriteItem requests returned as UnprocessedItems, to
+    exercise the retry path.
+    """
+
+    def __init__(self, latency=0.0, unprocessed_rate=0.0, seed=0):
+        super().__init__(latency)
+        self.tables = {}
+        self.unprocessed_rate = unprocessed_rate
+        self._random = np.random.default_rng(seed)
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = FakeTable(self, name)
+        return self.tables[name]
+
+    def batch_write_item(self, RequestItems):
+        self._call("batch_write_item")
+        unprocessed = {}
+        for table_name, requests in RequestItems.items():
+            if len(requests) > 25:
+                raise client_error("ValidationException", "BatchWriteItem")
+            table = self.Table(table_name)
+            for request in requests:
+                if self.unprocessed_rate and self._random.random() < self.unprocessed_rate:
+                    unprocessed.setdefault(table_name, []).append(request)
+                    continue
+                item = request["PutRequest"]["Item"]
+                with table._lock:
+                    table.items[(item["PK"], item["SK"])] = dict(item)
+        return {"UnprocessedItems": unprocessed}
+
+    def batch_get_item(self, RequestItems):
+        self._call("batch_get_item")
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.Table(table_name)
+            responses[table_name] = [
+                dict(table.items[(key["PK"], key["SK"])])
+                for key in request["Keys"]
+                if (key["PK"], key["SK"]) in table.items
+            ]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+
+class FakeSSM(FakeService):
+    def get_parameter(self, Name, WithDecryption=False):
+        self._call("get_parameter")
+        return {"Parameter": {"Name": Name, "Value": "benchmark-api-key"}}
+
+
+# -------- Pinecone --------
+
+
+class FakePineconeIndex(FakeService):
+    """Exact cosine search over the upserted vectors, shaped like pinecone-client 4.x"""
+
+    def __init__(self, latency=0.0, dimension=128):
+        super().__init__(latency)
+        self.dimension = dimension
+        self.ids = []
+        self.positions = {}
+        self.metadata = {}
+        self.vectors = np.empty((0, dimension), dtype=np.float32)
+
+    def upsert(self, vectors, **kwargs):
+        self._call("upsert")
+        with self._lock:
+            for vector in vectors:
+                self.metadata[vector["id"]] = vector.get("metadata", {})
+                values = np.asarray(vector["values"], dtype=np.float32)
+                if vector["id"] in self.positions:
+                    self.vectors[self.positions[vector["id"]]] = values
+                    continue
+                self.positions[vector["id"]] = len(self.ids)
+                self.ids.append(vector["id"])
+                self.vectors = np.vstack([self.vectors, values])
+        return {"upserted_count": len(vectors)}
+
+    def query(self, vector, top_k, include_values=False, **kwargs):
+        self._call("query")
+        with self._lock:
+            ids, vectors = list(self.ids), self.vectors
+        if not ids:
+            return {"matches": []}
+
+        query = np.asarray(vector, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+        scores = vectors @ query / np.maximum(norms, 1e-12)
+        top = np.argsort(-scores)[:top_k]
+        return {
+            "matches": [
+                {
+                    "id": ids[i],
+                    "score": float(scores[i]),
+                    **({"values": vectors[i].tolist()} if include_values else {}),
+                }
+                for i in top
+            ]
+        }
+
+    def fetch(self, ids, **kwargs):
+        self._call("fetch")
+        with self._lock:
+            found = {
+                vector_id: SimpleNamespace(
+                    id=vector_id,
+                    values=self.vectors[self.positions[vector_id]].tolist(),
+                    metadata=self.metadata[vector_id],
+                )
+                for vector_id in ids
+                if vector_id in self.positions
+            }
+        return SimpleNamespace(vectors=found)
+
+
+# -------- Rekognition --------
+
+
+def face_signature(image):
+    """
+    Stand-in for a Rekognition face vector: a normalized 16x16 grayscale
+    thumbnail. Crops of the same face from the same image compare as
+    near-identical, different faces do not.
+    """
+    thumbnail = np.asarray(image.convert("L").resize((16, 16)), dtype=np.float32).ravel()
+    thumbnail -= thumbnail.mean()
+    return thumbnail / max(float(np.linalg.norm(thumbnail)), 1e-6)
+
+
+class FakeRekognition(FakeService):
+    """
+    Collection faces, users and detections in memory.
+
+    Detection cannot run a real model, so face boxes come from `face_boxes`
+    (S3 key -> list of BoundingBox dicts, e.g. from the corpus manifest),
+    else `default_faces` boxes laid out across the image.
+    """
+
+    def __init__(self, s3, latency=0.0, face_boxes=None, default_faces=1):
+        super().__init__(latency)
+        self.s3 = s3
+        self.face_boxes = face_boxes or {}
+        self.default_faces = default_faces
+        self.collections = set()
+        self.faces = {}
+        self.users = set()
+
+    # Collections
+
+    def describe_collection(self, CollectionId):
+        self._call("describe_collection")
+        if CollectionId not in self.collections:
+            raise client_error("ResourceNotFoundException", "DescribeCollection")
+        return {"FaceCount": len(self.faces)}
+
+    def create_collection(self, CollectionId):
+        self._call("create_collection")
+        self.collections.add(CollectionId)
+        return {"StatusCode": 200}
+
+    # Detection
+
+    def _load(self, image):
+        from PIL import Image
+
+        if "S3Object" in image:
+            s3_object = image["S3Object"]
+            key = s3_object["Name"]
+            data = self.s3.get_object(Bucket=s3_object["Bucket"], Key=key)["Body"].read()
+        else:
+            key, data = None, image["Bytes"]
+        return key, Image.open(io.BytesIO(data)).convert("RGB")
+
+    def _boxes(self, key):
+        if key in self.face_boxes:
+            return self.face_boxes[key]
+        width = 1.0 / (self.default_faces + 1)
+        return [
+            {"Left": width * (i + 0.5), "Top": 0.3, "Width": width, "Height": 0.4}
+            for i in range(self.default_faces)
+        ]
+
+    def detect_faces(self, Image, Attributes=None):
+        self._call("detect_faces")
+        key, _ = self._load(Image)
+        return {"FaceDetails": [{"BoundingBox": box, "Confidence": 99.9} for box in self._boxes(key)]}
+
+    def _crop(self, image, box):
+        width, height = image.size
+        return image.crop(
+            (
+                int(box["Left"] * width),
+                int(box["Top"] * height),
+                int((box["Left"] + box["Width"]) * width),
+                int((box["Top"] + box["Height"]) * height),
+            )
+        )
+
+    # Search
+
+    def _search(self, signature, threshold, max_faces, exclude=None):
+        with self._lock:
+            faces = [face for face in self.faces.values() if face["FaceId"] != exclude]
+        matches = []
+        for face in faces:
+            similarity = 100.0 * max(0.0, float(face["signature"] @ signature))
+            if similarity >= threshold:
+                matches.append(
+                    {
+                        "Similarity": similarity,
+                        "Face": {
+                            key: value for key, value in face.items() if key != "signature"
+                        },
+                    }
+                )
+        matches.sort(key=lambda match: -match["Similarity"])
+        return {"FaceMatches": matches[:max_faces]}
+
+    def search_faces_by_image(self, CollectionId, Image, FaceMatchThreshold=80.0, MaxFaces=5):
+        self._call("search_faces_by_image")
+        _, image = self._load(Image)
+        return self._search(face_signature(image), FaceMatchThreshold, MaxFaces)
+
+    def search_faces(self, CollectionId, FaceId, FaceMatchThreshold=80.0, MaxFaces=5):
+        self._call("search_faces")
+        if FaceId not in self.faces:
+            raise client_error("InvalidParameterException", "SearchFaces")
+        return self._search(
+            self.faces[FaceId]["signature"], FaceMatchThreshold, MaxFaces, exclude=FaceId
+        )
+
+    # Indexing
+
+    def index_faces(self, CollectionId, Image, ExternalImageId=None, MaxFaces=None, **kwargs):
+        self._call("index_faces")
+        key, image = self._load(Image)
+        # A crop sent as bytes is one face filling the image
+        boxes = (
+            self._boxes(key)
+            if key is not None or MaxFaces is not None
+            else [{"Left": 0.0, "Top": 0.0, "Width": 1.0, "Height": 1.0}]
+        )
+        records = []
+        for box in boxes[: MaxFaces or None]:
+            face = {
+                "FaceId": uuid.uuid4().hex,
+                "BoundingBox": box,
+                "ExternalImageId": ExternalImageId,
+                "signature": face_signature(self._crop(image, box)),
+            }
+            with self._lock:
+                self.faces[face["FaceId"]] = face
+            records.append({"Face": {k: v for k, v in face.items() if k != "signature"}})
+        return {"FaceRecords": records, "UnindexedFaces": []}
+
+    def delete_faces(self, CollectionId, FaceIds):
+        self._call("delete_faces")
+        with self._lock:
+            for face_id in FaceIds:
+                self.faces.pop(face_id, None)
+        return {"DeletedFaces": FaceIds}
+
+    def create_user(self, CollectionId, UserId, **kwargs):
+        self._call("create_user")
+        with self._lock:
+            if UserId in self.users:
+                raise client_error("ConflictException", "CreateUser")
+            self.users.add(UserId)
+        return {}
+
+    def associate_faces(self, CollectionId, UserId, FaceIds, **kwargs):
+        self._call("associate_faces")
+        with self._lock:
+            if UserId not in self.users:
+                raise client_error("ResourceNotFoundException", "AssociateFaces")
+            for face_id in FaceIds:
+                if face_id in self.faces:
+                    self.faces[face_id]["UserId"] = UserId
+        return {"AssociatedFaces": [{"FaceId": face_id} for face_id in FaceIds]}
@@ -0,0 +1,305 @@
+"""
+Accuracy-vs-cost sweep of the face_recognition matching settings.
+
+Encodes a labelled image set once with the lambda's own
+detect_and_encode_faces_unified, then replays the faces in order through
+enhanced_face_matching against an in-memory index for every combination
+of the given settings. Unmatched faces enroll a new person, as in the
+pipeline. Per configuration it reports match precision and recall, false
+splits (new persons created for someone already enrolled), false merges
+and query cost.
+
+Labels come from one subdirectory per person (corpus/alice/1.jpg) or a
+"person" entry per file in the corpus manifest.json. Only the largest
+face of each image is evaluated.
+
+Run from src/lambdas:
+
+    python -m face_bench.sweep --corpus ~/lfw-subset --encodings lfw.npz \\
+        --similarity 0.8,0.85,0.9 --tolerance 0.35,0.4,0.45 --top-k 1,3,5 \\
+        --multi-stage true,false --output sweep.json
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from face_bench.benchmark import BENCH_TABLE, IMAGE_EXTENSIONS
+from face_pipeline.loader import load_lambda
+
+# Command line option -> FaceRecognitionConfig attribute and value parser
+SWEEP_SETTINGS = {
+    "similarity": ("PINECONE_SIMILARITY_THRESHOLD", float),
+    "tolerance": ("FACE_RECOGNITION_TOLERANCE", float),
+    "top_k": ("PINECONE_TOP_K", int),
+    "multi_stage": ("ENABLE_MULTI_STAGE_MATCHING", lambda value: value.lower() == "true"),
+    "relaxed_similarity": ("RELAXED_SIMILARITY_THRESHOLD", float),
+    "relaxed_tolerance": ("RELAXED_TOLERANCE", float),
+    "duplicate_similarity": ("DUPLICATE_SIMILARITY_THRESHOLD", float),
+    "duplicate_tolerance": ("DUPLICATE_TOLERANCE", float),
+    "person_samples": ("MAX_PERSON_SAMPLES", int),
+}
+
+
+def load_labelled_images(corpus_dir):
+    """[(path, label)] from person subdirectories and/or manifest "person" entries"""
+    corpus_dir = Path(corpus_dir)
+    manifest_path = corpus_dir / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    labelled = []
+    for path in sorted(corpus_dir.rglob("*")):
+        if path.suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+        relative = path.relative_to(corpus_dir).as_posix()
+        label = manifest.get(relative, {}).get("person")
+        if label is None and path.parent != corpus_dir:
+            label = path.parent.name
+        if label is not None:
+            labelled.append((path, label))
+
+    if not labelled:
+        raise SystemExit(f"No labelled images found in {corpus_dir}")
+    return labelled
+
+
+def encode_faces(lf, labelled, cache_path=None):
+    """
+    (labels, encodings) for the largest face of each image, read from
+    `cache_path` when it was written with the same detection settings
+    """
+    signature = lf.get_detection_config_signature()
+    files = [str(path) for path, _ in labelled]
+    if cache_path and Path(cache_path).exists():
+        cached = np.load(cache_path, allow_pickle=False)
+        if str(cached["signature"]) == signature and list(cached["files"]) == files:
+            return list(cached["labels"]), list(cached["encodings"]), json.loads(str(cached["skipped"]))
+
+    lf.load_vision_libraries()
+    labels, encodings = [], []
+    skipped = Counter()
+    for path, label in labelled:
+        _, embeddings, _, _ = lf.detect_and_encode_faces_unified(path.read_bytes())
+        if not embeddings:
+            skipped["no_face"] += 1
+            continue
+        if len(embeddings) > 1:
+            skipped["multiple_faces"] += 1
+        largest = max(
+            embeddings, key=lambda embedding: embedding["size"]["width"] * embedding["size"]["height"]
+        )
+        labels.append(label)
+        encodings.append(largest["encoding"])
+
+    if cache_path:
+        np.savez(
+            cache_path,
+            signature=signature,
+            files=np.array(files),
+            labels=np.array(labels),
+            encodings=np.array(encodings),
+            skipped=json.dumps(skipped),
+        )
+    return labels, encodings, dict(skipped)
+
+
+def ratio(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+
+def evaluate(lf, labels, encodings, settings):
+    """Replay every face through matching and enrollment with `settings` applied"""
+    for attribute, value in settings.items():
+        setattr(lf.config, attribute, value)
+
+    # Room for every face to become a person with all of its samples
+    index = lf.InMemoryIndex(len(encodings) * (lf.config.MAX_PERSON_SAMPLES + 2))
+    owners = {}
+    seen_labels = set()
+    counts = Counter()
+    matching_time = 0.0
+
+    for label, encoding in zip(labels, encodings):
+        embedding = {"encoding": encoding}
+        start = time.perf_counter()
+        found, person_id, _, stage = lf.enhanced_face_matching(embedding, index)
+        matching_time += time.perf_counter() - start
+
+        known = label in seen_labels
+        counts["known_faces"] += known
+        if found:
+            counts["matches"] += 1
+            counts[f"{stage}_matches"] += 1
+            if owners[person_id] == label:
+                counts["correct_matches"] += 1
+            else:
+                counts["false_merges"] += 1
+            face = {
+                "found": True,
+                "person_id": person_id,
+                "confidence": embedding["match_decision"]["match_confidence"],
+                "stage": stage,
+                "embedding": embedding,
+            }
+            lf.refine_persons([face], index)
+        else:
+            person_id = f"person{len(owners) + 1}"
+            owners[person_id] = label
+            index.upsert(lf.new_person_vectors(person_id, encoding))
+            counts["new_persons"] += 1
+            counts["false_splits"] += known
+            if lf.config.ENABLE_DUPLICATE_DETECTION:
+                flagged = bool(
+                    lf.check_for_duplicate_persons(encoding, matches=embedding["matches"])
+                )
+                counts["duplicate_flags"] += flagged
+                counts["correct_duplicate_flags"] += flagged and known
+        seen_labels.add(label)
+
+    precision = ratio(counts["correct_matches"], counts["matches"])
+    recall = ratio(counts["correct_matches"], counts["known_faces"])
+    return {
+        "settings": settings,
+        "faces": len(encodings),
+        "persons_expected": len(seen_labels),
+        "persons_created": counts["new_persons"],
+        "precision": precision,
+        "recall": recall,
+        "f1": (
+            round(2 * precision * recall / (precision + recall), 4)
+            if precision and recall
+            else 0.0
+        ),
+        "false_split_rate": ratio(counts["false_splits"], counts["known_faces"]),
+        "false_merge_rate": ratio(counts["false_merges"], len(encodings)),
+        "new_person_rate": ratio(counts["new_persons"], len(encodings)),
+        "relaxed_match_share": ratio(counts["relaxed_matches"], counts["matches"]),
+        "duplicate_flag_precision": ratio(
+            counts["correct_duplicate_flags"], counts["duplicate_flags"]
+        ),
+        "duplicate_flag_recall": ratio(
+            counts["correct_duplicate_flags"], counts["false_splits"]
+        ),
+        "candidates_per_query": lf.get_query_top_k(),
+        "vectors_per_query": lf.get_vector_top_k(lf.get_query_top_k()),
+        "matching_ms_per_face": round(matching_time * 1000 / max(len(encodings), 1), 3),
+    }
+
+
+def recommend(results, max_f1_drop):
+    """Cheapest configuration within max_f1_drop of the best F1: fewest vectors, then fewest stages"""
+    best_f1 = max(result["f1"] for result in results)
+    eligible = [result for result in results if result["f1"] >= best_f1 - max_f1_drop]
+    return min(
+        eligible,
+        key=lambda result: (
+            result["vectors_per_query"],
+            result["settings"].get("ENABLE_MULTI_STAGE_MATCHING", True),
+            -result["f1"],
+        ),
+    )
+
+
+def print_table(results):
+    columns = [
+        ("f1", 6),
+        ("precision", 9),
+        ("recall", 6),
+        ("false_split_rate", 16),
+        ("false_merge_rate", 16),
+        ("candidates_per_query", 10),
+        ("vectors_per_query", 7),
+    ]
+    print("  ".join(f"{name[:width]:>{width}}" for name, width in columns) + "  settings")
+    for result in results:
+        values = "  ".join(f"{str(result[name]):>{width}}" for name, width in columns)
+        settings = " ".join(f"{key}={value}" for key, value in result["settings"].items())
+        print(f"{values}  {settings}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus", required=True, help="Labelled image directory")
+    parser.add_argument("--encodings", help="Cache file (.npz) for the encoded faces")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Environment setting for the lambda (e.g. detection settings), repeatable",
+    )
+    for option in SWEEP_SETTINGS:
+        parser.add_argument(
+            f"--{option.replace('_', '-')}",
+            help="Comma-separated values to sweep (default: the configured value)",
+        )
+    parser.add_argument(
+        "--duplicate-detection",
+        action="store_true",
+        help="Run the duplicate check on new persons and report its precision/recall",
+    )
+    parser.add_argument(
+        "--shuffle-seed", type=int, help="Replay faces in a shuffled order instead of file order"
+    )
+    parser.add_argument("--max-f1-drop", type=float, default=0.01)
+    parser.add_argument("--output", help="Write all results as JSON here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    os.environ.setdefault("DDB_TABLE_NAME", BENCH_TABLE)
+    os.environ["VECTOR_INDEX"] = "memory"
+    os.environ["ENABLE_DETECTION_CACHE"] = "false"
+    os.environ["ENABLE_DUPLICATE_DETECTION"] = str(args.duplicate_detection).lower()
+    for setting in args.set:
+        key, _, value = setting.partition("=")
+        os.environ[key] = value
+
+    # Matching logs every decision at INFO
+    logging.disable(logging.WARNING)
+    lf = load_lambda("face_recognition")
+
+    labelled = load_labelled_images(args.corpus)
+    labels, encodings, skipped = encode_faces(lf, labelled, args.encodings)
+    if args.shuffle_seed is not None:
+        order = list(range(len(labels)))
+        random.Random(args.shuffle_seed).shuffle(order)
+        labels = [labels[i] for i in order]
+        encodings = [encodings[i] for i in order]
+    print(f"{len(labels)} faces of {len(set(labels))} persons, skipped: {skipped or 'none'}")
+
+    grid = {
+        attribute: [parse(value) for value in getattr(args, option).split(",")]
+        for option, (attribute, parse) in SWEEP_SETTINGS.items()
+        if getattr(args, option)
+    }
+    results = [
+        evaluate(lf, labels, encodings, dict(zip(grid, values)))
+        for values in itertools.product(*grid.values())
+    ]
+    results.sort(key=lambda result: -result["f1"])
+
+    print_table(results)
+    choice = recommend(results, args.max_f1_drop)
+    print(f"\nCheapest within {args.max_f1_drop} F1 of the best: {json.dumps(choice['settings'])}")
+
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps({"skipped": skipped, "results": results, "recommended": choice}, indent=2)
+            + "\n"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Offline maintenance jobs for the face index and the persons table"""
@@ -0,0 +1,272 @@
+"""
+Bulk backfill: run every image under an S3 prefix through a face lambda's
+handler pipeline. Use it to reprocess the library after changing
+FACE_DETECTION_MODEL or the matching thresholds, or when moving between
+the dlib and Rekognition backends.
+
+Keys are listed page by page and put on a bounded queue in batches of
+--batch-size, so listing never runs far ahead of processing. --workers
+processes take batches from the queue. Each worker loads the lambda and
+calls its handler with a synthetic SQS event. Detection, matching, person
+creation and the batched DynamoDB writes are therefore the production
+code. The workers provide the parallelism, so each one runs detection
+in-process (DETECTION_WORKERS=1) unless --set says otherwise.
+
+Finished keys are appended to --checkpoint. A rerun with the same file
+skips them and retries the keys that failed.
+
+Run from src/lambdas with the lambda's environment (DDB_TABLE_NAME,
+PINECONE_INDEX_NAME, ...):
+
+    python -m face_maintenance.backfill --lambda face_recognition \\
+        --bucket my-bucket --source large --checkpoint backfill.jsonl \\
+        --set FACE_DETECTION_MODEL=cnn
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+
+import boto3
+
+from face_pipeline.loader import load_lambda
+
+# Source -> (default prefix, key suffix)
+SOURCES = {
+    "originals": ("originals/", ""),
+    "large": ("processed/", "_large.webp"),
+}
+
+
+def list_keys(s3, bucket, prefix, suffix):
+    """Object keys under prefix ending with suffix, one ListObjectsV2 page at a time"""
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            if item["Key"].endswith(suffix) and not item["Key"].endswith("/"):
+                yield item["Key"]
+
+
+def build_record(bucket, source, key):
+    """SQS record in the format the thumbnail or upload trigger sends for this key"""
+    if source == "large":
+        body = {
+            "bucketName": bucket,
+            "largeImageKey": key,
+            "fileNameWithoutExt": key.split("/")[-1][: -len(SOURCES["large"][1])],
+        }
+    else:
+        body = {"bucketName": bucket, "objectKey": key}
+    return {"messageId": key, "body": json.dumps(body)}
+
+
+def load_checkpoint(path):
+    """Keys whose latest checkpoint entry is done"""
+    done = set()
+    if not path.exists():
+        return done
+    with open(path) as entries:
+        for line in entries:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of an interrupted run
+                continue
+            if entry["status"] == "done":
+                done.add(entry["key"])
+            else:
+                done.discard(entry["key"])
+    return done
+
+
+def batch_entries(keys, response):
+    """Checkpoint entries for the keys of one handler response"""
+    body = json.loads(response["body"])
+    results = {
+        result["object_key"]: result
+        for result in body.get("results", [])
+        if "object_key" in result
+    }
+    failed = {failure["itemIdentifier"] for failure in response.get("batchItemFailures", [])}
+
+    entries = []
+    for key in keys:
+        result = results.get(key, {})
+        if key in failed:
+            error = result.get("error", body.get("error", "failed"))
+            entries.append({"key": key, "status": "failed", "error": error})
+        else:
+            entries.append(
+                {"key": key, "status": "done", "faces": len(result.get("persons_found", []))}
+            )
+    return entries
+
+
+def worker(lambda_name, settings, verbose, tasks, results):
+    """Process batches from tasks with the lambda's handler until a None arrives, then report None"""
+    os.environ.setdefault("DETECTION_WORKERS", "1")
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        os.environ[key] = value
+    if not verbose:
+        # The lambda logs every event and result at INFO
+        logging.disable(logging.INFO)
+    module = load_lambda(lambda_name)
+
+    while True:
+        event = tasks.get()
+        if event is None:
+            results.put(None)
+            return
+        keys = [record["messageId"] for record in event["Records"]]
+        try:
+            entries = batch_entries(keys, module.handler(event, None))
+        except Exception as e:
+            entries = [{"key": key, "status": "failed", "error": str(e)} for key in keys]
+        results.put(entries)
+
+
+def feed(tasks, keys, args, worker_count):
+    """Queue keys in batches, then one None per worker"""
+    try:
+        batch = []
+        for key in keys:
+            batch.append(build_record(args.bucket, args.source, key))
+            if len(batch) == args.batch_size:
+                tasks.put({"Records": batch})
+                batch = []
+        if batch:
+            tasks.put({"Records": batch})
+    finally:
+        for _ in range(worker_count):
+            tasks.put(None)
+
+
+def pending_keys(s3, args, done):
+    """Listed keys not done in an earlier run, up to --limit"""
+    default_prefix, suffix = SOURCES[args.source]
+    count = 0
+    for key in list_keys(s3, args.bucket, args.prefix or default_prefix, suffix):
+        if key in done:
+            continue
+        if args.limit and count >= args.limit:
+            return
+        count += 1
+        yield key
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--lambda",
+        dest="lambda_name",
+        default="face_recognition",
+        choices=["face_recognition", "face_rekognition"],
+    )
+    parser.add_argument("--bucket", default=os.environ.get("S3_BUCKET_NAME"))
+    parser.add_argument(
+        "--source",
+        choices=list(SOURCES),
+        default="large",
+        help="originals/* uploads or processed/*_large.webp variants",
+    )
+    parser.add_argument("--prefix", help="Narrower key prefix than the source's")
+    parser.add_argument("--checkpoint", required=True, help="Progress file (JSON lines)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--limit", type=int, default=0, help="Process at most this many keys")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Environment setting for the lambda, repeatable",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Keep the lambda's INFO logs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if not args.bucket:
+        raise SystemExit("--bucket not given and S3_BUCKET_NAME not set")
+
+    checkpoint = Path(args.checkpoint)
+    done = load_checkpoint(checkpoint)
+    if done:
+        print(f"Resuming: {len(done)} keys already done")
+
+    # At most two batches wait per worker, which bounds memory and listing
+    tasks = multiprocessing.Queue(maxsize=2 * args.workers)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=worker, args=(args.lambda_name, args.set, args.verbose, tasks, results)
+        )
+        for _ in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    keys = pending_keys(boto3.client("s3"), args, done)
+    threading.Thread(target=feed, args=(tasks, keys, args, len(processes)), daemon=True).start()
+
+    start = time.time()
+    processed = failed = faces = finished = 0
+    with open(checkpoint, "a") as log:
+        if log.tell() and checkpoint.read_bytes()[-1:] != b"\n":
+            log.write("\n")
+        while True:
+            try:
+                entries = results.get(timeout=5)
+            except queue.Empty:
+                if any(process.is_alive() for process in processes):
+                    continue
+                # Workers flush their results before exiting
+                try:
+                    entries = results.get(timeout=1)
+                except queue.Empty:
+                    break
+
+            if entries is None:
+                finished += 1
+                if finished == len(processes):
+                    break
+                continue
+            log.writelines(json.dumps(entry) + "\n" for entry in entries)
+            log.flush()
+            processed += len(entries)
+            failed += sum(entry["status"] == "failed" for entry in entries)
+            faces += sum(entry.get("faces", 0) for entry in entries)
+            per_minute = processed / max(time.time() - start, 1e-9) * 60
+            print(
+                f"{processed} images ({failed} failed, {faces} faces), "
+                f"{per_minute:.0f} images/min"
+            )
+
+    crashed = [process.exitcode for process in processes if process.exitcode]
+    if crashed:
+        print(f"{len(crashed)} workers exited with {crashed}; rerun to retry their batches")
+
+    minutes = (time.time() - start) / 60
+    print(
+        json.dumps(
+            {
+                "images": processed,
+                "failed": failed,
+                "faces": faces,
+                "minutes": round(minutes, 2),
+                "images_per_minute": round(processed / minutes, 1) if minutes else None,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
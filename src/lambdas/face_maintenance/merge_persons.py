@@ -0,0 +1,763 @@
+"""
+Offline merge of duplicate persons in the face_recognition Pinecone index.
+
+The lambdas only log potential duplicates (check_for_duplicate_persons).
+This job finds them across the whole index and merges them, in four
+stages checkpointed in --work-dir so that an interrupted run resumes where
+it stopped:
+
+  export  every person vector, fetched by the sequential `personN` ids as
+          the local vector index syncs them, into .npz shards, plus the
+          TAGGING, PERSON and user items from a parallel table scan
+  graph   an approximate nearest-neighbour graph. Vectors are bucketed
+          into --lists coarse clusters and compared, in bounded blocks,
+          with the buckets of their --probes closest clusters. Pairs of
+          different persons within the duplicate thresholds (similarity >
+          DUPLICATE_SIMILARITY_THRESHOLD and distance <= DUPLICATE_TOLERANCE
+          unless overridden) become edges
+  plan    groups persons along the edges, strongest first, into plan.jsonl.
+          Persons tagged in the same image, linked to different users or
+          given different names are never merged
+  apply   merges each group into its survivor: one centroid and the pooled
+          samples are upserted, the other persons' vectors are deleted,
+          their TAGGING items are rewritten to the survivor, their PERSON
+          items are deleted and linked users are moved to the survivor.
+          Each chunk is logged in a MERGED_PERSONS item, from which warm
+          lambdas evict the merged persons from their local vector index
+
+Each command first runs the earlier stages that have not completed, so
+`plan` is a dry run and `apply` acts on the plan it reviewed.
+
+Run from src/lambdas with the face_recognition lambda's environment
+(DDB_TABLE_NAME, PINECONE_INDEX_NAME, MAX_PERSON_SAMPLES, ...):
+
+    python -m face_maintenance.merge_persons --work-dir merge-work plan
+    python -m face_maintenance.merge_persons --work-dir merge-work apply
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+from boto3.dynamodb.conditions import Attr, Key
+
+from face_pipeline.loader import load_lambda
+
+# Pinecone request limits
+UPSERT_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+
+# Coarse clusters are trained on a sample of this many vectors per cluster
+TRAIN_POINTS_PER_LIST = 64
+TRAIN_ITERATIONS = 10
+
+# Coarse clusters joined per edge file, and so per checkpoint
+LISTS_PER_PART = 256
+
+COMMANDS = ["export", "graph", "plan", "apply"]
+
+
+def write_atomically(path, write, mode="w"):
+    """Write a file through a temporary one, so a crash never leaves half of it"""
+    temporary = path.with_name(path.name + ".tmp")
+    with open(temporary, mode) as out:
+        write(out)
+    os.replace(temporary, path)
+
+
+class WorkDir:
+    """Stage outputs and checkpoint state of one merge run"""
+
+    def __init__(self, path):
+        self.root = Path(path)
+        self.root.mkdir(parents=True, exist_ok=True)
+        state_path = self.root / "state.json"
+        self.state = json.loads(state_path.read_text()) if state_path.exists() else {}
+
+    def path(self, *parts):
+        path = self.root.joinpath(*parts)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def stage(self, name):
+        return self.state.setdefault(name, {})
+
+    def save(self):
+        write_atomically(
+            self.root / "state.json", lambda out: out.write(json.dumps(self.state, indent=2))
+        )
+
+
+# -------- Export --------
+
+
+def export_vectors(lf, work, shard_persons, concurrency):
+    """Fetch all person vectors into shards of shard_persons persons each"""
+    stage = work.stage("export")
+    if "person_limit" not in stage:
+        # Persons created after this point are left for the next run
+        response = lf.get_table().get_item(
+            Key={"PK": "UNKNOWN_PERSONS", "SK": "UNKNOWN_PERSONS"}
+        )
+        stage["person_limit"] = int(response.get("Item", {}).get("limit", 0))
+        stage["shard_persons"] = shard_persons
+        work.save()
+    if stage.get("vectors_done"):
+        return
+
+    index = lf.get_index()
+    person_limit = stage["person_limit"]
+    shard_persons = stage["shard_persons"]
+    batch_size = lf.config.LOCAL_INDEX_FETCH_BATCH_SIZE
+
+    for shard in range(math.ceil(person_limit / shard_persons)):
+        path = work.path("vectors", f"shard-{shard:05d}.npz")
+        if path.exists():
+            continue
+
+        first = shard * shard_persons + 1
+        last = min(first + shard_persons - 1, person_limit)
+        wanted = [
+            vector_id
+            for number in range(first, last + 1)
+            for vector_id in lf.person_vector_ids(f"person{number}")
+        ]
+        chunks = [wanted[i : i + batch_size] for i in range(0, len(wanted), batch_size)]
+        fetched = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for response in executor.map(lambda ids: index.fetch(ids=ids), chunks):
+                fetched.update(response.vectors)
+
+        # Keep the person order: centroid first, then samples #1..#K
+        ids = [vector_id for vector_id in wanted if vector_id in fetched]
+        values = np.array([fetched[vector_id].values for vector_id in ids], dtype=np.float32)
+        # Faces merged into each centroid; samples are single faces
+        counts = [
+            0
+            if "#" in vector_id
+            else int((getattr(fetched[vector_id], "metadata", None) or {}).get("count", 1))
+            for vector_id in ids
+        ]
+        write_atomically(
+            path,
+            lambda out: np.savez(
+                out,
+                ids=np.array(ids, dtype=str),
+                values=values.reshape(len(ids), -1) if ids else np.empty((0, 128), np.float32),
+                counts=np.array(counts, dtype=np.int32),
+            ),
+            mode="wb",
+        )
+        print(f"Exported persons {first}-{last}: {len(ids)} vectors")
+
+    stage["vectors_done"] = True
+    work.save()
+
+
+def table_record(item):
+    """Compact [kind, key, value] row of a scanned TAGGING, PERSON or user item"""
+    entity_type = item.get("entityType", "")
+    if entity_type.startswith("TAGGING#"):
+        return ["tag", item["PK"], entity_type[len("TAGGING#") :]]
+    if entity_type == "PERSON":
+        return ["person", item["SK"], item.get("displayName", item["SK"])]
+    return ["user", item["PK"], item["personId"]]
+
+
+def export_table(lf, work, segments):
+    """Parallel scan of the TAGGING, PERSON and person-linked user items, one file per segment"""
+    stage = work.stage("export")
+    segments = stage.setdefault("segments", segments)
+    done = stage.setdefault("segments_done", [])
+    pending = [segment for segment in range(segments) if segment not in done]
+    if not pending:
+        return
+
+    table = lf.get_table()
+
+    def scan_segment(segment):
+        kwargs = {
+            "Segment": segment,
+            "TotalSegments": segments,
+            "FilterExpression": Attr("entityType").begins_with("TAGGING#")
+            | Attr("entityType").eq("PERSON")
+            | Attr("personId").exists(),
+            "ProjectionExpression": "PK, SK, entityType, displayName, personId",
+        }
+
+        def write(out):
+            while True:
+                response = table.scan(**kwargs)
+                for item in response["Items"]:
+                    out.write(json.dumps(table_record(item)) + "\n")
+                if "LastEvaluatedKey" not in response:
+                    return
+                kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        write_atomically(work.path("table", f"segment-{segment:03d}.jsonl"), write)
+        return segment
+
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        for future in as_completed([executor.submit(scan_segment, s) for s in pending]):
+            done.append(future.result())
+            work.save()
+    print(f"Scanned table in {segments} segments")
+
+
+def read_table_records(work):
+    for path in sorted((work.root / "table").glob("segment-*.jsonl")):
+        with open(path) as records:
+            for line in records:
+                yield json.loads(line)
+
+
+def load_vectors(work):
+    """(ids, values, counts) of all exported shards"""
+    shards = []
+    for path in sorted((work.root / "vectors").glob("shard-*.npz")):
+        with np.load(path, allow_pickle=False) as shard:
+            shards.append((shard["ids"], shard["values"], shard["counts"]))
+    if not shards:
+        return np.array([], dtype=str), np.empty((0, 128), np.float32), np.array([], np.int32)
+    return tuple(np.concatenate(columns) for columns in zip(*shards))
+
+
+# -------- Graph --------
+
+
+def nearest_lists(unit, centroids, count, block_size):
+    """Indices of the `count` most similar centroids of each vector, closest first"""
+    rows = max(1, block_size // len(centroids))
+    nearest = np.empty((len(unit), count), dtype=np.int32)
+    for i in range(0, len(unit), rows):
+        scores = unit[i : i + rows] @ centroids.T
+        top = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        nearest[i : i + rows] = np.take_along_axis(top, order, axis=1)
+    return nearest
+
+
+def train_coarse(unit, lists, block_size, seed):
+    """Spherical k-means centroids of a sample of the normalized vectors"""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(unit), lists * TRAIN_POINTS_PER_LIST)
+    sample = unit[np.sort(rng.choice(len(unit), sample_size, replace=False))]
+    centroids = sample[rng.choice(len(sample), lists, replace=False)]
+
+    for _ in range(TRAIN_ITERATIONS):
+        assignment = nearest_lists(sample, centroids, 1, block_size)[:, 0]
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        # Reseed clusters that lost all their points
+        empty = ~sums.any(axis=1)
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1), 1e-12)[:, None]
+    return centroids.astype(np.float32)
+
+
+def join_list(values, norms, owner, rows, candidates, similarity, tolerance, block_size):
+    """
+    Edges (person_a, person_b, similarity) with person_a < person_b between
+    the query rows and candidate rows that pass both thresholds, computed
+    in blocks of at most block_size pairs
+    """
+    edges = []
+    if not len(rows) or not len(candidates):
+        return edges
+
+    candidate_block = min(len(candidates), block_size)
+    row_block = max(1, block_size // candidate_block)
+    for i in range(0, len(rows), row_block):
+        query = rows[i : i + row_block]
+        for j in range(0, len(candidates), candidate_block):
+            other = candidates[j : j + candidate_block]
+            dots = values[query] @ values[other].T
+            scores = dots / np.maximum(np.outer(norms[query], norms[other]), 1e-12)
+            # Same euclidean distance the lambda's match decisions use
+            squared = norms[query, None] ** 2 + norms[other] ** 2 - 2 * dots
+            passing = (
+                (scores > similarity)
+                & (squared <= tolerance**2)
+                & (owner[query][:, None] != owner[other])
+            )
+            hit_rows, hit_columns = np.nonzero(passing)
+            if len(hit_rows):
+                a, b = owner[query][hit_rows], owner[other][hit_columns]
+                edges.append((np.minimum(a, b), np.maximum(a, b), scores[hit_rows, hit_columns]))
+    return edges
+
+
+def build_graph(work, values, owner, args):
+    """Approximate nearest-neighbour join of all vectors, saved as edge files per LISTS_PER_PART lists"""
+    stage = work.stage("graph")
+    if stage.get("done"):
+        return
+
+    lists = min(len(values), args.lists or int(math.sqrt(len(values))) or 1)
+    params = {
+        "similarity": args.similarity,
+        "tolerance": args.tolerance,
+        "lists": lists,
+        "probes": min(args.probes, lists),
+    }
+    if stage.setdefault("params", params) != params:
+        raise SystemExit(
+            f"{work.root} holds a graph built with {stage['params']}, use a new --work-dir"
+        )
+    work.save()
+
+    norms = np.linalg.norm(values, axis=1)
+    unit = values / np.maximum(norms, 1e-12)[:, None]
+
+    coarse_path = work.path("graph", "coarse.npy")
+    if coarse_path.exists():
+        coarse = np.load(coarse_path)
+    else:
+        coarse = train_coarse(unit, lists, args.block_size, args.seed)
+        write_atomically(coarse_path, lambda out: np.save(out, coarse), mode="wb")
+
+    probes_path = work.path("graph", "probes.npy")
+    if probes_path.exists():
+        probes = np.load(probes_path)
+    else:
+        probes = nearest_lists(unit, coarse, params["probes"], args.block_size)
+        write_atomically(probes_path, lambda out: np.save(out, probes), mode="wb")
+    del unit
+
+    # Each vector is a member of its closest list and queries all its probed lists
+    members = np.argsort(probes[:, 0], kind="stable")
+    member_offsets = np.searchsorted(probes[members, 0], np.arange(lists + 1))
+    flat = probes.ravel()
+    queries = np.argsort(flat, kind="stable")
+    query_offsets = np.searchsorted(flat[queries], np.arange(lists + 1))
+    queries //= probes.shape[1]
+
+    for first in range(stage.get("lists_done", 0), lists, LISTS_PER_PART):
+        last = min(first + LISTS_PER_PART, lists)
+        edges = []
+        for cluster in range(first, last):
+            edges += join_list(
+                values,
+                norms,
+                owner,
+                queries[query_offsets[cluster] : query_offsets[cluster + 1]],
+                members[member_offsets[cluster] : member_offsets[cluster + 1]],
+                args.similarity,
+                args.tolerance,
+                args.block_size,
+            )
+        a, b, scores = (
+            [np.concatenate(column) for column in zip(*edges)]
+            if edges
+            else (np.array([], np.int64), np.array([], np.int64), np.array([], np.float32))
+        )
+        write_atomically(
+            work.path("graph", f"edges-{first:05d}.npz"),
+            lambda out: np.savez(out, a=a, b=b, scores=scores),
+            mode="wb",
+        )
+        stage["lists_done"] = last
+        work.save()
+        print(f"Joined lists {last}/{lists}: {len(a)} candidate pairs")
+
+    stage["done"] = True
+    work.save()
+
+
+# -------- Plan --------
+
+
+def person_number(person):
+    return int(person[len("person") :])
+
+
+class PersonGroups:
+    """
+    Union-find over persons that refuses to merge groups holding two
+    persons tagged in the same image, linked to different users or given
+    different names, or growing past max_size persons
+    """
+
+    def __init__(self, images, users, names, max_size):
+        self.images = images
+        self.users = users
+        self.names = names
+        self.max_size = max_size
+        self.parent = {}
+        self.groups = {}
+
+    def find(self, person):
+        if person not in self.parent:
+            self.parent[person] = person
+            self.groups[person] = {
+                "members": [person],
+                "images": set(self.images.get(person, ())),
+                "users": set(self.users.get(person, ())),
+                "names": {self.names[person]} if person in self.names else set(),
+                "similarity": 1.0,
+            }
+        root = person
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[person] != root:
+            self.parent[person], person = root, self.parent[person]
+        return root
+
+    def union(self, a, b, similarity):
+        """Merge the groups of a and b. Returns the reason when refused, else None."""
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return None
+        group_a, group_b = self.groups[root_a], self.groups[root_b]
+        if not group_a["images"].isdisjoint(group_b["images"]):
+            return "same_image"
+        if len(group_a["users"] | group_b["users"]) > 1:
+            return "different_users"
+        if len(group_a["names"] | group_b["names"]) > 1:
+            return "different_names"
+        if self.max_size and len(group_a["members"]) + len(group_b["members"]) > self.max_size:
+            return "max_group_size"
+
+        if len(group_a["images"]) < len(group_b["images"]):
+            root_a, root_b, group_a, group_b = root_b, root_a, group_b, group_a
+        self.parent[root_b] = root_a
+        group_a["members"] += group_b["members"]
+        group_a["images"] |= group_b["images"]
+        group_a["users"] |= group_b["users"]
+        group_a["names"] |= group_b["names"]
+        group_a["similarity"] = min(group_a["similarity"], group_b["similarity"], similarity)
+        del self.groups[root_b]
+        return None
+
+    def survivor(self, members):
+        """Keep the person linked to a user, then a named one, then the oldest"""
+        return min(
+            members,
+            key=lambda person: (
+                person not in self.users,
+                person not in self.names,
+                person_number(person),
+            ),
+        )
+
+
+def plan_merges(work, persons, max_group_size):
+    """Group the graph's persons into merges and write them to plan.jsonl"""
+    plan_path = work.root / "plan.jsonl"
+    if work.stage("apply").get("groups_done") and plan_path.exists():
+        print(f"Apply already started, keeping {plan_path}")
+        return
+
+    parts = [np.load(path) for path in sorted((work.root / "graph").glob("edges-*.npz"))]
+    a = np.concatenate([part["a"] for part in parts]) if parts else np.array([], np.int64)
+    b = np.concatenate([part["b"] for part in parts]) if parts else np.array([], np.int64)
+    scores = np.concatenate([part["scores"] for part in parts]) if parts else np.array([])
+
+    # Strongest similarity per pair of persons, strongest pairs first
+    order = np.lexsort((-scores, b, a))
+    a, b, scores = a[order], b[order], scores[order]
+    first = np.ones(len(a), dtype=bool)
+    first[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+    order = np.argsort(-scores[first], kind="stable")
+    a, b, scores = a[first][order], b[first][order], scores[first][order]
+
+    candidates = {str(persons[i]) for i in np.union1d(a, b)}
+    images, users, names = {}, {}, {}
+    for kind, key, value in read_table_records(work):
+        if kind == "tag" and value in candidates:
+            images.setdefault(value, set()).add(key)
+        elif kind == "user" and value in candidates:
+            users.setdefault(value, set()).add(key)
+        elif kind == "person" and key in candidates and value != key:
+            names[key] = value
+
+    groups = PersonGroups(images, users, names, max_group_size)
+    refused = Counter()
+    for person_a, person_b, score in zip(a, b, scores):
+        reason = groups.union(str(persons[person_a]), str(persons[person_b]), float(score))
+        if reason:
+            refused[reason] += 1
+
+    plan = []
+    for group in groups.groups.values():
+        if len(group["members"]) < 2:
+            continue
+        survivor = groups.survivor(group["members"])
+        plan.append(
+            {
+                "survivor": survivor,
+                "merged": sorted(
+                    (person for person in group["members"] if person != survivor),
+                    key=person_number,
+                ),
+                "similarity": round(group["similarity"], 4),
+                "tagged_images": len(group["images"]),
+            }
+        )
+    plan.sort(key=lambda merge: person_number(merge["survivor"]))
+
+    write_atomically(
+        plan_path, lambda out: out.writelines(json.dumps(merge) + "\n" for merge in plan)
+    )
+    work.stage("plan")["groups"] = len(plan)
+    work.save()
+    merged = sum(len(merge["merged"]) for merge in plan)
+    print(
+        f"{len(a)} candidate pairs, refused: {dict(refused) or 'none'}. "
+        f"Proposed merging {merged} persons into {len(plan)} survivors, see {plan_path}"
+    )
+
+
+# -------- Apply --------
+
+
+def merged_person_vectors(lf, survivor, person_vectors):
+    """
+    Index vectors of a merge survivor from [(person, [(id, values, count)])],
+    survivor first. The centroid is the mean of the centroids weighted by
+    their face counts. The samples of all persons (a person without
+    samples contributes its centroid) are kept up to MAX_PERSON_SAMPLES.
+    """
+    total = 0
+    mean = None
+    samples = []
+    for person, vectors in person_vectors:
+        centroids = [(values, count) for vector_id, values, count in vectors if vector_id == person]
+        for values, count in centroids:
+            count = max(int(count), 1)
+            weighted = values.astype(np.float64) * count
+            mean = weighted if mean is None else mean + weighted
+            total += count
+        samples += [values for vector_id, values, _ in vectors if vector_id != person] or [
+            values for values, _ in centroids
+        ]
+    if mean is None:
+        return []
+
+    mean /= total
+    if lf.config.MAX_PERSON_SAMPLES <= 0:
+        return [{"id": survivor, "values": mean.tolist()}]
+    samples = samples[: lf.config.MAX_PERSON_SAMPLES]
+    return [
+        {
+            "id": survivor,
+            "values": mean.tolist(),
+            "metadata": {"count": total, "samples": len(samples)},
+        }
+    ] + [
+        {"id": f"{survivor}#{k}", "values": sample.tolist(), "metadata": {"person": survivor}}
+        for k, sample in enumerate(samples, 1)
+    ]
+
+
+def query_taggings(table, person):
+    """All TAGGING items of a person, through the entityType GSI"""
+    kwargs = {
+        "IndexName": "entityType-PK-index",
+        "KeyConditionExpression": Key("entityType").eq(f"TAGGING#{person}"),
+    }
+    items = []
+    while True:
+        response = table.query(**kwargs)
+        items += response["Items"]
+        if "LastEvaluatedKey" not in response:
+            return items
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def rewrite_items(table, survivors, users, concurrency):
+    """
+    Move the TAGGING items of each merged person to its survivor, delete
+    its PERSON item and relink its users. Returns the number of taggings moved.
+    """
+    merged = list(survivors)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        taggings = list(executor.map(lambda person: query_taggings(table, person), merged))
+
+    moved = 0
+    with table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as batch:
+        for person, items in zip(merged, taggings):
+            survivor = survivors[person]
+            for item in items:
+                batch.put_item(
+                    Item={
+                        **item,
+                        "SK": f"PERSON#{survivor}",
+                        "entityType": f"TAGGING#{survivor}",
+                    }
+                )
+                batch.delete_item(Key={"PK": item["PK"], "SK": item["SK"]})
+                moved += 1
+            batch.delete_item(Key={"PK": f"PERSON#{person}", "SK": person})
+
+    for person in merged:
+        for user in users.get(person, ()):
+            table.update_item(
+                Key={"PK": user, "SK": user},
+                UpdateExpression="SET personId = :personId, updatedAt = :updatedAt",
+                ExpressionAttributeValues={
+                    ":personId": survivors[person],
+                    ":updatedAt": datetime.now().isoformat(),
+                },
+            )
+    return moved
+
+
+def apply_plan(lf, work, ids, values, counts, persons, owner, args):
+    """
+    Apply plan.jsonl in chunks of --apply-batch merges, checkpointing after
+    each. Vectors come from the export, so re-running a chunk is idempotent;
+    faces folded into these persons since the export are not carried over.
+    """
+    merges = [json.loads(line) for line in (work.root / "plan.jsonl").read_text().splitlines()]
+    stage = work.stage("apply")
+
+    positions = {str(person): i for i, person in enumerate(persons)}
+    order = np.argsort(owner, kind="stable")
+    offsets = np.searchsorted(owner[order], np.arange(len(persons) + 1))
+
+    def vectors_of(person):
+        if person not in positions:
+            return []
+        position = positions[person]
+        return [
+            (str(ids[row]), values[row], counts[row])
+            for row in order[offsets[position] : offsets[position + 1]]
+        ]
+
+    merged_persons = {person for merge in merges for person in merge["merged"]}
+    users = {}
+    for kind, key, value in read_table_records(work):
+        if kind == "user" and value in merged_persons:
+            users.setdefault(value, set()).add(key)
+
+    index = lf.get_index()
+    table = lf.get_table()
+    if "merge_log_prefix" not in stage:
+        # Merge log items of this run sort after those of earlier runs
+        stage["merge_log_prefix"] = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        work.save()
+    for start in range(stage.get("groups_done", 0), len(merges), args.apply_batch):
+        chunk = merges[start : start + args.apply_batch]
+        upserts, deletes = [], []
+        for merge in chunk:
+            members = [merge["survivor"]] + merge["merged"]
+            upserts += merged_person_vectors(
+                lf, merge["survivor"], [(person, vectors_of(person)) for person in members]
+            )
+            for person in merge["merged"]:
+                deletes += dict.fromkeys(
+                    lf.person_vector_ids(person)
+                    + [vector_id for vector_id, _, _ in vectors_of(person)]
+                )
+
+        for i in range(0, len(upserts), UPSERT_BATCH_SIZE):
+            index.upsert(vectors=upserts[i : i + UPSERT_BATCH_SIZE])
+        for i in range(0, len(deletes), DELETE_BATCH_SIZE):
+            index.delete(ids=deletes[i : i + DELETE_BATCH_SIZE])
+
+        survivors = {person: merge["survivor"] for merge in chunk for person in merge["merged"]}
+        # Warm face_recognition containers evict the merged persons from their
+        # local vector index, and refetch the survivors, when they sync
+        table.put_item(
+            Item={
+                "PK": lf.LocalVectorIndex.MERGE_LOG_PK,
+                "SK": f"{stage['merge_log_prefix']}#{start:08d}",
+                "entityType": "MERGED_PERSONS",
+                "survivors": survivors,
+                "createdAt": int(datetime.now().timestamp()),
+            }
+        )
+        moved = rewrite_items(table, survivors, users, args.concurrency)
+
+        stage["groups_done"] = start + len(chunk)
+        work.save()
+        print(
+            f"Applied {stage['groups_done']}/{len(merges)} merges: "
+            f"{len(deletes)} vector ids deleted, {moved} taggings moved"
+        )
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=COMMANDS, help="Last stage to run")
+    parser.add_argument("--work-dir", required=True, help="Checkpoint directory of this run")
+    parser.add_argument(
+        "--similarity",
+        type=float,
+        help="Minimum cosine similarity of a merge (default: DUPLICATE_SIMILARITY_THRESHOLD)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="Maximum euclidean distance of a merge (default: DUPLICATE_TOLERANCE)",
+    )
+    parser.add_argument(
+        "--lists", type=int, default=0, help="Coarse clusters (default: sqrt of the vector count)"
+    )
+    parser.add_argument(
+        "--probes", type=int, default=4, help="Closest clusters each vector is compared with"
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=4_000_000,
+        help="Pairs per similarity block, bounds the graph stage's memory",
+    )
+    parser.add_argument("--shard-persons", type=int, default=100_000)
+    parser.add_argument("--scan-segments", type=int, default=16)
+    parser.add_argument(
+        "--max-group-size", type=int, default=20, help="Persons per merge, 0 for no limit"
+    )
+    parser.add_argument("--apply-batch", type=int, default=100, help="Merges per checkpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    command = COMMANDS.index(args.command)
+
+    # The lambda logs every Pinecone and DynamoDB step at INFO
+    logging.disable(logging.INFO)
+    lf = load_lambda("face_recognition")
+    if args.similarity is None:
+        args.similarity = lf.config.DUPLICATE_SIMILARITY_THRESHOLD
+    if args.tolerance is None:
+        args.tolerance = lf.config.DUPLICATE_TOLERANCE
+
+    work = WorkDir(args.work_dir)
+    export_vectors(lf, work, args.shard_persons, args.concurrency)
+    export_table(lf, work, args.scan_segments)
+    if command == COMMANDS.index("export"):
+        return
+
+    ids, values, counts = load_vectors(work)
+    if not len(ids):
+        print("No person vectors exported")
+        return
+    persons, owner = np.unique(np.char.partition(ids, "#")[:, 0], return_inverse=True)
+    print(f"{len(ids)} vectors of {len(persons)} persons")
+
+    build_graph(work, values, owner, args)
+    if command == COMMANDS.index("graph"):
+        return
+
+    plan_merges(work, persons, args.max_group_size)
+    if command == COMMANDS.index("plan"):
+        return
+
+    apply_plan(lf, work, ids, values, counts, persons, owner, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Pipeline and recognition backends shared by the face lambdas"""
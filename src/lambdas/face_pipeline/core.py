@@ -0,0 +1,827 @@
+"""
+Pipeline shared by the face lambdas: SQS message parsing, person ID
+reservation, batched DynamoDB writes, crop uploads, profile association,
+tagging, metrics and the handler loop.
+
+Detection, encoding and matching are delegated to a RecognitionBackend, so
+batching, concurrency and write coalescing apply to every backend.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+
+from face_pipeline import tracing
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class PipelineConfig:
+    def __init__(self):
+        # Env resources
+        self.DDB_TABLE_NAME = os.environ["DDB_TABLE_NAME"]
+        self.S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")  # fallback if not in event
+
+        # Persistence
+        self.SAVE_DETECTED_FACES = (
+            os.environ.get("SAVE_DETECTED_FACES", "true").lower() == "true"
+        )
+        self.PERSISTENCE_CONCURRENCY = int(
+            os.environ.get("PERSISTENCE_CONCURRENCY", "8")
+        )  # Parallel crop uploads and original S3 key lookups
+        self.DDB_BATCH_WRITE_MAX_ATTEMPTS = int(
+            os.environ.get("DDB_BATCH_WRITE_MAX_ATTEMPTS", "8")
+        )  # Attempts per BatchWriteItem chunk, including unprocessed-item retries
+
+
+config = PipelineConfig()
+
+
+# Custom exceptions for better error handling
+class FaceRecognitionError(Exception):
+    """Base exception for face recognition errors"""
+
+    pass
+
+
+class PersistenceError(FaceRecognitionError):
+    """Error writing person or tagging records"""
+
+    pass
+
+
+# -------- Clients and resources (created on first use) --------
+
+_resources = {}
+_resource_locks = {}
+
+# Seconds spent initializing each phase, for cold start analysis
+init_timings = {}
+
+# boto3's default session is not thread-safe, so each client gets its own
+# session and the factories can run in parallel
+_resource_factories = {}
+
+
+def register_resource(name, factory):
+    """Add a lazily created client or resource; initialize_resources creates it with the others"""
+    _resource_locks.setdefault(name, threading.Lock())
+    _resource_factories[name] = factory
+
+
+def get_resource(name):
+    """Return a cached client or resource, creating it on first use"""
+    resource = _resources.get(name)
+    if resource is not None:
+        return resource
+
+    with _resource_locks[name]:
+        resource = _resources.get(name)
+        if resource is None:
+            start = time.time()
+            resource = _resource_factories[name]()
+            init_timings[name] = round(time.time() - start, 3)
+            logger.info(f"Initialized {name} in {init_timings[name]:.3f}s")
+            _resources[name] = resource
+    return resource
+
+
+def reset_resource(name):
+    """Drop a cached resource so the next get_resource recreates it"""
+    _resources.pop(name, None)
+
+
+def get_table():
+    return get_resource("table")
+
+
+def get_s3():
+    return get_resource("s3")
+
+
+def initialize_resources():
+    """
+    Create every registered client and resource in parallel, so a cold
+    start costs the slowest phase instead of the sum of all of them.
+    Returns True if anything was initialized by this call.
+    """
+    pending = [name for name in _resource_factories if name not in _resources]
+    if not pending:
+        return False
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        list(executor.map(get_resource, pending))
+    init_timings["total"] = round(time.time() - start, 3)
+    logger.info(f"Initialization timings: {json.dumps(init_timings)}")
+    return True
+
+
+register_resource("dynamodb", lambda: boto3.session.Session().resource("dynamodb"))
+register_resource("table", lambda: get_resource("dynamodb").Table(config.DDB_TABLE_NAME))
+register_resource(
+    "s3",
+    lambda: boto3.session.Session().client(
+        "s3", config=Config(max_pool_connections=max(10, config.PERSISTENCE_CONCURRENCY))
+    ),
+)
+
+
+# -------- Backend interface --------
+
+
+class RecognitionBackend:
+    """
+    Detection and matching half of the pipeline.
+
+    identify() sets job["faces"] to one dict per matched face with the keys
+    found, person_id, confidence, stage and face_size, plus whatever the
+    backend needs later (encodings, crops, FaceIds). Unknown faces get their
+    person_id from the pipeline, and enroll() is called for them after their
+    crop and PERSON record have been stored. An unknown face can name another
+    unknown face of the batch as face["same_person_as"]; it then gets that
+    face's person instead of creating its own.
+    """
+
+    # Used in log and response messages
+    label = "face recognition"
+
+    def identify(self, jobs):
+        """
+        Detect and match the faces of every job. Sets job["faces"] or
+        job["error"], and optionally job["detection_time"],
+        job["encoding_time"], job["matching_time"] (index queries or
+        searches), job["faces_detected"] and job["encodings_generated"].
+        """
+        raise NotImplementedError
+
+    def face_image(self, job, face):
+        """JPEG crop stored as persons/personN.jpg, or None"""
+        return face.get("face_image")
+
+    def enroll(self, job, faces):
+        """Register new persons so later searches find them"""
+        raise NotImplementedError
+
+    def release(self, job):
+        """Drop per-job image data once crops are no longer needed"""
+        pass
+
+    def learn(self, jobs):
+        """
+        Update known persons from the matches of jobs whose items were
+        persisted and whose messages will not be retried, so a redelivered
+        message is never learned twice
+        """
+        pass
+
+    def result_fields(self, job):
+        """Backend-specific fields for the result and metrics"""
+        return {}
+
+    def configuration(self):
+        """Backend settings reported in the response body"""
+        return {}
+
+
+# -------- Messages --------
+
+
+def parse_record(record):
+    """Extract the image processing request from an SQS record"""
+    body = json.loads(record["body"])
+
+    # Check if this is a profile picture processing request
+    is_profile_picture = body.get("isProfilePicture", False)
+    user_email = body.get("userEmail", None)
+
+    # Handle the new message format from thumbnail completion
+    if "largeImageKey" in body:
+        bucket_name = body["bucketName"]
+        object_key = body["largeImageKey"]
+        file_name_without_ext = body["fileNameWithoutExt"]
+        logger.info(f"Processing large image: {bucket_name}/{object_key}")
+    else:
+        bucket_name = body.get("bucketName", config.S3_BUCKET_NAME)
+        object_key = body["objectKey"]
+        file_name_without_ext = object_key.split("/")[-1].split(".")[0]
+        logger.info(
+            f"Processing {'profile picture' if is_profile_picture else 'original image'}: {bucket_name}/{object_key}"
+        )
+
+    if not bucket_name:
+        raise ValueError("bucketName not provided and S3_BUCKET_NAME not set")
+
+    return {
+        "message_id": record.get("messageId"),
+        "bucket_name": bucket_name,
+        "object_key": object_key,
+        "file_name_without_ext": file_name_without_ext,
+        "is_profile_picture": is_profile_picture,
+        "user_email": user_email,
+        "processed_image_type": "large" if "largeImageKey" in body else "original",
+        "start_time": time.time(),
+    }
+
+
+# -------- DynamoDB --------
+
+
+def check_if_unknown_persons_key_available():
+    """Ensure the UNKNOWN_PERSONS counter exists"""
+    table = get_table()
+    try:
+        tracing.record_call("dynamodb", "GetItem")
+        response = table.get_item(
+            Key={"PK": "UNKNOWN_PERSONS", "SK": "UNKNOWN_PERSONS"}
+        )
+
+        if "Item" not in response:
+            table.put_item(
+                Item={
+                    "PK": "UNKNOWN_PERSONS",
+                    "SK": "UNKNOWN_PERSONS",
+                    "entityType": "UNKNOWN_PERSONS",
+                    "limit": 0,
+                }
+            )
+            logger.info("Created UNKNOWN_PERSONS counter")
+    except Exception as e:
+        logger.error(f"Error checking/creating UNKNOWN_PERSONS key: {str(e)}")
+        raise
+
+
+def reserve_person_ids(table, count):
+    """Reserve `count` consecutive person IDs with one atomic counter update"""
+    try:
+        tracing.record_call("dynamodb", "UpdateItem")
+        response = table.update_item(
+            Key={
+                "PK": "UNKNOWN_PERSONS",
+                "SK": "UNKNOWN_PERSONS",
+            },
+            UpdateExpression="SET #attrName = if_not_exists(#attrName, :start) + :val",
+            ExpressionAttributeNames={"#attrName": "limit"},
+            ExpressionAttributeValues={":val": count, ":start": 0},
+            ReturnValues="ALL_NEW",
+        )
+        limit = int(response["Attributes"]["limit"])
+        return list(range(limit - count + 1, limit + 1))
+    except Exception as e:
+        logger.error(f"Error reserving {count} new person IDs: {str(e)}")
+        raise
+
+
+def build_person_item(person_name, s3_key):
+    """DynamoDB item for a new person"""
+    return {
+        "PK": f"PERSON#{person_name}",
+        "SK": person_name,
+        "displayName": person_name,
+        "entityType": "PERSON",
+        "s3Key": s3_key,
+        "createdAt": int(time.time()),
+    }
+
+
+def build_tagging_item(ksuid, person, original_s3_key):
+    """DynamoDB item tagging a person in an image"""
+    return {
+        "PK": ksuid,
+        "SK": f"PERSON#{person}",
+        "entityType": f"TAGGING#{person}",
+        "s3Key": original_s3_key,
+        "createdAt": int(time.time()),
+        "images": {
+            "large": f"processed/{ksuid}_large.webp",
+            "medium": f"processed/{ksuid}_medium.webp",
+        },
+    }
+
+
+class PersistenceBuffer:
+    """
+    Collects the PERSON and TAGGING items of a whole SQS batch and writes
+    them with BatchWriteItem, 25 items per request. Each item remembers the
+    message that produced it, so a failed write only fails those messages.
+    """
+
+    MAX_BATCH_ITEMS = 25
+
+    def __init__(self):
+        # Keyed by (PK, SK): BatchWriteItem rejects duplicate keys in a request
+        self._items = {}
+
+    def put(self, owner, item):
+        self._items[(item["PK"], item["SK"])] = (owner, item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def flush(self):
+        """Write all buffered items. Returns the owners whose items could not be written."""
+        pending = list(self._items.items())
+        self._items = {}
+        failed = set()
+
+        for i in range(0, len(pending), self.MAX_BATCH_ITEMS):
+            chunk = pending[i : i + self.MAX_BATCH_ITEMS]
+            owners = {key: owner for key, (owner, _) in chunk}
+            requests = [{"PutRequest": {"Item": item}} for _, (_, item) in chunk]
+
+            for attempt in range(config.DDB_BATCH_WRITE_MAX_ATTEMPTS):
+                if attempt:
+                    # Exponential backoff with full jitter
+                    time.sleep(random.uniform(0, min(2.0, 0.05 * 2**attempt)))
+                try:
+                    tracing.record_call("dynamodb", "BatchWriteItem")
+                    response = get_resource("dynamodb").batch_write_item(
+                        RequestItems={config.DDB_TABLE_NAME: requests}
+                    )
+                except Exception as e:
+                    logger.warning(f"BatchWriteItem attempt {attempt + 1} failed: {str(e)}")
+                    continue
+                requests = response.get("UnprocessedItems", {}).get(config.DDB_TABLE_NAME, [])
+                if not requests:
+                    break
+
+            for request in requests:
+                item = request["PutRequest"]["Item"]
+                failed.add(owners[(item["PK"], item["SK"])])
+
+        written = len(pending) - sum(owner in failed for _, (owner, _) in pending)
+        logger.info(f"Persisted {written}/{len(pending)} DynamoDB items in batch writes")
+        return failed
+
+
+def get_original_s3_key(ksuid):
+    """Get the original S3 key from the KSUID"""
+    try:
+        tracing.record_call("dynamodb", "Query")
+        response = get_table().query(
+            IndexName="entityType-PK-index",
+            KeyConditionExpression=Key("PK").eq(ksuid) & Key("entityType").eq("IMAGE"),
+        )
+        if "Items" in response and response["Items"]:
+            return response["Items"][0].get("s3Key")
+        else:
+            logger.warning(f"No item found for KSUID: {ksuid}")
+            return None
+
+    except Exception as e:
+        logger.error(f"Error retrieving original S3 key for KSUID {ksuid}: {str(e)}")
+        raise
+
+
+def get_original_s3_keys(ksuids):
+    """
+    Look up original S3 keys for several KSUIDs concurrently. Returns {ksuid: key}.
+
+    IMAGE items are keyed by (KSUID, UPLOADED_BY#<email>) and messages do not
+    carry the uploader, so they cannot be read with BatchGetItem; one GSI query
+    per distinct image runs in parallel instead.
+    """
+    ksuids = list(dict.fromkeys(ksuids))
+    if not ksuids:
+        return {}
+
+    with ThreadPoolExecutor(
+        max_workers=min(config.PERSISTENCE_CONCURRENCY, len(ksuids))
+    ) as executor:
+        return dict(zip(ksuids, executor.map(get_original_s3_key, ksuids)))
+
+
+def associate_profile_picture(user_email, person):
+    """Associate the user with the person detected in their profile picture"""
+    try:
+        # Update the user record to associate with the matched person
+        tracing.record_call("dynamodb", "UpdateItem")
+        get_table().update_item(
+            Key={"PK": user_email, "SK": user_email},
+            UpdateExpression="SET personId = :personId, updatedAt = :updatedAt",
+            ExpressionAttributeValues={
+                ":personId": person,
+                ":updatedAt": datetime.now().isoformat(),
+            },
+        )
+
+        logger.info(f"Associated user {user_email} with person {person}")
+
+    except Exception as e:
+        logger.error(
+            f"Error associating user {user_email} with person {person}: {str(e)}"
+        )
+
+
+# -------- Metrics --------
+
+
+def log_processing_metrics(
+    start_time,
+    faces_detected,
+    encodings_generated,
+    matches_found,
+    detection_time=0,
+    encoding_time=0,
+    extra=None,
+    matching_time=0,
+):
+    """Log detailed processing metrics"""
+    processing_time = time.time() - start_time
+
+    metrics = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "processing_time_seconds": round(processing_time, 2),
+        "detection_time_seconds": round(detection_time, 2),
+        "encoding_time_seconds": round(encoding_time, 2),
+        "matching_time_seconds": round(matching_time, 2),
+        "faces_detected": faces_detected,
+        "encodings_generated": encodings_generated,
+        "matches_found": matches_found,
+        "faces_per_second": round(faces_detected / processing_time, 2)
+        if processing_time > 0
+        else 0,
+        **(extra or {}),
+    }
+
+    logger.info(f"Face recognition metrics: {json.dumps(metrics)}")
+    return metrics
+
+
+# -------- Pipeline --------
+
+
+def store_new_persons(new_faces, backend):
+    """
+    Upload the crops of new persons concurrently, write their PERSON items
+    with one batched write and enroll them with the backend, one call per
+    job. PERSON items are written before enrolling, as the index must not
+    hold a person the table does not: a retried message would match it.
+    """
+
+    def upload(pair):
+        job, face = pair
+        s3_key = f"persons/{face['person_id']}.jpg"
+        if config.SAVE_DETECTED_FACES:
+            face_image = backend.face_image(job, face)
+            if face_image:
+                tracing.record_call("s3", "PutObject", job, sent=len(face_image))
+                with tracing.span("cropUpload", job):
+                    get_s3().put_object(
+                        Bucket=job["bucket_name"],
+                        Key=s3_key,
+                        Body=face_image,
+                        ContentType="image/jpeg",
+                    )
+                logger.info(f"Uploaded face to S3: {s3_key}")
+            else:
+                logger.warning(
+                    f"Face crop not available, using placeholder for S3 key: {s3_key}"
+                )
+        return s3_key
+
+    def try_upload(pair):
+        try:
+            with tracing.bind_job(pair[0]):
+                return upload(pair), None
+        except Exception as e:
+            return None, e
+
+    if not new_faces:
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=min(config.PERSISTENCE_CONCURRENCY, len(new_faces))
+    ) as executor:
+        uploads = list(executor.map(try_upload, new_faces))
+
+    persons = PersistenceBuffer()
+    faces_by_job = {}
+    for (job, face), (s3_key, error) in zip(new_faces, uploads):
+        if error is not None:
+            job.setdefault("error", error)
+            continue
+        persons.put(job["message_id"], build_person_item(face["person_id"], s3_key))
+        faces_by_job.setdefault(id(job), (job, []))[1].append(face)
+
+    with tracing.span("persistPersons"):
+        failed = persons.flush()
+
+    for job, faces in faces_by_job.values():
+        if job["message_id"] in failed:
+            job.setdefault(
+                "error",
+                PersistenceError(f"Could not write PERSON records for {job['object_key']}"),
+            )
+        if "error" in job:
+            continue
+        try:
+            with tracing.bind_job(job), tracing.span("enroll"):
+                backend.enroll(job, faces)
+        except Exception as e:
+            job["error"] = e
+
+
+def build_result(job, backend):
+    """Log metrics and build the per-message result"""
+    faces = job["faces"]
+    face_found = [face["person_id"] for face in faces]
+    matching_details = [
+        {
+            "person": face["person_id"],
+            "confidence": face["confidence"],
+            "stage": face["stage"],
+            "face_size": face.get("face_size", {}),
+        }
+        for face in faces
+        if face["found"]
+    ]
+    faces_detected = job.get("faces_detected", len(faces))
+    encodings_generated = job.get("encodings_generated", faces_detected)
+    detection_time = job.get("detection_time", 0.0)
+    encoding_time = job.get("encoding_time", 0.0)
+    matching_time = job.get("matching_time", 0.0)
+    fields = backend.result_fields(job)
+
+    # Log processing metrics
+    metrics = log_processing_metrics(
+        job["start_time"],
+        faces_detected,
+        encodings_generated,
+        len(face_found),
+        detection_time,
+        encoding_time,
+        fields,
+        matching_time,
+    )
+
+    result = {
+        "object_key": job["object_key"],
+        "persons_found": face_found,
+        "time_taken": metrics["processing_time_seconds"],
+        "detection_time": detection_time,
+        "encoding_time": encoding_time,
+        "matching_time": matching_time,
+        "faces_detected": faces_detected,
+        "encodings_generated": encodings_generated,
+        "matching_details": matching_details,
+        "processed_image_type": job["processed_image_type"],
+        **fields,
+    }
+
+    logger.info(f"Processing completed for {job['object_key']}: {result}")
+    return result
+
+
+def process_jobs(jobs, backend):
+    """
+    Run a batch of jobs through the backend and persist the outcome:
+    one counter update for every new person in the batch, concurrent crop
+    uploads and original key lookups, and batched DynamoDB writes: the
+    PERSON items before their vectors are enrolled, then the TAGGING items.
+    """
+    try:
+        with tracing.span("identify"):
+            backend.identify(jobs)
+    except Exception as e:
+        for job in jobs:
+            job.setdefault("error", e)
+
+    identified = [job for job in jobs if "error" not in job]
+
+    # Reserve IDs for every new person in the batch with one counter update
+    new_faces = [
+        (job, face)
+        for job in identified
+        for face in job["faces"]
+        if not face["found"] and "same_person_as" not in face
+    ]
+    owners = {id(face): job for job, face in new_faces}
+    if new_faces:
+        try:
+            with tracing.span("reserveIds"):
+                person_ids = reserve_person_ids(get_table(), len(new_faces))
+            for (job, face), person_id in zip(new_faces, person_ids):
+                face["person_id"] = f"person{person_id}"
+        except Exception as e:
+            for job, _ in new_faces:
+                job["error"] = e
+            new_faces = []
+
+    buffer = PersistenceBuffer()
+    try:
+        with tracing.span("storeNewPersons"):
+            store_new_persons(new_faces, backend)
+    finally:
+        for job in jobs:
+            backend.release(job)
+
+    # Faces of a new person seen earlier in the batch are tagged with that
+    # person; if creating it failed, their message is retried as well
+    for job in identified:
+        for face in job["faces"]:
+            if face["found"] or "same_person_as" not in face:
+                continue
+            first = face["same_person_as"]
+            first_job = owners.get(
+                id(first), {"error": PersistenceError("New person was not created")}
+            )
+            if not first["found"] and "error" in first_job:
+                job.setdefault("error", first_job["error"])
+                continue
+            face.update(found=True, person_id=first["person_id"])
+
+    # Look up original S3 keys for every tagged image concurrently
+    tagged_jobs = [
+        job
+        for job in jobs
+        if "error" not in job and not job["is_profile_picture"] and job["faces"]
+    ]
+    try:
+        with tracing.span("originalKeys"):
+            original_s3_keys = get_original_s3_keys(
+                [job["file_name_without_ext"] for job in tagged_jobs]
+            )
+    except Exception as e:
+        original_s3_keys = {}
+        for job in tagged_jobs:
+            job["error"] = e
+
+    # Handle profile picture processing vs regular image tagging
+    for job in identified:
+        if "error" in job or not job["faces"]:
+            continue
+        face_found = [face["person_id"] for face in job["faces"]]
+        if job["is_profile_picture"] and job["user_email"]:
+            # For profile pictures, associate the user with the first detected person
+            associate_profile_picture(job["user_email"], face_found[0])
+        elif not job["is_profile_picture"]:
+            kusid = job["file_name_without_ext"]
+            for person in face_found:
+                buffer.put(
+                    job["message_id"],
+                    build_tagging_item(kusid, person, original_s3_keys[kusid]),
+                )
+
+    # Fail the jobs whose items could not be written, so SQS retries them
+    with tracing.span("persist"):
+        failed = buffer.flush()
+    for job in jobs:
+        if job["message_id"] in failed and "error" not in job:
+            job["error"] = PersistenceError(
+                f"Could not write DynamoDB records for {job['object_key']}"
+            )
+
+    # faces_detected counts saved crops, which is 0 without SAVE_DETECTED_FACES
+    for job in jobs:
+        if "error" not in job and job["faces"]:
+            job["result"] = build_result(job, backend)
+
+
+def handle_warmup(backend):
+    """
+    Create every registered client and model now (a no-op in a warm
+    container), so the next batch does not pay for them
+    """
+    start = time.time()
+    cold_start = initialize_resources()
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "message": f"{backend.label.capitalize()} warmed up",
+                "warmup_seconds": round(time.time() - start, 3),
+                "cold_start": cold_start,
+                "init_timings": init_timings if cold_start else {},
+            }
+        ),
+    }
+
+
+def fifo_batch_item_failures(records, failed_message_ids):
+    """
+    batchItemFailures for the failed messages. A FIFO message group must be
+    retried in order from its first failure, so every later message of that
+    group is reported as well, processed or not. Messages of a standard
+    queue have no MessageGroupId and are reported alone.
+    """
+    failed_groups = set()
+    failures = []
+    for record in records:
+        group = record.get("attributes", {}).get("MessageGroupId")
+        if record.get("messageId") in failed_message_ids or (
+            group is not None and group in failed_groups
+        ):
+            failures.append({"itemIdentifier": record.get("messageId")})
+            if group is not None:
+                failed_groups.add(group)
+    return failures
+
+
+def handle_event(event, backend):
+    """Process an SQS event with the given backend and report per-message failures"""
+    logger.info(f"Event: {json.dumps(event)}")
+
+    # Scheduled pings ({"warmup": true}) only prepare the container
+    if event.get("warmup") and "Records" not in event:
+        return handle_warmup(backend)
+
+    records = event.get("Records", [])
+    tracing.start()
+    jobs = []
+    cold_start = False
+
+    try:
+        with tracing.span("init"):
+            cold_start = initialize_resources()
+            check_if_unknown_persons_key_available()
+        results = []
+        failed_message_ids = set()
+
+        for record in records:
+            try:
+                jobs.append(parse_record(record))
+            except Exception as e:
+                logger.error(f"Invalid record {record.get('messageId')}: {str(e)}")
+                results.append(
+                    {
+                        "error": str(e),
+                        "status": "failed",
+                        "error_type": "UnexpectedError",
+                    }
+                )
+                failed_message_ids.add(record.get("messageId"))
+
+        process_jobs(jobs, backend)
+
+        for job in jobs:
+            error = job.get("error")
+            if error is None:
+                if job.get("result"):
+                    results.append(job["result"])
+                continue
+
+            if isinstance(error, FaceRecognitionError):
+                logger.error(f"Face recognition error processing record: {str(error)}")
+                error_type = type(error).__name__
+            else:
+                logger.error(f"Unexpected error processing record: {str(error)}")
+                error_type = "UnexpectedError"
+            results.append(
+                {
+                    "object_key": job["object_key"],
+                    "error": str(error),
+                    "status": "failed",
+                    "error_type": error_type,
+                }
+            )
+            failed_message_ids.add(job["message_id"])
+
+        # Only failed messages, and the FIFO messages queued behind them, are retried
+        batch_item_failures = fifo_batch_item_failures(records, failed_message_ids)
+        retried = {failure["itemIdentifier"] for failure in batch_item_failures}
+        backend.learn([job for job in jobs if job["message_id"] not in retried])
+
+        return {
+            "statusCode": 200,
+            "batchItemFailures": batch_item_failures,
+            "body": json.dumps(
+                {
+                    "message": f"{backend.label.capitalize()} processing completed",
+                    "results": results,
+                    "configuration": backend.configuration(),
+                    "cold_start": cold_start,
+                    "init_timings": init_timings if cold_start else {},
+                }
+            ),
+        }
+
+    except Exception as e:
+        logger.error(f"Handler error: {str(e)}")
+        return {
+            "statusCode": 500,
+            # Nothing in the batch was processed reliably, so retry all of it
+            "batchItemFailures": [
+                {"itemIdentifier": record.get("messageId")} for record in records
+            ],
+            "body": json.dumps(
+                {
+                    "message": f"Error occurred during {backend.label} processing",
+                    "error": str(e),
+                    "error_type": type(e).__name__,
+                }
+            ),
+        }
+
+    finally:
+        tracing.finish(jobs, cold_start)
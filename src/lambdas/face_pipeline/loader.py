@@ -0,0 +1,25 @@
+"""
+Loads a face lambda's lambda_function outside Lambda, for the offline
+tools (face_bench, face_maintenance) that drive its handler or reuse its
+matching code. Run them from src/lambdas.
+"""
+
+import importlib.util
+import sys
+from pathlib import Path
+
+LAMBDAS_DIR = Path(__file__).resolve().parent.parent
+
+
+def load_lambda(name):
+    """Import a lambda's lambda_function under a unique module name"""
+    sys.path.insert(0, str(LAMBDAS_DIR))
+    spec = importlib.util.spec_from_file_location(
+        f"{name}_lambda_function", LAMBDAS_DIR / name / "lambda_function.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    # Registered first, so classes defined in the module (exceptions sent back
+    # by forked detection workers) can be pickled by reference
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,184 @@
+"""
+Cheap no-face pre-filter shared by the face lambdas. A small thumbnail of
+the downloaded image is screened for face candidates. Photos without a
+single one then skip the full-resolution decode, detection and encoding
+(dlib) or the DetectFaces/IndexFaces call (Rekognition).
+
+PREFILTER_METHOD picks the screen. "hog" runs dlib's HOG detector on a
+grayscale thumbnail. "skin" only needs Pillow: it counts skin-toned pixels
+in YCbCr, for lambdas packaged without dlib such as face_rekognition.
+Grayscale images have no skin tones and always pass it.
+
+JPEGs are decoded straight at thumbnail size through libjpeg's DCT
+scaling, so screening costs a fraction of a full decode.
+
+A sampled share of would-be skips (PREFILTER_AUDIT_RATE) still takes the
+full path. Faces found there are counted as PrefilterMisses, so the
+false-negative rate is PrefilterMisses / PrefilterAudits. Both counts are
+emitted next to PrefilterSkips when tracing is on.
+"""
+
+import importlib.util
+import io
+import logging
+import os
+import random
+
+from PIL import Image, ImageChops, ImageOps
+
+from face_pipeline import tracing
+from face_pipeline.core import get_resource, register_resource
+
+logger = logging.getLogger()
+
+
+class PrefilterConfig:
+    def __init__(self):
+        self.ENABLE_FACE_PREFILTER = (
+            os.environ.get("ENABLE_FACE_PREFILTER", "false").lower() == "true"
+        )
+        self.PREFILTER_METHOD = os.environ.get(
+            "PREFILTER_METHOD", "hog"
+        ).lower()  # 'hog' (needs dlib) or 'skin' (Pillow only)
+        self.PREFILTER_MAX_DIMENSION = int(
+            os.environ.get("PREFILTER_MAX_DIMENSION", "800")
+        )  # Long edge of the screened thumbnail
+        self.PREFILTER_UPSAMPLE = int(
+            os.environ.get("PREFILTER_UPSAMPLE", "1")
+        )  # HOG finds faces from 80px, halved per upsample
+        self.PREFILTER_FALLBACK_CONFIDENCE = float(
+            os.environ.get("PREFILTER_FALLBACK_CONFIDENCE", "-0.5")
+        )  # HOG score from which a candidate sends the image down the full path; lower favours recall
+        self.PREFILTER_MIN_SKIN_PIXELS = int(
+            os.environ.get("PREFILTER_MIN_SKIN_PIXELS", "100")
+        )  # Skin-toned thumbnail pixels that make a face candidate (method 'skin')
+        self.PREFILTER_AUDIT_RATE = float(
+            os.environ.get("PREFILTER_AUDIT_RATE", "0.01")
+        )  # Share of would-be skips processed anyway to measure misses
+
+
+config = PrefilterConfig()
+
+# Outcomes of screen()
+PASS = "pass"
+SKIP = "skip"
+AUDIT = "audit"
+
+
+# Skin chroma ranges in YCbCr (Chai & Ngan), which hold across skin tones
+SKIN_CB_RANGE = (77, 127)
+SKIN_CR_RANGE = (133, 173)
+
+# Chroma spread below which a thumbnail counts as grayscale
+GRAYSCALE_CHROMA_SPREAD = 8
+
+
+def _create_detector():
+    import dlib
+
+    return dlib.get_frontal_face_detector()
+
+
+if config.ENABLE_FACE_PREFILTER:
+    if config.PREFILTER_METHOD not in ("hog", "skin"):
+        raise ValueError(
+            f"PREFILTER_METHOD must be 'hog' or 'skin', not {config.PREFILTER_METHOD!r}"
+        )
+    if config.PREFILTER_METHOD == "hog":
+        if importlib.util.find_spec("dlib") is None:
+            raise ValueError(
+                "PREFILTER_METHOD=hog needs dlib, which is not installed. "
+                "Set PREFILTER_METHOD=skin for lambdas without dlib"
+            )
+        register_resource("prefilter_detector", _create_detector)
+
+
+def settings():
+    """Settings that change which images are skipped, or None when disabled"""
+    if not config.ENABLE_FACE_PREFILTER:
+        return None
+    if config.PREFILTER_METHOD == "skin":
+        return ["skin", config.PREFILTER_MAX_DIMENSION, config.PREFILTER_MIN_SKIN_PIXELS]
+    return [
+        config.PREFILTER_MAX_DIMENSION,
+        config.PREFILTER_UPSAMPLE,
+        config.PREFILTER_FALLBACK_CONFIDENCE,
+    ]
+
+
+def load_thumbnail(image_bytes, mode="L"):
+    """Upright thumbnail in `mode` with a long edge of at most PREFILTER_MAX_DIMENSION"""
+    image = Image.open(io.BytesIO(image_bytes))
+    size = (config.PREFILTER_MAX_DIMENSION, config.PREFILTER_MAX_DIMENSION)
+    # JPEGs are decoded directly at 1/2 to 1/8 scale, no smaller than size
+    image.draft("L" if mode == "L" else "YCbCr", size)
+    image = ImageOps.exif_transpose(image).convert(mode)
+    image.thumbnail(size)
+    return image
+
+
+def hog_candidates(image_bytes):
+    """Whether dlib's HOG detector finds a candidate in the grayscale thumbnail"""
+    import numpy as np
+
+    thumbnail = np.asarray(load_thumbnail(image_bytes))
+    candidates, _, _ = get_resource("prefilter_detector").run(
+        thumbnail, config.PREFILTER_UPSAMPLE, config.PREFILTER_FALLBACK_CONFIDENCE
+    )
+    return len(candidates) > 0
+
+
+def skin_candidates(image_bytes):
+    """
+    Whether the thumbnail has PREFILTER_MIN_SKIN_PIXELS skin-toned pixels.
+    Grayscale thumbnails carry no chroma to judge by, so they always pass.
+    """
+    thumbnail = load_thumbnail(image_bytes, "YCbCr")
+    _, cb, cr = thumbnail.split()
+    (cb_low, cb_high), (cr_low, cr_high) = cb.getextrema(), cr.getextrema()
+    if max(cb_high - cb_low, cr_high - cr_low) < GRAYSCALE_CHROMA_SPREAD:
+        return True
+
+    def in_range(channel, low, high):
+        return channel.point(lambda value: 255 if low <= value <= high else 0)
+
+    skin = ImageChops.multiply(in_range(cb, *SKIN_CB_RANGE), in_range(cr, *SKIN_CR_RANGE))
+    return skin.histogram()[255] >= config.PREFILTER_MIN_SKIN_PIXELS
+
+
+def screen(image_bytes):
+    """
+    PASS when the image may contain a face or cannot be screened. SKIP when
+    the thumbnail has no face candidate: no HOG candidate scoring at least
+    PREFILTER_FALLBACK_CONFIDENCE, or fewer than PREFILTER_MIN_SKIN_PIXELS
+    skin-toned pixels. AUDIT for a sampled skip that must still take the
+    full path; report its faces with record_audit().
+    """
+    if not config.ENABLE_FACE_PREFILTER:
+        return PASS
+    has_candidates = skin_candidates if config.PREFILTER_METHOD == "skin" else hog_candidates
+
+    with tracing.span("prefilter"):
+        try:
+            found = has_candidates(image_bytes)
+        except Exception as e:
+            # The full path reports images that cannot be decoded
+            logger.warning(f"Pre-filter could not screen image: {str(e)}")
+            return PASS
+
+    if found:
+        return PASS
+    if random.random() < config.PREFILTER_AUDIT_RATE:
+        tracing.count("PrefilterAudits")
+        logger.info("Pre-filter found no face candidate, auditing with full detection")
+        return AUDIT
+    tracing.count("PrefilterSkips")
+    logger.info("Pre-filter found no face candidate, skipping detection")
+    return SKIP
+
+
+def record_audit(faces_found):
+    """Record what full detection found in an audited image"""
+    if faces_found:
+        tracing.count("PrefilterMisses")
+        logger.warning(f"Pre-filter would have skipped an image with {faces_found} faces")
@@ -0,0 +1,583 @@
+"""
+Amazon Rekognition recognition backend: DetectFaces/IndexFaces for
+detection and SearchFacesByImage/SearchFaces against a collection for
+matching. Used by the face_rekognition lambda and, for low-confidence
+faces, by the hybrid backend of the face_recognition lambda.
+"""
+
+import io
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps
+
+from face_pipeline import prefilter, tracing
+from face_pipeline.core import (
+    RecognitionBackend,
+    get_resource,
+    get_s3,
+    register_resource,
+)
+
+logger = logging.getLogger()
+
+
+class RekognitionConfig:
+    def __init__(self):
+        # Rekognition
+        self.REKOGNITION_COLLECTION_ID = os.environ.get(
+            "REKOGNITION_COLLECTION_ID"
+        )
+        self.REKOGNITION_MATCH_THRESHOLD = float(
+            os.environ.get("REKOGNITION_MATCH_THRESHOLD", "90.0")
+        )
+        self.REKOGNITION_MAX_FACES = int(os.environ.get("REKOGNITION_MAX_FACES", "5"))
+        self.REKOGNITION_CONCURRENCY = int(
+            os.environ.get("REKOGNITION_CONCURRENCY", "5")
+        )  # Faces searched/indexed in parallel per image
+        self.REKOGNITION_MATCHING_MODE = os.environ.get(
+            "REKOGNITION_MATCHING_MODE", "search"
+        )  # 'search' (DetectFaces + SearchFacesByImage per crop) or 'index' (IndexFaces + SearchFaces)
+        self.REKOGNITION_KEEP_MATCHED_FACES = (
+            os.environ.get("REKOGNITION_KEEP_MATCHED_FACES", "false").lower() == "true"
+        )  # index mode: keep matched faces as extra samples of the person
+        self.REKOGNITION_MAX_ATTEMPTS = int(
+            os.environ.get("REKOGNITION_MAX_ATTEMPTS", "10")
+        )  # Per call, with adaptive backoff on throttling
+
+        # Detection input
+        self.ENABLE_S3_OBJECT_DETECTION = (
+            os.environ.get("ENABLE_S3_OBJECT_DETECTION", "true").lower() == "true"
+        )  # JPEG/PNG objects are read by Rekognition straight from S3
+        self.REKOGNITION_MAX_IMAGE_BYTES = int(
+            os.environ.get("REKOGNITION_MAX_IMAGE_BYTES", str(5 * 1024 * 1024))
+        )  # DetectFaces limit for images passed as bytes
+        self.TRANSCODE_MAX_DIMENSION = int(
+            os.environ.get("TRANSCODE_MAX_DIMENSION", "4096")
+        )  # Long edge for images that must be re-encoded
+
+        # Processing
+        self.MAX_FACES_PER_IMAGE = int(os.environ.get("MAX_FACES_PER_IMAGE", "10"))
+        self.FACE_PADDING = int(os.environ.get("FACE_PADDING", "20"))  # pixels
+
+        # Startup
+        self.STARTUP_MODE = os.environ.get(
+            "STARTUP_MODE", "lazy"
+        )  # 'lazy' (first invocation) or 'eager' (container init)
+
+
+config = RekognitionConfig()
+
+# Formats DetectFaces reads natively, by magic bytes and by S3 key extension
+REKOGNITION_FORMATS = {"jpeg": b"\xff\xd8\xff", "png": b"\x89PNG\r\n\x1a\n"}
+REKOGNITION_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# -------- AWS clients (created on first use) --------
+
+
+def _create_rekognition_client():
+    # Adaptive retry mode backs off and rate-limits the client on
+    # ThrottlingException / ProvisionedThroughputExceededException
+    return boto3.session.Session().client(
+        "rekognition",
+        config=Config(
+            retries={"mode": "adaptive", "max_attempts": config.REKOGNITION_MAX_ATTEMPTS},
+            max_pool_connections=max(10, config.REKOGNITION_CONCURRENCY),
+        ),
+    )
+
+
+def get_rekognition():
+    return get_resource("rekognition")
+
+
+# -------- Collection management --------
+
+def ensure_collection_exists(collection_id: str):
+    rekognition = get_rekognition()
+    try:
+        rekognition.describe_collection(CollectionId=collection_id)
+        logger.info(f"Rekognition collection exists: {collection_id}")
+    except ClientError as e:
+        error_code = e.response.get("Error", {}).get("Code")
+        if error_code == "ResourceNotFoundException":
+            logger.info(f"Creating Rekognition collection: {collection_id}")
+            rekognition.create_collection(CollectionId=collection_id)
+        else:
+            logger.error(f"Error describing collection: {str(e)}")
+            raise
+    return True
+
+
+def bytes_from_s3(bucket: str, key: str) -> bytes:
+    with tracing.span("download"):
+        data = get_s3().get_object(Bucket=bucket, Key=key)["Body"].read()
+    tracing.record_call("s3", "GetObject", received=len(data))
+    return data
+
+
+def pil_from_bytes(b: bytes) -> Image.Image:
+    # Rekognition applies EXIF orientation before computing bounding boxes,
+    # so crops must be taken from the upright image
+    with tracing.span("decode"):
+        return ImageOps.exif_transpose(Image.open(io.BytesIO(b))).convert("RGB")
+
+
+def sniff_image_format(b: bytes):
+    """Return 'jpeg' or 'png' when DetectFaces can read the bytes as-is, else None"""
+    for image_format, magic in REKOGNITION_FORMATS.items():
+        if b.startswith(magic):
+            return image_format
+    return None
+
+
+def clamp(n, min_n, max_n):
+    return max(min(n, max_n), min_n)
+
+
+def crop_face(image: Image.Image, bbox: dict, padding_px: int = 0) -> Image.Image:
+    width, height = image.size
+    left = int(bbox["Left"] * width)
+    top = int(bbox["Top"] * height)
+    w = int(bbox["Width"] * width)
+    h = int(bbox["Height"] * height)
+
+    x1 = clamp(left - padding_px, 0, width - 1)
+    y1 = clamp(top - padding_px, 0, height - 1)
+    x2 = clamp(left + w + padding_px, 0, width - 1)
+    y2 = clamp(top + h + padding_px, 0, height - 1)
+
+    return image.crop((x1, y1, x2, y2))
+
+
+def image_to_jpeg_bytes(image: Image.Image) -> bytes:
+    with tracing.span("jpegEncode"):
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=90)
+        return buf.getvalue()
+
+
+def detection_bytes(image_bytes: bytes, pil_image: Image.Image) -> bytes:
+    """
+    Bytes to send to DetectFaces: the original when Rekognition can read it
+    within the byte limit, otherwise a JPEG downscaled until it fits.
+    """
+    if (
+        sniff_image_format(image_bytes)
+        and len(image_bytes) <= config.REKOGNITION_MAX_IMAGE_BYTES
+    ):
+        return image_bytes
+
+    width, height = pil_image.size
+    scale = min(1.0, config.TRANSCODE_MAX_DIMENSION / max(width, height))
+    while True:
+        image = pil_image
+        if scale < 1.0:
+            image = pil_image.resize(
+                (max(1, int(width * scale)), max(1, int(height * scale))),
+                Image.BILINEAR,
+            )
+        jpeg_bytes = image_to_jpeg_bytes(image)
+        if len(jpeg_bytes) <= config.REKOGNITION_MAX_IMAGE_BYTES:
+            # Bounding boxes are ratios, so downscaling does not affect cropping
+            logger.info(
+                f"Transcoded image for detection: {width}x{height} -> {image.size[0]}x{image.size[1]}, "
+                f"{len(jpeg_bytes)} bytes"
+            )
+            return jpeg_bytes
+        scale *= 0.75
+
+
+# -------- Rekognition helpers --------
+
+def detect_faces_with_rekognition(image: dict):
+    """Run DetectFaces on a Rekognition Image parameter (Bytes or S3Object)"""
+    start = time.time()
+    tracing.record_call("rekognition", "DetectFaces", sent=len(image.get("Bytes", b"")))
+    resp = get_rekognition().detect_faces(Image=image, Attributes=[])
+    detection_time = time.time() - start
+    tracing.record_stage("rekognitionDetect", detection_time)
+    faces = resp.get("FaceDetails", [])
+    # Only return bounding boxes
+    bboxes = [f["BoundingBox"] for f in faces][: config.MAX_FACES_PER_IMAGE]
+    return bboxes, detection_time
+
+
+def load_and_detect(bucket: str, key: str, detect=detect_faces_with_rekognition, discard=None):
+    """
+    Download an image for cropping and run `detect` on it, a function taking
+    a Rekognition Image parameter. Returns (pil_image, detect result).
+
+    JPEG/PNG keys are passed to `detect` as an S3Object reference while the
+    download runs. Other formats, objects whose bytes turn out not to be
+    JPEG/PNG, and objects Rekognition rejects fall back to sending bytes.
+    An S3Object detection that is not used is cancelled, or waited for and
+    its result passed to `discard` to undo its side effects.
+
+    With ENABLE_FACE_PREFILTER the download is screened before `detect` is
+    called, and images without a face candidate return (None, ([], 0.0)).
+    """
+    s3_object = config.ENABLE_S3_OBJECT_DETECTION and key.lower().endswith(
+        REKOGNITION_EXTENSIONS
+    )
+    s3_image = {"S3Object": {"Bucket": bucket, "Name": key}}
+    executor = None
+    s3_detection = None
+    s3_detection_used = False
+    if s3_object and not prefilter.config.ENABLE_FACE_PREFILTER:
+        executor = ThreadPoolExecutor(max_workers=1)
+        s3_detection = executor.submit(tracing.propagate(detect), s3_image)
+
+    try:
+        image_bytes = bytes_from_s3(bucket, key)
+        screening = prefilter.screen(image_bytes)
+        if screening == prefilter.SKIP:
+            return None, ([], 0.0)
+        pil_image = pil_from_bytes(image_bytes)
+
+        if s3_object and sniff_image_format(image_bytes):
+            try:
+                if s3_detection is None:
+                    result = detect(s3_image)
+                else:
+                    s3_detection_used = True
+                    result = s3_detection.result()
+                if screening == prefilter.AUDIT:
+                    prefilter.record_audit(len(result[0]))
+                return pil_image, result
+            except ClientError as e:
+                error_code = e.response.get("Error", {}).get("Code")
+                if error_code not in ("InvalidImageFormatException", "ImageTooLargeException"):
+                    raise
+                logger.warning(f"Rekognition rejected S3 object {key} ({error_code}), sending bytes")
+
+        result = detect({"Bytes": detection_bytes(image_bytes, pil_image)})
+        if screening == prefilter.AUDIT:
+            prefilter.record_audit(len(result[0]))
+        return pil_image, result
+    finally:
+        if s3_detection is not None:
+            if not s3_detection_used and not s3_detection.cancel():
+                if s3_detection.exception() is None and discard is not None:
+                    discard(s3_detection.result())
+            executor.shutdown()
+
+
+def person_from_face(face: dict):
+    """
+    personN a collection face belongs to: its UserId (index mode), or its
+    ExternalImageId when it was indexed as personN (search mode)
+    """
+    if face.get("UserId"):
+        return face["UserId"]
+    external_id = face.get("ExternalImageId") or ""
+    return external_id if external_id.startswith("person") else None
+
+
+def top_person_match(matches: list):
+    """First match that resolves to a person, as (person_id, similarity)"""
+    for match in matches:
+        person_id = person_from_face(match.get("Face", {}))
+        if person_id:
+            return person_id, match.get("Similarity", 0.0)
+    return None, 0.0
+
+
+def search_face_by_image(face_bytes: bytes):
+    start = time.time()
+    tracing.record_call("rekognition", "SearchFacesByImage", sent=len(face_bytes))
+    resp = get_rekognition().search_faces_by_image(
+        CollectionId=config.REKOGNITION_COLLECTION_ID,
+        Image={"Bytes": face_bytes},
+        FaceMatchThreshold=config.REKOGNITION_MATCH_THRESHOLD,
+        MaxFaces=config.REKOGNITION_MAX_FACES,
+    )
+    search_time = time.time() - start
+    tracing.record_stage("rekognitionSearch", search_time)
+    person_id, similarity = top_person_match(resp.get("FaceMatches", []))
+    return person_id is not None, person_id, similarity, search_time
+
+
+def search_face_by_id(face_id: str):
+    """Search the collection with an indexed face; no image is uploaded"""
+    start = time.time()
+    tracing.record_call("rekognition", "SearchFaces")
+    resp = get_rekognition().search_faces(
+        CollectionId=config.REKOGNITION_COLLECTION_ID,
+        FaceId=face_id,
+        FaceMatchThreshold=config.REKOGNITION_MATCH_THRESHOLD,
+        MaxFaces=config.REKOGNITION_MAX_FACES,
+    )
+    search_time = time.time() - start
+    tracing.record_stage("rekognitionSearch", search_time)
+    # Faces indexed from the same image have no person yet and are skipped
+    person_id, similarity = top_person_match(resp.get("FaceMatches", []))
+    return person_id is not None, person_id, similarity, search_time
+
+
+def index_whole_image(image: dict, external_image_id: str):
+    """IndexFaces on a whole image. Returns (face records, detection_time)."""
+    start = time.time()
+    tracing.record_call("rekognition", "IndexFaces", sent=len(image.get("Bytes", b"")))
+    resp = get_rekognition().index_faces(
+        CollectionId=config.REKOGNITION_COLLECTION_ID,
+        Image=image,
+        ExternalImageId=external_image_id,
+        DetectionAttributes=[],
+        MaxFaces=config.MAX_FACES_PER_IMAGE,
+        QualityFilter="AUTO",
+    )
+    detection_time = time.time() - start
+    tracing.record_stage("rekognitionDetect", detection_time)
+    unindexed = resp.get("UnindexedFaces", [])
+    if unindexed:
+        logger.info(f"{len(unindexed)} faces not indexed (quality filter or face limit)")
+    return [record["Face"] for record in resp.get("FaceRecords", [])], detection_time
+
+
+def create_person_user(person_name: str):
+    """Create the personN user in the collection; an existing user is fine"""
+    try:
+        tracing.record_call("rekognition", "CreateUser")
+        get_rekognition().create_user(
+            CollectionId=config.REKOGNITION_COLLECTION_ID, UserId=person_name
+        )
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConflictException":
+            raise
+
+
+def associate_face_with_person(face_id: str, person_name: str):
+    """Attach a face to the personN user, creating the user if needed"""
+    def associate():
+        tracing.record_call("rekognition", "AssociateFaces")
+        get_rekognition().associate_faces(
+            CollectionId=config.REKOGNITION_COLLECTION_ID,
+            UserId=person_name,
+            FaceIds=[face_id],
+        )
+    try:
+        associate()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ResourceNotFoundException":
+            raise
+        # Persons enrolled in search mode have no user yet
+        create_person_user(person_name)
+        associate()
+
+
+def delete_face_ids(face_ids):
+    """Remove faces from the collection; failures are logged, not raised"""
+    face_ids = list(face_ids)
+    if not face_ids:
+        return
+    try:
+        tracing.record_call("rekognition", "DeleteFaces")
+        get_rekognition().delete_faces(
+            CollectionId=config.REKOGNITION_COLLECTION_ID, FaceIds=face_ids
+        )
+    except Exception as e:
+        logger.error(f"Could not delete faces {face_ids} from the collection: {str(e)}")
+
+
+def index_face(face_bytes: bytes, external_image_id: str):
+    tracing.record_call("rekognition", "IndexFaces", sent=len(face_bytes))
+    resp = get_rekognition().index_faces(
+        CollectionId=config.REKOGNITION_COLLECTION_ID,
+        Image={"Bytes": face_bytes},
+        ExternalImageId=external_image_id,
+        DetectionAttributes=[],
+        QualityFilter="AUTO",
+    )
+    records = resp.get("FaceRecords", [])
+    if records:
+        logger.info(
+            f"Indexed face for {external_image_id}, FaceId={records[0]['Face']['FaceId']}"
+        )
+
+
+def search_detected_face(pil_image: Image.Image, bbox: dict):
+    """Crop one detected face and search the collection for it"""
+    face_bytes = image_to_jpeg_bytes(crop_face(pil_image, bbox, config.FACE_PADDING))
+    found, person_id, similarity, search_time = search_face_by_image(face_bytes)
+    return {
+        "bbox": bbox,
+        "face_bytes": face_bytes,
+        "found": found and bool(person_id),
+        "person_id": person_id,
+        "confidence": similarity,
+        "stage": "rekognition",
+        "search_time": search_time,
+    }
+
+
+def index_and_search_faces(bucket: str, key: str, ksuid: str):
+    """
+    Index mode: one IndexFaces call on the whole image, then SearchFaces by
+    FaceId for every indexed face. Returns (pil_image, faces, detection_time)
+    with faces shaped like search_detected_face results.
+
+    Faces that match a person are kept as extra samples of that person or
+    removed from the collection, per REKOGNITION_KEEP_MATCHED_FACES. Faces
+    of new persons stay indexed for enroll_face, and every other indexed
+    face, including all of them when a call fails, is removed.
+    """
+    pil_image, (records, detection_time) = load_and_detect(
+        bucket,
+        key,
+        lambda image: index_whole_image(image, ksuid),
+        discard=lambda result: delete_face_ids(record["FaceId"] for record in result[0]),
+    )
+
+    def search(record):
+        found, person_id, similarity, search_time = search_face_by_id(record["FaceId"])
+        return {
+            "bbox": record["BoundingBox"],
+            "face_id": record["FaceId"],
+            "found": found,
+            "person_id": person_id,
+            "confidence": similarity,
+            "stage": "rekognition",
+            "search_time": search_time,
+        }
+
+    def keep(face):
+        associate_face_with_person(face["face_id"], face["person_id"])
+        face["associated"] = True
+
+    faces = []
+    new_faces = []
+    try:
+        faces = map_faces(search, records)
+        matched = [face for face in faces if face["found"]]
+        if matched and config.REKOGNITION_KEEP_MATCHED_FACES:
+            map_faces(keep, matched)
+        new_faces = [face for face in faces if not face["found"]]
+    finally:
+        claimed = {face["face_id"] for face in faces if face.get("associated")}
+        claimed.update(face["face_id"] for face in new_faces)
+        delete_face_ids(
+            record["FaceId"] for record in records if record["FaceId"] not in claimed
+        )
+
+    return pil_image, faces, detection_time
+
+
+def enroll_face(face: dict):
+    """Register a new person's face in the collection as face["person_id"]"""
+    if "face_id" in face:
+        # Already indexed from the whole image, so attach it to a new personN user
+        create_person_user(face["person_id"])
+        associate_face_with_person(face["face_id"], face["person_id"])
+        face["associated"] = True
+    else:
+        # Index in Rekognition with ExternalImageId = personN
+        index_face(face["face_bytes"], face["person_id"])
+
+
+def map_faces(fn, items):
+    """Run per-face work concurrently; results keep the order of `items`"""
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(
+        max_workers=min(config.REKOGNITION_CONCURRENCY, len(items))
+    ) as executor:
+        return list(executor.map(tracing.propagate(fn), items))
+
+
+class RekognitionBackend(RecognitionBackend):
+    """Detection and matching against an Amazon Rekognition collection"""
+
+    label = "face rekognition"
+
+    def __init__(self):
+        register_resource("rekognition", _create_rekognition_client)
+        register_resource(
+            "collection", lambda: ensure_collection_exists(config.REKOGNITION_COLLECTION_ID)
+        )
+
+    def identify(self, jobs):
+        for job in jobs:
+            try:
+                with tracing.bind_job(job):
+                    self.identify_job(job)
+            except Exception as e:
+                job["error"] = e
+
+    def identify_job(self, job):
+        if config.REKOGNITION_MATCHING_MODE == "index":
+            # One image upload; identities resolved by FaceId
+            pil_image, faces, detection_time = index_and_search_faces(
+                job["bucket_name"], job["object_key"], job["file_name_without_ext"]
+            )
+        else:
+            # Load image from S3 for cropping (once) and detect faces
+            pil_image, (bboxes, detection_time) = load_and_detect(
+                job["bucket_name"], job["object_key"]
+            )
+
+            # Crop and search every face concurrently
+            faces = map_faces(lambda bbox: search_detected_face(pil_image, bbox), bboxes)
+
+        if not faces:
+            logger.info("No faces detected in image")
+
+        for face in faces:
+            width, height = pil_image.size
+            face["face_size"] = {
+                "width": int(face["bbox"]["Width"] * width),
+                "height": int(face["bbox"]["Height"] * height),
+            }
+            if face["found"]:
+                logger.info(
+                    f"Found match: {face['person_id']} (similarity: {face['confidence']:.2f})"
+                )
+
+        job["pil_image"] = pil_image
+        job["faces"] = faces
+        job["detection_time"] = detection_time
+        # Rekognition encodes nothing locally; searches are matching time
+        job["encoding_time"] = 0.0
+        job["matching_time"] = sum(face["search_time"] for face in faces)
+
+    def face_image(self, job, face):
+        # Index mode never needed a crop to identify the face, so encode it now
+        if "face_bytes" not in face:
+            face["face_bytes"] = image_to_jpeg_bytes(
+                crop_face(job["pil_image"], face["bbox"], config.FACE_PADDING)
+            )
+        return face["face_bytes"]
+
+    def enroll(self, job, faces):
+        map_faces(enroll_face, faces)
+
+    def release(self, job):
+        job.pop("pil_image", None)
+        # Index mode faces of new persons that were never enrolled
+        delete_face_ids(
+            face["face_id"]
+            for face in job.get("faces", [])
+            if "face_id" in face and not face["found"] and not face.get("associated")
+        )
+
+    def result_fields(self, job):
+        return {
+            "detection_model": "rekognition",
+            "size_filtering_enabled": False,
+            "multi_stage_matching_enabled": False,
+        }
+
+    def configuration(self):
+        return {
+            "rekognition_collection_id": config.REKOGNITION_COLLECTION_ID,
+            "rekognition_match_threshold": config.REKOGNITION_MATCH_THRESHOLD,
+            "rekognition_max_faces": config.REKOGNITION_MAX_FACES,
+            "rekognition_concurrency": config.REKOGNITION_CONCURRENCY,
+            "rekognition_matching_mode": config.REKOGNITION_MATCHING_MODE,
+            "prefilter_enabled": prefilter.config.ENABLE_FACE_PREFILTER,
+        }
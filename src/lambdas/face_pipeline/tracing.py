@@ -0,0 +1,338 @@
+"""
+Per-invocation tracing for the face lambdas: stage timers, external call
+counts, bytes transferred and event counters, emitted as CloudWatch Embedded Metric Format
+(EMF) log lines, one per image and one per invocation.
+
+Disabled unless ENABLE_TRACING=true. While disabled, span() returns a shared
+no-op context manager and the record functions return after one global
+lookup, so instrumented code costs next to nothing.
+
+Measurements are attributed to an image through bind_job() (thread-local)
+or an explicit job argument. Work handed to thread pools keeps its image
+with bound()/propagate().
+"""
+
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+# EMF accepts at most 100 values per metric and 100 metrics per document
+EMF_MAX_VALUES = 100
+EMF_MAX_METRICS = 100
+
+
+class TracingConfig:
+    def __init__(self):
+        self.ENABLE_TRACING = (
+            os.environ.get("ENABLE_TRACING", "false").lower() == "true"
+        )
+        self.METRICS_NAMESPACE = os.environ.get(
+            "METRICS_NAMESPACE", "Sparks/FaceRecognition"
+        )
+        self.FUNCTION_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+
+
+config = TracingConfig()
+
+
+class Trace:
+    """Measurements of one invocation; worker threads record into it concurrently"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = defaultdict(list)
+        self.calls = Counter()
+        self.bytes = Counter()
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def _job_trace(self, job):
+        if "trace" not in job:
+            job["trace"] = {
+                "stages": Counter(),
+                "calls": Counter(),
+                "bytes": Counter(),
+                "counts": Counter(),
+            }
+        return job["trace"]
+
+    def add_stage(self, stage, ms, job=None):
+        with self._lock:
+            self.stages[stage].append(ms)
+            if job is not None:
+                self._job_trace(job)["stages"][stage] += ms
+
+    def add_call(self, name, job=None, sent=0, received=0):
+        with self._lock:
+            self.calls[name] += 1
+            self.bytes["sent"] += sent
+            self.bytes["received"] += received
+            if job is not None:
+                job_trace = self._job_trace(job)
+                job_trace["calls"][name] += 1
+                job_trace["bytes"]["sent"] += sent
+                job_trace["bytes"]["received"] += received
+
+    def add_count(self, name, value, job=None):
+        with self._lock:
+            self.counts[name] += value
+            if job is not None:
+                self._job_trace(job)["counts"][name] += value
+
+    def export(self):
+        """Plain data for sending a worker process's measurements to the parent"""
+        return {
+            "stages": dict(self.stages),
+            "calls": dict(self.calls),
+            "bytes": dict(self.bytes),
+            "counts": dict(self.counts),
+        }
+
+
+# Lambda runs one invocation at a time per execution environment
+_active = None
+_local = threading.local()
+_NO_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("trace", "stage", "job", "started")
+
+    def __init__(self, trace, stage, job):
+        self.trace = trace
+        self.stage = stage
+        self.job = job
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add_stage(
+            self.stage, (time.perf_counter() - self.started) * 1000, self.job
+        )
+        return False
+
+
+def current_job():
+    return getattr(_local, "job", None)
+
+
+def span(stage, job=None):
+    """Time a block as `stage`, attributed to `job` or the bound job"""
+    trace = _active
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, stage, job if job is not None else current_job())
+
+
+def record_stage(stage, seconds, job=None):
+    """Record a duration measured elsewhere, e.g. in a worker process"""
+    trace = _active
+    if trace is None:
+        return
+    trace.add_stage(stage, seconds * 1000, job if job is not None else current_job())
+
+
+def record_call(service, operation, job=None, sent=0, received=0):
+    """Count one external call and the payload bytes it moved"""
+    trace = _active
+    if trace is None:
+        return
+    trace.add_call(
+        f"{service}.{operation}",
+        job if job is not None else current_job(),
+        sent,
+        received,
+    )
+
+
+def count(name, value=1, job=None):
+    """Count an event, e.g. an image skipped by the pre-filter"""
+    trace = _active
+    if trace is None:
+        return
+    trace.add_count(name, value, job if job is not None else current_job())
+
+
+@contextmanager
+def bind_job(job):
+    """Attribute measurements made by this thread to `job`"""
+    if _active is None:
+        yield
+        return
+    previous = current_job()
+    _local.job = job
+    try:
+        yield
+    finally:
+        _local.job = previous
+
+
+def bound(job, fn):
+    """`fn` wrapped to run with `job` bound, for thread pools"""
+    if _active is None or job is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with bind_job(job):
+            return fn(*args, **kwargs)
+
+    return run
+
+
+def propagate(fn):
+    """`fn` wrapped to run with the calling thread's job bound"""
+    return bound(current_job(), fn)
+
+
+@contextmanager
+def capture():
+    """
+    Trace a block in a forked worker process. Yields the worker's Trace (or
+    None when disabled); send trace.export() back and merge() it in the parent.
+    """
+    global _active
+    if not config.ENABLE_TRACING:
+        yield None
+        return
+    previous = _active
+    _active = Trace()
+    try:
+        yield _active
+    finally:
+        _active = previous
+
+
+def merge(exported, job=None):
+    """Add a worker's exported measurements to the invocation (and `job`)"""
+    trace = _active
+    if trace is None or not exported:
+        return
+    for stage, values in exported["stages"].items():
+        for ms in values:
+            trace.add_stage(stage, ms, job)
+    with trace._lock:
+        trace.calls.update(exported["calls"])
+        trace.bytes.update(exported["bytes"])
+        trace.counts.update(exported["counts"])
+        if job is not None:
+            job_trace = trace._job_trace(job)
+            job_trace["calls"].update(exported["calls"])
+            job_trace["bytes"].update(exported["bytes"])
+            job_trace["counts"].update(exported["counts"])
+
+
+def start():
+    """Begin tracing an invocation when enabled"""
+    global _active
+    _active = Trace() if config.ENABLE_TRACING else None
+    return _active
+
+
+def face_count_bucket(faces):
+    if faces <= 1:
+        return str(faces)
+    if faces <= 3:
+        return "2-3"
+    if faces <= 7:
+        return "4-7"
+    return "8+"
+
+
+def image_size_bucket(size_bytes):
+    if size_bytes < 256 * 1024:
+        return "<256KB"
+    if size_bytes < 1024 * 1024:
+        return "256KB-1MB"
+    if size_bytes < 4 * 1024 * 1024:
+        return "1-4MB"
+    return "4MB+"
+
+
+def emf_document(metrics, dimensions, properties):
+    """EMF log line; metrics maps name -> (value or list of values, unit)"""
+    names = list(metrics)[:EMF_MAX_METRICS]
+    document = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": config.METRICS_NAMESPACE,
+                    "Dimensions": [list(dimension_set) for dimension_set in dimensions],
+                    "Metrics": [{"Name": name, "Unit": metrics[name][1]} for name in names],
+                }
+            ],
+        },
+        "Function": config.FUNCTION_NAME,
+        **properties,
+    }
+    for name in names:
+        value = metrics[name][0]
+        document[name] = value[:EMF_MAX_VALUES] if isinstance(value, list) else value
+    return json.dumps(document, default=str)
+
+
+def finish(jobs, cold_start):
+    """Emit the EMF documents of the invocation and stop tracing"""
+    global _active
+    trace = _active
+    _active = None
+    if trace is None:
+        return
+
+    # Printed rather than logged: EMF lines must not carry the logger's prefix
+    for job in jobs:
+        job_trace = job.get("trace")
+        if job_trace is None:
+            continue
+        faces = len(job.get("faces") or [])
+        # Named apart from the invocation metrics, which share the Function dimension
+        metrics = {
+            "ImageTime": ((time.time() - job["start_time"]) * 1000, "Milliseconds"),
+            "Image.Faces": (faces, "Count"),
+            "Image.ExternalCalls": (sum(job_trace["calls"].values()), "Count"),
+            "Image.BytesReceived": (job_trace["bytes"]["received"], "Bytes"),
+            "Image.BytesSent": (job_trace["bytes"]["sent"], "Bytes"),
+        }
+        for stage, ms in job_trace["stages"].items():
+            metrics[f"Image.{stage}Time"] = (ms, "Milliseconds")
+        for name, value in job_trace["counts"].items():
+            metrics[f"Image.{name}"] = (value, "Count")
+        print(
+            emf_document(
+                metrics,
+                [["Function"], ["Function", "FaceCount", "ImageSize"]],
+                {
+                    "FaceCount": face_count_bucket(faces),
+                    "ImageSize": image_size_bucket(job_trace["bytes"]["received"]),
+                    "ColdStart": cold_start,
+                    "objectKey": job["object_key"],
+                    "failed": "error" in job,
+                    "calls": dict(job_trace["calls"]),
+                },
+            ),
+            flush=True,
+        )
+
+    metrics = {
+        "InvocationTime": ((time.perf_counter() - trace.start) * 1000, "Milliseconds"),
+        "Images": (len(jobs), "Count"),
+        "ColdStart": (int(bool(cold_start)), "Count"),
+        "BytesReceived": (trace.bytes["received"], "Bytes"),
+        "BytesSent": (trace.bytes["sent"], "Bytes"),
+    }
+    # Every span of a stage, so CloudWatch can derive percentiles
+    for stage, values in trace.stages.items():
+        metrics[f"{stage}Time"] = (values, "Milliseconds")
+    for name, calls in trace.calls.items():
+        metrics[f"{name}.Calls"] = (calls, "Count")
+    for name, value in trace.counts.items():
+        metrics[name] = (value, "Count")
+    print(
+        emf_document(metrics, [["Function"]], {}),
+        flush=True,
+    )
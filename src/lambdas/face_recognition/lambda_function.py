@@ -1,16 +1,45 @@
 import json
 import boto3
+import hashlib
+import io
 import os
 import time
 import logging
-from datetime import datetime
-
+import multiprocessing
+import multiprocessing.connection
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+
+import numpy as np
 from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps
+
+from face_pipeline import prefilter, tracing
+from face_pipeline.core import (
+    FaceRecognitionError,
+    RecognitionBackend,
+    config as pipeline_config,
+    get_resource,
+    get_s3,
+    get_table,
+    handle_event,
+    handle_warmup,
+    initialize_resources,
+    register_resource,
+    reset_resource,
+)
+from face_pipeline.rekognition import (
+    RekognitionBackend,
+    index_face,
+    map_faces,
+    search_face_by_image,
+)
 
-from pinecone import Pinecone, ServerlessSpec
-
-import cv2
-import face_recognition
+# Imported on first use (see load_vision_libraries) to keep cold starts short
+cv2 = None
 
 # Configure logging
 logger = logging.getLogger()
@@ -27,18 +56,99 @@ class FaceRecognitionConfig:
         self.FACE_RECOGNITION_TOLERANCE = float(
             os.environ.get("FACE_RECOGNITION_TOLERANCE", "0.4")
         )
+        self.RELAXED_SIMILARITY_THRESHOLD = float(
+            os.environ.get("RELAXED_SIMILARITY_THRESHOLD", "0.75")
+        )  # Second matching stage (ENABLE_MULTI_STAGE_MATCHING)
+        self.RELAXED_TOLERANCE = float(os.environ.get("RELAXED_TOLERANCE", "0.6"))
+        self.DUPLICATE_SIMILARITY_THRESHOLD = float(
+            os.environ.get("DUPLICATE_SIMILARITY_THRESHOLD", "0.9")
+        )  # Potential duplicate persons (ENABLE_DUPLICATE_DETECTION)
+        self.DUPLICATE_TOLERANCE = float(os.environ.get("DUPLICATE_TOLERANCE", "0.3"))
         self.MIN_FACE_SIZE = int(os.environ.get("MIN_FACE_SIZE", "50"))
 
         # Face detection settings
         self.FACE_DETECTION_MODEL = os.environ.get(
             "FACE_DETECTION_MODEL", "hog"
-        )  # 'hog' or 'cnn'
+        )  # 'hog', 'cnn' or 'cascade' (HOG pre-pass, CNN on candidate regions)
         self.UPSAMPLE_TIMES = int(
             os.environ.get("UPSAMPLE_TIMES", "1")
         )  # For detecting smaller faces
 
+        # Encoding fidelity presets (see encoding_settings): 'fast', 'balanced' or 'accurate'
+        self.ENCODING_PRESET = os.environ.get(
+            "ENCODING_PRESET", "fast"
+        )  # Event photos
+        self.PROFILE_ENCODING_PRESET = os.environ.get(
+            "PROFILE_ENCODING_PRESET", "accurate"
+        )  # Profile pictures
+        self.ENROLLMENT_ENCODING_PRESET = os.environ.get(
+            "ENROLLMENT_ENCODING_PRESET", "accurate"
+        )  # Vectors stored for new persons, which later faces are matched against
+        self.ACCURATE_NUM_JITTERS = int(
+            os.environ.get("ACCURATE_NUM_JITTERS", "5")
+        )  # Randomly perturbed copies averaged per encoding in 'accurate'
+
+        # Adaptive detection resolution (replaces UPSAMPLE_TIMES when enabled)
+        self.ENABLE_ADAPTIVE_DETECTION = (
+            os.environ.get("ENABLE_ADAPTIVE_DETECTION", "false").lower() == "true"
+        )
+        self.DETECTION_TARGET_LONG_EDGE = int(
+            os.environ.get("DETECTION_TARGET_LONG_EDGE", "1600")
+        )
+        self.MAX_UPSAMPLE_TIMES = int(os.environ.get("MAX_UPSAMPLE_TIMES", "2"))
+
+        # Thumbnail variant detection for original uploads
+        self.ENABLE_VARIANT_DETECTION = (
+            os.environ.get("ENABLE_VARIANT_DETECTION", "false").lower() == "true"
+        )  # Detect on processed/{id}_large.webp when MIN_FACE_SIZE faces stay detectable there
+        self.VARIANT_ENCODING_MIN_FACE_SIZE = int(
+            os.environ.get("VARIANT_ENCODING_MIN_FACE_SIZE", "100")
+        )  # Faces smaller than this in a downscaled variant are encoded from the original
+
+        # Cascade detector settings (FACE_DETECTION_MODEL=cascade)
+        self.CASCADE_HOG_LONG_EDGE = int(
+            os.environ.get("CASCADE_HOG_LONG_EDGE", "1024")
+        )  # Resolution of the HOG pre-pass
+        self.CASCADE_REGION_MARGIN = float(
+            os.environ.get("CASCADE_REGION_MARGIN", "0.5")
+        )  # CNN region around a HOG hit, as a fraction of the box size
+        self.CASCADE_TILE_SIZE = int(os.environ.get("CASCADE_TILE_SIZE", "800"))
+        self.CASCADE_MAX_CNN_TILES = int(
+            os.environ.get("CASCADE_MAX_CNN_TILES", "4")
+        )  # CNN tiles scanned where HOG found nothing
+        self.CASCADE_DETAIL_THRESHOLD = float(
+            os.environ.get("CASCADE_DETAIL_THRESHOLD", "100")
+        )  # Laplacian variance below which a tile is too flat to hold a face
+        self.CASCADE_NMS_IOU = float(os.environ.get("CASCADE_NMS_IOU", "0.3"))
+
         # Performance settings
         self.PINECONE_TOP_K = int(os.environ.get("PINECONE_TOP_K", "5"))
+        self.PINECONE_QUERY_CONCURRENCY = int(
+            os.environ.get("PINECONE_QUERY_CONCURRENCY", "8")
+        )
+        self.DUPLICATE_CHECK_SAMPLE_SIZE = int(
+            os.environ.get("DUPLICATE_CHECK_SAMPLE_SIZE", "10")
+        )
+
+        # Warm-container vector cache in front of Pinecone
+        self.ENABLE_LOCAL_INDEX_CACHE = (
+            os.environ.get("ENABLE_LOCAL_INDEX_CACHE", "false").lower() == "true"
+        )
+        self.LOCAL_INDEX_REFRESH_SECONDS = int(
+            os.environ.get("LOCAL_INDEX_REFRESH_SECONDS", "300")
+        )
+        self.LOCAL_INDEX_MISS_REFRESH_SECONDS = int(
+            os.environ.get("LOCAL_INDEX_MISS_REFRESH_SECONDS", "30")
+        )  # Minimum gap between refreshes triggered by unmatched faces
+        self.LOCAL_INDEX_MAX_VECTORS = int(
+            os.environ.get("LOCAL_INDEX_MAX_VECTORS", "200000")
+        )  # ~100MB of float32 128-d vectors
+        self.LOCAL_INDEX_METRIC = os.environ.get(
+            "LOCAL_INDEX_METRIC", "cosine"
+        )  # 'cosine' or 'euclidean' candidate ranking
+        self.LOCAL_INDEX_FETCH_BATCH_SIZE = int(
+            os.environ.get("LOCAL_INDEX_FETCH_BATCH_SIZE", "100")
+        )
         self.MAX_FACES_PER_IMAGE = int(os.environ.get("MAX_FACES_PER_IMAGE", "10"))
         self.FACE_PADDING = int(os.environ.get("FACE_PADDING", "20"))
 
@@ -56,30 +166,124 @@ class FaceRecognitionConfig:
             os.environ.get("SAVE_DETECTED_FACES", "true").lower() == "true"
         )
 
+        # Batch pipeline settings
+        self.ENABLE_BATCH_PIPELINE = (
+            os.environ.get("ENABLE_BATCH_PIPELINE", "true").lower() == "true"
+        )
+        self.DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "8"))
+        self.DETECTION_WORKERS = int(
+            os.environ.get("DETECTION_WORKERS", "0")
+        )  # 0 = one worker process per available vCPU
+
+        # Recognition backend
+        self.RECOGNITION_BACKEND = os.environ.get(
+            "RECOGNITION_BACKEND", "dlib"
+        )  # 'dlib' or 'hybrid' (dlib first, Rekognition for low-confidence faces)
+        self.VECTOR_INDEX = os.environ.get(
+            "VECTOR_INDEX", "pinecone"
+        )  # 'pinecone' or 'memory' (in-process NumPy index, nothing persisted)
+        self.HYBRID_MIN_CONFIDENCE = float(
+            os.environ.get("HYBRID_MIN_CONFIDENCE", "0.9")
+        )  # dlib matches below this score are checked with Rekognition
+
+        # Multi-sample persons: a running centroid `personN` plus up to this
+        # many sample vectors `personN#k` (0 = one fixed vector per person)
+        self.MAX_PERSON_SAMPLES = int(os.environ.get("MAX_PERSON_SAMPLES", "0"))
+        self.SAMPLE_MIN_CONFIDENCE = float(
+            os.environ.get("SAMPLE_MIN_CONFIDENCE", "0.92")
+        )  # Strict matches scoring at least this refine the person
+        self.SAMPLE_MIN_DISTANCE = float(
+            os.environ.get("SAMPLE_MIN_DISTANCE", "0.2")
+        )  # Faces closer than this to the matched vector add no new sample
+
+        # New persons: unmatched faces of one batch that pass the strict
+        # thresholds against each other, or against a person this container
+        # created recently, become one person
+        self.ENABLE_BATCH_CLUSTERING = (
+            os.environ.get("ENABLE_BATCH_CLUSTERING", "true").lower() == "true"
+        )
+        self.RECENT_PERSONS_SECONDS = int(
+            os.environ.get("RECENT_PERSONS_SECONDS", "300")
+        )  # Covers the delay before Pinecone serves new upserts
+        self.RECENT_PERSONS_MAX = int(os.environ.get("RECENT_PERSONS_MAX", "1000"))
+
+        # Content-hash detection cache (DynamoDB, expired via the table's TTL)
+        self.ENABLE_DETECTION_CACHE = (
+            os.environ.get("ENABLE_DETECTION_CACHE", "false").lower() == "true"
+        )
+        self.DETECTION_CACHE_TTL_SECONDS = int(
+            os.environ.get("DETECTION_CACHE_TTL_SECONDS", "604800")
+        )  # 7 days
+
+        # Startup settings
+        self.STARTUP_MODE = os.environ.get(
+            "STARTUP_MODE", "lazy"
+        )  # 'lazy' (first invocation) or 'eager' (container init)
+        self.PINECONE_API_KEY_TTL_SECONDS = int(
+            os.environ.get("PINECONE_API_KEY_TTL_SECONDS", "3600")
+        )
+        self.ENABLE_MODEL_WARMUP = (
+            os.environ.get("ENABLE_MODEL_WARMUP", "true").lower() == "true"
+        )  # Run a dummy inference when the models load
+
 
 # Initialize configuration
 config = FaceRecognitionConfig()
 
-# Output folder for temporary face crops
-output_folder = "/tmp/detected_faces"
+
+def encoding_settings(preset):
+    """
+    (landmark model, num_jitters) of an encoding preset. 'small' is dlib's
+    5-point shape predictor, 'large' the 68-point one; num_jitters=1 encodes
+    the face once, unperturbed. Unknown presets fall back to 'fast'.
+    """
+    presets = {
+        "fast": ("small", 1),
+        "balanced": ("large", 1),
+        "accurate": ("large", config.ACCURATE_NUM_JITTERS),
+    }
+    return presets.get(preset, presets["fast"])
+
+
+def job_encoding_preset(job):
+    """Profile pictures become reference encodings, so they get their own preset"""
+    if job["is_profile_picture"]:
+        return config.PROFILE_ENCODING_PRESET
+    return config.ENCODING_PRESET
+
+
+# Approximate smallest face (pixels) dlib's HOG and CNN detectors find without
+# upsampling; each upsample halves it
+DETECTOR_MIN_FACE_SIZE = 80
+
+# image_thumbnail_generation fits the large variant inside 1920x1920 without enlarging
+LARGE_VARIANT_LONG_EDGE = 1920
+
+# Ranged read of an original that reaches its frame header: JPEG EXIF segments
+# are at most 64KB
+ORIGINAL_HEADER_BYTES = 65536
+
+if config.ENABLE_VARIANT_DETECTION and not config.ENABLE_ADAPTIVE_DETECTION:
+    # Without MAX_UPSAMPLE_TIMES, variants of large originals lose MIN_FACE_SIZE faces
+    variant_original_limit = int(
+        LARGE_VARIANT_LONG_EDGE
+        * config.MIN_FACE_SIZE
+        * 2**config.UPSAMPLE_TIMES
+        / DETECTOR_MIN_FACE_SIZE
+    )
+    logger.warning(
+        "ENABLE_VARIANT_DETECTION without ENABLE_ADAPTIVE_DETECTION: originals with a "
+        f"long edge over {variant_original_limit}px are still detected on the original"
+    )
 
 # Environment variables
-pinecone_index_name = os.environ["PINECONE_INDEX_NAME"]
+pinecone_index_name = os.environ.get("PINECONE_INDEX_NAME")
 pinecone_ssm_parameter_name = os.environ.get(
     "PINECONE_SSM_PARAMETER_NAME", "/pinecone/sparks"
 )
 
-# Initialize SSM client
-ssm_client = boto3.client("ssm")
-
 
 # Custom exceptions for better error handling
-class FaceRecognitionError(Exception):
-    """Base exception for face recognition errors"""
-
-    pass
-
-
 class FaceDetectionError(FaceRecognitionError):
     """Error in face detection phase"""
 
@@ -98,13 +302,27 @@ class PersonMatchingError(FaceRecognitionError):
     pass
 
 
+# Clients and resources are created on first use and cached for the container
+_pinecone_api_key_cache = {"value": None, "expires_at": 0.0}
+
+
 def get_pinecone_api_key():
-    """Retrieve Pinecone API key from SSM Parameter Store"""
+    """Retrieve Pinecone API key from SSM Parameter Store, cached for PINECONE_API_KEY_TTL_SECONDS"""
+    if (
+        _pinecone_api_key_cache["value"] is not None
+        and time.time() < _pinecone_api_key_cache["expires_at"]
+    ):
+        return _pinecone_api_key_cache["value"]
+
     try:
-        response = ssm_client.get_parameter(
+        response = get_resource("ssm").get_parameter(
             Name=pinecone_ssm_parameter_name, WithDecryption=True
         )
-        return response["Parameter"]["Value"]
+        _pinecone_api_key_cache["value"] = response["Parameter"]["Value"]
+        _pinecone_api_key_cache["expires_at"] = (
+            time.time() + config.PINECONE_API_KEY_TTL_SECONDS
+        )
+        return _pinecone_api_key_cache["value"]
     except Exception as e:
         logger.error(
             f"Error retrieving Pinecone API key from SSM parameter '{pinecone_ssm_parameter_name}': {str(e)}"
@@ -112,88 +330,438 @@ def get_pinecone_api_key():
         raise
 
 
-# Get Pinecone API key from SSM
-pinecone_api_key = get_pinecone_api_key()
-
-# Setup Pinecone with latest SDK
-pc = Pinecone(api_key=pinecone_api_key)
-
-# Get or create index
-try:
-    index = pc.Index(pinecone_index_name)
-except Exception as e:
-    logger.info(f"Index {pinecone_index_name} not found, creating it...")
-    pc.create_index(
-        name=pinecone_index_name,
-        dimension=128,  # face_recognition encoding dimension
-        metric="cosine",
-        spec=ServerlessSpec(
-            cloud="aws",
-            region="us-east-1",  # Adjust based on your region
+def _create_pinecone_index():
+    from pinecone import Pinecone, ServerlessSpec
+
+    # Setup Pinecone with latest SDK
+    pc = Pinecone(api_key=get_pinecone_api_key())
+
+    # Get or create index
+    try:
+        return pc.Index(pinecone_index_name)
+    except Exception as e:
+        logger.info(f"Index {pinecone_index_name} not found, creating it...")
+        pc.create_index(
+            name=pinecone_index_name,
+            dimension=128,  # face_recognition encoding dimension
+            metric="cosine",
+            spec=ServerlessSpec(
+                cloud="aws",
+                region="us-east-1",  # Adjust based on your region
+            ),
+        )
+        return pc.Index(pinecone_index_name)
+
+
+def _load_vision_libraries():
+    global cv2
+    import cv2
+
+    return True
+
+
+class DlibModels:
+    """
+    The dlib detectors, shape predictors and encoder, each loaded on first
+    use and kept for the life of the container.
+
+    Importing face_recognition loads every model it ships, including the
+    100MB 68-point predictor and the CNN detector, whether the configuration
+    uses them or not. The models are loaded here straight from
+    face_recognition_models instead, with face_recognition's box and
+    encoding semantics.
+    """
+
+    def __init__(self):
+        import dlib
+        import face_recognition_models
+
+        self._dlib = dlib
+        self._paths = {
+            "cnn": face_recognition_models.cnn_face_detector_model_location,
+            "small": face_recognition_models.pose_predictor_five_point_model_location,
+            "large": face_recognition_models.pose_predictor_model_location,
+            "encoder": face_recognition_models.face_recognition_model_location,
+        }
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._lock:
+            if name not in self._models:
+                start = time.time()
+                if name == "hog":
+                    model = self._dlib.get_frontal_face_detector()
+                elif name == "cnn":
+                    model = self._dlib.cnn_face_detection_model_v1(self._paths["cnn"]())
+                elif name == "encoder":
+                    model = self._dlib.face_recognition_model_v1(self._paths["encoder"]())
+                else:
+                    model = self._dlib.shape_predictor(self._paths[name]())
+                self._models[name] = model
+                logger.info(f"Loaded dlib {name} model in {time.time() - start:.3f}s")
+        return self._models[name]
+
+    def face_locations(self, image, model="hog", number_of_times_to_upsample=1):
+        """Face boxes as (top, right, bottom, left), clipped to the image"""
+        if model == "cnn":
+            rects = [
+                detection.rect
+                for detection in self._get("cnn")(image, number_of_times_to_upsample)
+            ]
+        else:
+            rects = self._get("hog")(image, number_of_times_to_upsample)
+        height, width = image.shape[:2]
+        return [
+            (
+                max(rect.top(), 0),
+                min(rect.right(), width),
+                min(rect.bottom(), height),
+                max(rect.left(), 0),
+            )
+            for rect in rects
+        ]
+
+    def face_encodings(self, image, face_locations, num_jitters=1, model="small"):
+        """128-d encodings of the faces at `face_locations`"""
+        predictor = self._get(model)
+        encoder = self._get("encoder")
+        encodings = []
+        for top, right, bottom, left in face_locations:
+            shape = predictor(image, self._dlib.rectangle(left, top, right, bottom))
+            encodings.append(np.array(encoder.compute_face_descriptor(image, shape, num_jitters)))
+        return encodings
+
+    def required(self):
+        """Names of the models the current configuration uses"""
+        detectors = {"hog": ["hog"], "cnn": ["cnn"], "cascade": ["hog", "cnn"]}
+        landmark_models = {
+            encoding_settings(preset)[0]
+            for preset in (
+                config.ENCODING_PRESET,
+                config.PROFILE_ENCODING_PRESET,
+                config.ENROLLMENT_ENCODING_PRESET,
+            )
+        }
+        return (
+            detectors.get(config.FACE_DETECTION_MODEL, ["hog"])
+            + sorted(landmark_models)
+            + ["encoder"]
+        )
+
+    def warm_up(self):
+        """
+        Load the configured models and run them once on a blank image, so
+        the first real image does not pay for dlib's lazy allocations
+        """
+        start = time.time()
+        for name in self.required():
+            self._get(name)
+        if config.ENABLE_MODEL_WARMUP:
+            image = np.zeros((160, 160, 3), dtype=np.uint8)
+            for name in self.required():
+                if name in ("hog", "cnn"):
+                    self.face_locations(image, model=name)
+                elif name != "encoder":
+                    self.face_encodings(image, [(20, 140, 140, 20)], model=name)
+        logger.info(f"Vision models ready in {time.time() - start:.3f}s")
+        return self
+
+
+# boto3's default session is not thread-safe, so each client gets its own
+# session and the factories can run in parallel
+if config.VECTOR_INDEX == "memory":
+    register_resource(
+        "memory_index", lambda: InMemoryIndex(config.LOCAL_INDEX_MAX_VECTORS)
+    )
+else:
+    register_resource("ssm", lambda: boto3.session.Session().client("ssm"))
+    register_resource("pinecone_index", _create_pinecone_index)
+register_resource("vision_libraries", _load_vision_libraries)
+register_resource("vision_models", lambda: DlibModels().warm_up())
+
+
+def get_index():
+    """Pinecone index, reconnected when the API key in SSM has been rotated"""
+    if config.VECTOR_INDEX == "memory":
+        return get_resource("memory_index")
+
+    index = get_resource("pinecone_index")
+    if time.time() >= _pinecone_api_key_cache["expires_at"]:
+        api_key_in_use = _pinecone_api_key_cache["value"]
+        if get_pinecone_api_key() != api_key_in_use:
+            logger.info("Pinecone API key changed in SSM, reconnecting")
+            reset_resource("pinecone_index")
+            index = get_resource("pinecone_index")
+    return index
+
+
+def load_vision_libraries():
+    """Import cv2 once"""
+    get_resource("vision_libraries")
+
+
+def get_models():
+    """The warmed-up dlib models"""
+    return get_resource("vision_models")
+
+
+def decode_image(image_bytes):
+    """Decode encoded image bytes (JPEG, PNG, WEBP, ...) to an RGB array in memory"""
+    load_vision_libraries()
+    with tracing.span("decode"):
+        image_bgr = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image_bgr is None:
+            return None
+        return cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+
+
+def encode_face_crop(face_crop):
+    """Encode an RGB face crop to in-memory JPEG bytes"""
+    with tracing.span("jpegEncode"):
+        # Convert RGB to BGR for OpenCV encoding
+        face_bgr = cv2.cvtColor(face_crop, cv2.COLOR_RGB2BGR)
+        success, buffer = cv2.imencode(".jpg", face_bgr)
+        return buffer.tobytes() if success else None
+
+
+def crop_face_image(image, location):
+    """Crop a face with FACE_PADDING around it and return it as JPEG bytes"""
+    top, right, bottom, left = location
+
+    # Add padding around the face
+    padding = config.FACE_PADDING
+    img_height, img_width = image.shape[:2]
+
+    top_padded = max(0, top - padding)
+    right_padded = min(img_width, right + padding)
+    bottom_padded = min(img_height, bottom + padding)
+    left_padded = max(0, left - padding)
+
+    # Crop face with padding
+    face_crop = image[top_padded:bottom_padded, left_padded:right_padded]
+    return encode_face_crop(face_crop)
+
+
+def choose_detection_scale(image_shape, min_face_size=None):
+    """
+    Pick (scale, upsample_times) for detecting faces in an image.
+
+    Large images are detected on a copy downscaled to DETECTION_TARGET_LONG_EDGE.
+    Upsampling is then chosen per image, just high enough that a face of
+    min_face_size pixels (MIN_FACE_SIZE by default) at full resolution still
+    reaches the detector's minimum size; if MAX_UPSAMPLE_TIMES is not enough,
+    less downscaling is used.
+    """
+    if not config.ENABLE_ADAPTIVE_DETECTION:
+        return 1.0, config.UPSAMPLE_TIMES
+
+    long_edge = max(image_shape[:2])
+    scale = min(1.0, config.DETECTION_TARGET_LONG_EDGE / long_edge)
+
+    # Magnification a MIN_FACE_SIZE face needs to be detectable
+    required = DETECTOR_MIN_FACE_SIZE / (min_face_size or config.MIN_FACE_SIZE)
+
+    for upsample_times in range(config.MAX_UPSAMPLE_TIMES + 1):
+        if scale * 2**upsample_times >= required:
+            return scale, upsample_times
+
+    return (
+        min(1.0, required / 2**config.MAX_UPSAMPLE_TIMES),
+        config.MAX_UPSAMPLE_TIMES,
+    )
+
+
+def remap_face_locations(face_locations, scale, image_shape):
+    """Map (top, right, bottom, left) boxes from a scaled image back to full resolution"""
+    if scale == 1.0:
+        return face_locations
+
+    img_height, img_width = image_shape[:2]
+    return [
+        (
+            max(0, int(round(top / scale))),
+            min(img_width, int(round(right / scale))),
+            min(img_height, int(round(bottom / scale))),
+            max(0, int(round(left / scale))),
+        )
+        for top, right, bottom, left in face_locations
+    ]
+
+
+def resize_image(image, scale):
+    """Resize an image by a factor, using area interpolation when shrinking"""
+    img_height, img_width = image.shape[:2]
+    return cv2.resize(
+        image,
+        (max(1, int(round(img_width * scale))), max(1, int(round(img_height * scale)))),
+        interpolation=cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR,
+    )
+
+
+def box_iou(box_a, box_b):
+    """Intersection over union of two (top, right, bottom, left) boxes"""
+    top = max(box_a[0], box_b[0])
+    right = min(box_a[1], box_b[1])
+    bottom = min(box_a[2], box_b[2])
+    left = max(box_a[3], box_b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    if intersection == 0:
+        return 0.0
+    area_a = (box_a[1] - box_a[3]) * (box_a[2] - box_a[0])
+    area_b = (box_b[1] - box_b[3]) * (box_b[2] - box_b[0])
+    return intersection / float(area_a + area_b - intersection)
+
+
+def non_max_suppression(boxes, iou_threshold):
+    """Drop boxes overlapping an earlier (higher priority) box by more than iou_threshold"""
+    kept = []
+    for box in boxes:
+        if all(box_iou(box, other) <= iou_threshold for other in kept):
+            kept.append(box)
+    return kept
+
+
+def cnn_face_locations(image, top, right, bottom, left, upsample_times):
+    """Run the CNN detector on one region and return boxes in image coordinates"""
+    region = np.ascontiguousarray(image[top:bottom, left:right])
+    return [
+        (t + top, r + left, b + top, l + left)
+        for t, r, b, l in get_models().face_locations(
+            region, model="cnn", number_of_times_to_upsample=upsample_times
+        )
+    ]
+
+
+def cascade_face_locations(image, upsample_times):
+    """
+    Two-tier detection: a fast HOG pass on a reduced image, then the CNN
+    detector only on the regions around HOG hits and on the most detailed
+    tiles where HOG found nothing. Results are merged with NMS, preferring
+    the tighter CNN boxes.
+    """
+    img_height, img_width = image.shape[:2]
+
+    # Tier 1: HOG on a reduced copy
+    hog_scale = min(1.0, config.CASCADE_HOG_LONG_EDGE / max(img_height, img_width))
+    hog_image = resize_image(image, hog_scale) if hog_scale < 1.0 else image
+    hog_boxes = remap_face_locations(
+        get_models().face_locations(
+            hog_image, model="hog", number_of_times_to_upsample=upsample_times
         ),
+        hog_scale,
+        image.shape,
     )
-    index = pc.Index(pinecone_index_name)
 
-# DynamoDB setup
-dynamodb = boto3.resource("dynamodb")
-table_name = os.environ["DDB_TABLE_NAME"]
-table = dynamodb.Table(table_name)
+    # Tier 2a: CNN around each HOG hit
+    cnn_boxes = []
+    regions = []
+    for top, right, bottom, left in hog_boxes:
+        margin_y = int((bottom - top) * config.CASCADE_REGION_MARGIN)
+        margin_x = int((right - left) * config.CASCADE_REGION_MARGIN)
+        region = (
+            max(0, top - margin_y),
+            min(img_width, right + margin_x),
+            min(img_height, bottom + margin_y),
+            max(0, left - margin_x),
+        )
+        regions.append(region)
+        cnn_boxes.extend(cnn_face_locations(image, *region, upsample_times))
+
+    # Tier 2b: CNN on the most detailed tiles not covered by a HOG region
+    tile_size = config.CASCADE_TILE_SIZE
+    stride = max(1, tile_size * 3 // 4)  # Overlap so faces on tile edges are seen whole
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    tiles = []
+    for top in range(0, max(1, img_height - tile_size + stride), stride):
+        for left in range(0, max(1, img_width - tile_size + stride), stride):
+            tile = (
+                top,
+                min(img_width, left + tile_size),
+                min(img_height, top + tile_size),
+                left,
+            )
+            if any(box_iou(tile, region) > 0 for region in regions):
+                continue
+            detail = cv2.Laplacian(
+                gray[tile[0] : tile[2], tile[3] : tile[1]], cv2.CV_64F
+            ).var()
+            if detail >= config.CASCADE_DETAIL_THRESHOLD:
+                tiles.append((detail, tile))
 
-# S3 setup
-s3 = boto3.client("s3")
-bucket_name = os.environ["S3_BUCKET_NAME"]
+    tiles.sort(key=lambda item: item[0], reverse=True)
+    scanned_tiles = [tile for _, tile in tiles[: config.CASCADE_MAX_CNN_TILES]]
+    for tile in scanned_tiles:
+        cnn_boxes.extend(cnn_face_locations(image, *tile, upsample_times))
 
+    face_locations = non_max_suppression(cnn_boxes + hog_boxes, config.CASCADE_NMS_IOU)
 
-def log_processing_metrics(
-    start_time,
-    faces_detected,
-    encodings_generated,
-    matches_found,
-    detection_time=0,
-    encoding_time=0,
-):
-    """Log detailed processing metrics"""
-    processing_time = time.time() - start_time
-
-    metrics = {
-        "timestamp": datetime.utcnow().isoformat(),
-        "processing_time_seconds": round(processing_time, 2),
-        "detection_time_seconds": round(detection_time, 2),
-        "encoding_time_seconds": round(encoding_time, 2),
-        "faces_detected": faces_detected,
-        "encodings_generated": encodings_generated,
-        "matches_found": matches_found,
-        "faces_per_second": round(faces_detected / processing_time, 2)
-        if processing_time > 0
-        else 0,
-        "detection_model": config.FACE_DETECTION_MODEL,
-        "size_filtering_enabled": config.ENABLE_SIZE_FILTERING,
-        "multi_stage_matching_enabled": config.ENABLE_MULTI_STAGE_MATCHING,
-    }
+    logger.info(
+        f"Cascade detection: {len(hog_boxes)} HOG hits, {len(regions)} CNN regions, "
+        f"{len(scanned_tiles)}/{len(tiles)} detailed tiles scanned, "
+        f"{len(face_locations)} faces after NMS"
+    )
+    return face_locations
+
+
+def detect_face_locations(image, min_face_size=None):
+    """Detect faces, possibly on a downscaled copy, returning full-resolution boxes"""
+    scale, upsample_times = choose_detection_scale(image.shape, min_face_size)
 
-    logger.info(f"Face recognition metrics: {json.dumps(metrics)}")
-    return metrics
+    detection_image = resize_image(image, scale) if scale < 1.0 else image
 
+    with tracing.span("detect"):
+        if config.FACE_DETECTION_MODEL == "cascade":
+            face_locations = cascade_face_locations(detection_image, upsample_times)
+        else:
+            # Detect face locations with dlib
+            face_locations = get_models().face_locations(
+                detection_image,
+                model=config.FACE_DETECTION_MODEL,  # 'hog' (fast) or 'cnn' (accurate)
+                number_of_times_to_upsample=upsample_times,
+            )
 
-def detect_and_encode_faces_unified(image_path, output_folder):
+    if config.ENABLE_ADAPTIVE_DETECTION:
+        logger.info(
+            f"Detection on {detection_image.shape[1]}x{detection_image.shape[0]} "
+            f"(scale {scale:.3f}, upsample {upsample_times}) for "
+            f"{image.shape[1]}x{image.shape[0]} image"
+        )
+
+    return remap_face_locations(face_locations, scale, image.shape)
+
+
+def detect_and_encode_faces_unified(image_bytes, preset=None, variant_scale=1.0):
     """
-    Unified face detection and encoding using face_recognition library
-    Replaces the previous MTCNN + face_recognition approach
+    Unified face detection and encoding with dlib's face_recognition models
+    Replaces the previous MTCNN + face_recognition approach.
+    Works entirely in memory: face crops are returned as JPEG bytes.
+    Encodings use the given preset, ENCODING_PRESET by default.
+
+    For a thumbnail variant, variant_scale is its size relative to the
+    original. MIN_FACE_SIZE and the reported sizes then refer to the
+    original, and faces that need its pixels are left with an encoding of
+    None for encode_from_original().
     """
     try:
         detection_start = time.time()
 
-        # Load image using face_recognition
-        image = face_recognition.load_image_file(image_path)
+        # Images without a face candidate in a thumbnail stop here
+        screening = prefilter.screen(image_bytes)
+        if screening == prefilter.SKIP:
+            return [], [], time.time() - detection_start, 0
+
+        # Decode the S3 object bytes directly, no /tmp round trip
+        image = decode_image(image_bytes)
         if image is None:
-            raise FaceDetectionError(f"Could not load image from {image_path}")
+            raise FaceDetectionError("Could not decode image bytes")
 
-        # Detect face locations using face_recognition
-        face_locations = face_recognition.face_locations(
-            image,
-            model=config.FACE_DETECTION_MODEL,  # 'hog' (fast) or 'cnn' (accurate)
-            number_of_times_to_upsample=config.UPSAMPLE_TIMES,
-        )
+        # Boxes are always in full-resolution coordinates, so crops and
+        # encodings below use the original pixels
+        face_locations = detect_face_locations(image, config.MIN_FACE_SIZE * variant_scale)
 
         detection_time = time.time() - detection_start
 
@@ -205,27 +773,19 @@ def detect_and_encode_faces_unified(image_path, output_folder):
             f"Detected {len(face_locations)} faces using {config.FACE_DETECTION_MODEL} model"
         )
 
-        # Create output directory for face crops
-        if config.SAVE_DETECTED_FACES:
-            os.makedirs(output_folder, exist_ok=True)
-
-            # Clean output folder
-            for filename in os.listdir(output_folder):
-                file_path = os.path.join(output_folder, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-
         # Filter faces by size if enabled
         filtered_locations = []
+        face_images = []
         detected_faces = []
 
         for i, (top, right, bottom, left) in enumerate(face_locations):
             width = right - left
             height = bottom - top
 
-            # Size filtering
+            # Size filtering, at the original's scale
             if config.ENABLE_SIZE_FILTERING:
-                if width < config.MIN_FACE_SIZE or height < config.MIN_FACE_SIZE:
+                min_size = config.MIN_FACE_SIZE * variant_scale
+                if width < min_size or height < min_size:
                     logger.info(
                         f"Skipping face {i + 1} due to small size: {width}x{height}"
                     )
@@ -233,32 +793,21 @@ def detect_and_encode_faces_unified(image_path, output_folder):
 
             filtered_locations.append((top, right, bottom, left))
 
-            # Save face crop if enabled
-            if config.SAVE_DETECTED_FACES:
-                # Add padding around the face
-                padding = config.FACE_PADDING
-                img_height, img_width = image.shape[:2]
-
-                top_padded = max(0, top - padding)
-                right_padded = min(img_width, right + padding)
-                bottom_padded = min(img_height, bottom + padding)
-                left_padded = max(0, left - padding)
-
-                # Crop face with padding
-                face_crop = image[top_padded:bottom_padded, left_padded:right_padded]
-
-                # Convert RGB to BGR for OpenCV saving
-                face_bgr = cv2.cvtColor(face_crop, cv2.COLOR_RGB2BGR)
-                face_filename = os.path.join(output_folder, f"face_{i + 1}.jpg")
-
-                success = cv2.imwrite(face_filename, face_bgr)
-                if success:
-                    detected_faces.append(face_filename)
+            # Keep an in-memory face crop if enabled; faces encoded from the
+            # original are cropped from it too
+            face_image = None
+            if config.SAVE_DETECTED_FACES and not needs_original_pixels(
+                (top, right, bottom, left), variant_scale
+            ):
+                face_image = crop_face_image(image, (top, right, bottom, left))
+                if face_image is not None:
+                    detected_faces.append(face_image)
                     logger.info(
-                        f"Saved face {i + 1} to {face_filename} (size: {width}x{height})"
+                        f"Encoded face {i + 1} crop to JPEG (size: {width}x{height})"
                     )
                 else:
-                    logger.warning(f"Failed to save face {i + 1}")
+                    logger.warning(f"Failed to encode face {i + 1} crop")
+            face_images.append(face_image)
 
             # Limit number of faces processed per image
             if len(filtered_locations) >= config.MAX_FACES_PER_IMAGE:
@@ -270,33 +819,52 @@ def detect_and_encode_faces_unified(image_path, output_folder):
         if not filtered_locations:
             logger.info("No faces passed size filtering")
             return [], [], detection_time, 0
+        if screening == prefilter.AUDIT:
+            prefilter.record_audit(len(filtered_locations))
 
         # Generate encodings for filtered face locations
         encoding_start = time.time()
-        face_encodings = face_recognition.face_encodings(image, filtered_locations)
+        landmark_model, num_jitters = encoding_settings(preset or config.ENCODING_PRESET)
+        pending = [
+            needs_original_pixels(location, variant_scale) for location in filtered_locations
+        ]
+        face_encodings = iter(
+            get_models().face_encodings(
+                image,
+                [
+                    location
+                    for location, needs_original in zip(filtered_locations, pending)
+                    if not needs_original
+                ],
+                num_jitters=num_jitters,
+                model=landmark_model,
+            )
+        )
         encoding_time = time.time() - encoding_start
+        tracing.record_stage("encode", encoding_time)
 
         logger.info(
-            f"Generated {len(face_encodings)} face encodings in {encoding_time:.3f}s"
+            f"Generated {pending.count(False)} face encodings in {encoding_time:.3f}s"
+            + (f", {sum(pending)} left for the original" if any(pending) else "")
         )
 
         # Prepare embeddings data structure (compatible with existing code)
         embeddings = []
-        for i, encoding in enumerate(face_encodings):
+        for i, (top, right, bottom, left) in enumerate(filtered_locations):
             embeddings.append(
                 {
-                    "encoding": encoding,
-                    "filename": f"face_{i + 1}.jpg",
+                    "encoding": None if pending[i] else next(face_encodings),
+                    "face_image": face_images[i],
                     "location": filtered_locations[i],
                     "size": {
-                        "width": filtered_locations[i][1] - filtered_locations[i][3],
-                        "height": filtered_locations[i][2] - filtered_locations[i][0],
+                        "width": int(round((right - left) / variant_scale)),
+                        "height": int(round((bottom - top) / variant_scale)),
                     },
                 }
             )
 
         logger.info(
-            f"Total {len(detected_faces)} face images saved, {len(embeddings)} embeddings generated"
+            f"Total {len(detected_faces)} face images cropped, {len(embeddings)} embeddings generated"
         )
 
         return detected_faces, embeddings, detection_time, encoding_time
@@ -307,136 +875,1021 @@ def detect_and_encode_faces_unified(image_path, output_folder):
         )
 
 
-def enhanced_face_matching(
-    embedding, index, tolerance_strict=None, tolerance_relaxed=None
-):
+def needs_original_pixels(location, variant_scale):
+    """Whether a face found in a downscaled variant is too small there to encode well"""
+    top, right, bottom, left = location
+    return (
+        variant_scale < 1.0
+        and min(right - left, bottom - top) < config.VARIANT_ENCODING_MIN_FACE_SIZE
+    )
+
+
+def has_unencoded_faces(detection):
+    """Whether a variant detection left faces for encode_from_original()"""
+    return any(embedding["encoding"] is None for embedding in detection[1])
+
+
+def decode_original(image_bytes, min_long_edge):
     """
-    Multi-stage face matching with strict and relaxed thresholds
+    Upright RGB array of an original image with a long edge of at least
+    min_long_edge. JPEGs are decoded at the smallest DCT scale (1/2 to 1/8)
+    that reaches it, other formats at full size.
     """
-    if tolerance_strict is None:
-        tolerance_strict = config.FACE_RECOGNITION_TOLERANCE
-    if tolerance_relaxed is None:
-        tolerance_relaxed = 0.6  # Fallback to more relaxed tolerance
+    with tracing.span("decode"):
+        image = Image.open(io.BytesIO(image_bytes))
+        reduction = min(1.0, min_long_edge / max(image.size))
+        image.draft("RGB", tuple(int(np.ceil(side * reduction)) for side in image.size))
+        return np.array(ImageOps.exif_transpose(image).convert("RGB"))
+
+
+def encode_original_faces(image_bytes, variant_size, locations, preset=None, crop=False):
+    """
+    Encodings of the faces at `locations` in a variant of variant_size
+    (width, height), computed from the original image bytes. With crop,
+    also returns their crops from the original, else a list of None.
+    """
+    # Decode just large enough for the smallest face to reach
+    # VARIANT_ENCODING_MIN_FACE_SIZE pixels
+    smallest = min(min(right - left, bottom - top) for top, right, bottom, left in locations)
+    image = decode_original(
+        image_bytes,
+        config.VARIANT_ENCODING_MIN_FACE_SIZE * max(variant_size) / max(1, smallest),
+    )
+
+    img_height, img_width = image.shape[:2]
+    scale_x = img_width / variant_size[0]
+    scale_y = img_height / variant_size[1]
+    if abs(scale_x - scale_y) > 0.02 * max(scale_x, scale_y):
+        raise FaceDetectionError(
+            f"Original of {img_width}x{img_height} does not match its "
+            f"{variant_size[0]}x{variant_size[1]} variant"
+        )
+
+    original_locations = [
+        (
+            int(round(top * scale_y)),
+            min(img_width, int(round(right * scale_x))),
+            min(img_height, int(round(bottom * scale_y))),
+            int(round(left * scale_x)),
+        )
+        for top, right, bottom, left in locations
+    ]
+    landmark_model, num_jitters = encoding_settings(preset or config.ENCODING_PRESET)
+    face_encodings = get_models().face_encodings(
+        image, original_locations, num_jitters=num_jitters, model=landmark_model
+    )
+    crops = [
+        crop_face_image(image, location) if crop else None for location in original_locations
+    ]
+    logger.info(
+        f"Encoded {len(locations)} small faces from a {img_width}x{img_height} "
+        f"decode of the original"
+    )
+    return face_encodings, crops
 
-    found_match = False
-    match_confidence = 0.0
-    matched_person = None
-    matching_stage = None
 
+def encode_from_original(image_bytes, variant_size, detection, preset=None):
+    """
+    Complete a variant detection: encode, and crop, the faces it left
+    unencoded from the original image bytes. Their boxes stay in the
+    variant's coordinates.
+    """
+    detected_faces, embeddings, detection_time, encoding_time = detection
+    pending = [embedding for embedding in embeddings if embedding["encoding"] is None]
+    start = time.time()
     try:
-        # Query Pinecone with higher top_k for better coverage
-        query_result = index.query(
-            vector=embedding["encoding"].tolist(),
-            top_k=config.PINECONE_TOP_K,
-            include_values=True,
-            include_metadata=True,
-        )
-
-        matches = query_result.get("matches", [])
-
-        if config.ENABLE_MULTI_STAGE_MATCHING:
-            # Stage 1: Strict matching first
-            for match in matches:
-                if match["score"] > config.PINECONE_SIMILARITY_THRESHOLD:
-                    known_face_encodings = match["values"]
-
-                    # Strict tolerance check
-                    results = face_recognition.compare_faces(
-                        [known_face_encodings],
-                        embedding["encoding"],
-                        tolerance=tolerance_strict,
-                    )
+        face_encodings, crops = encode_original_faces(
+            image_bytes,
+            variant_size,
+            [embedding["location"] for embedding in pending],
+            preset,
+            crop=config.SAVE_DETECTED_FACES,
+        )
+    except FaceRecognitionError:
+        raise
+    except Exception as e:
+        raise FaceDetectionError(f"Error encoding faces from the original: {str(e)}")
+
+    for embedding, encoding, face_image in zip(pending, face_encodings, crops):
+        embedding["encoding"] = encoding
+        embedding["face_image"] = face_image
+        if face_image is not None:
+            detected_faces.append(face_image)
+
+    elapsed = time.time() - start
+    tracing.record_stage("originalEncode", elapsed)
+    return detected_faces, embeddings, detection_time, encoding_time + elapsed
+
+
+def get_detection_config_signature(preset=None):
+    """Short hash of every setting that changes detected boxes or encodings"""
+    settings = {
+        "model": config.FACE_DETECTION_MODEL,
+        "encoding": encoding_settings(preset or config.ENCODING_PRESET),
+        "upsample_times": config.UPSAMPLE_TIMES,
+        "adaptive": config.ENABLE_ADAPTIVE_DETECTION,
+        "target_long_edge": config.DETECTION_TARGET_LONG_EDGE,
+        "max_upsample_times": config.MAX_UPSAMPLE_TIMES,
+        "cascade": [
+            config.CASCADE_HOG_LONG_EDGE,
+            config.CASCADE_REGION_MARGIN,
+            config.CASCADE_TILE_SIZE,
+            config.CASCADE_MAX_CNN_TILES,
+            config.CASCADE_DETAIL_THRESHOLD,
+            config.CASCADE_NMS_IOU,
+        ],
+        "min_face_size": config.MIN_FACE_SIZE,
+        "size_filtering": config.ENABLE_SIZE_FILTERING,
+        "max_faces": config.MAX_FACES_PER_IMAGE,
+    }
+    if prefilter.settings() is not None:
+        # Skipped images are cached as having no faces
+        settings["prefilter"] = prefilter.settings()
+    if config.ENABLE_VARIANT_DETECTION:
+        # Variants are cached under their own content hash and scale
+        settings["variant_encoding_min_face_size"] = config.VARIANT_ENCODING_MIN_FACE_SIZE
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def detection_cache_key(content_hash, preset=None):
+    return {
+        "PK": f"FACE_CACHE#{content_hash}",
+        "SK": f"DLIB#{get_detection_config_signature(preset)}",
+    }
+
+
+def lookup_cached_detections(content_hashes, preset=None):
+    """
+    Fetch cached detection results with BatchGetItem.
+    Returns {content_hash: detection} for unexpired hits only.
+    """
+    if not config.ENABLE_DETECTION_CACHE or not content_hashes:
+        return {}
+
+    keys = [
+        detection_cache_key(content_hash, preset)
+        for content_hash in dict.fromkeys(content_hashes)
+    ]
+    now = int(time.time())
+    cached = {}
+    try:
+        for i in range(0, len(keys), 100):
+            tracing.record_call("dynamodb", "BatchGetItem")
+            response = get_resource("dynamodb").batch_get_item(
+                RequestItems={pipeline_config.DDB_TABLE_NAME: {"Keys": keys[i : i + 100]}}
+            )
+            # Unprocessed keys are simply treated as misses
+            for item in response.get("Responses", {}).get(pipeline_config.DDB_TABLE_NAME, []):
+                # TTL deletion can lag, so check expiry explicitly
+                if int(item.get("ttl", 0)) > now:
+                    cached[item["PK"].split("#", 1)[1]] = detection_from_cache_item(item)
+    except Exception as e:
+        logger.error(f"Error reading detection cache: {str(e)}")
+    return cached
+
+
+def detection_from_cache_item(item):
+    """Rebuild a detection tuple from a cache item; crops are produced on demand"""
+    faces = json.loads(item["faces"])
+    encodings = np.empty((0, 128))
+    if faces:
+        raw = item["encodings"]
+        encodings = np.frombuffer(bytes(getattr(raw, "value", raw)), dtype=np.float64)
+        encodings = encodings.reshape(len(faces), -1)
+
+    embeddings = [
+        {
+            "encoding": encoding.copy(),
+            "face_image": None,
+            "location": tuple(face["location"]),
+            "size": face["size"],
+        }
+        for face, encoding in zip(faces, encodings)
+    ]
+    return [None] * len(embeddings), embeddings, 0.0, 0.0
+
+
+def store_cached_detections(entries, preset=None):
+    """Write (content_hash, detection) pairs to the cache"""
+    if not config.ENABLE_DETECTION_CACHE or not entries:
+        return
 
-                    if results[0]:
-                        found_match = True
-                        match_confidence = match["score"]
-                        matched_person = match["id"]
-                        matching_stage = "strict"
-                        logger.info(
-                            f"Strict match found: {matched_person} (score: {match_confidence:.3f})"
-                        )
-                        break
-
-            # Stage 2: Relaxed matching if no strict match found
-            if not found_match:
-                for match in matches:
-                    if match["score"] > 0.75:  # Lower similarity threshold
-                        known_face_encodings = match["values"]
-
-                        # Relaxed tolerance check
-                        results = face_recognition.compare_faces(
-                            [known_face_encodings],
-                            embedding["encoding"],
-                            tolerance=tolerance_relaxed,
-                        )
-
-                        if results[0]:
-                            found_match = True
-                            match_confidence = match["score"]
-                            matched_person = match["id"]
-                            matching_stage = "relaxed"
-                            logger.info(
-                                f"Relaxed match found: {matched_person} (score: {match_confidence:.3f})"
+    now = int(time.time())
+    # The batch writer flushes 25 items per BatchWriteItem
+    for _ in range(0, len(entries), 25):
+        tracing.record_call("dynamodb", "BatchWriteItem")
+    try:
+        with get_table().batch_writer(overwrite_by_pkeys=["PK", "SK"]) as writer:
+            for content_hash, detection in entries:
+                embeddings = detection[1]
+                item = {
+                    **detection_cache_key(content_hash, preset),
+                    "entityType": "FACE_CACHE",
+                    "faces": json.dumps(
+                        [
+                            {
+                                "location": [int(value) for value in embedding["location"]],
+                                "size": {
+                                    key: int(value)
+                                    for key, value in embedding["size"].items()
+                                },
+                            }
+                            for embedding in embeddings
+                        ]
+                    ),
+                    "createdAt": now,
+                    "ttl": now + config.DETECTION_CACHE_TTL_SECONDS,
+                }
+                if embeddings:
+                    item["encodings"] = np.asarray(
+                        [embedding["encoding"] for embedding in embeddings],
+                        dtype=np.float64,
+                    ).tobytes()
+                writer.put_item(Item=item)
+    except Exception as e:
+        logger.error(f"Error writing detection cache: {str(e)}")
+
+
+def get_decoded_image(job):
+    """The job's image as an RGB array, decoded once from the kept image bytes"""
+    if "decoded_image" not in job:
+        job["decoded_image"] = decode_image(job["image_bytes"])
+    return job["decoded_image"]
+
+
+def get_face_image(job, embedding):
+    """Face crop for an embedding, cropped from the job's image if it came from the cache"""
+    if embedding.get("face_image") or "image_bytes" not in job:
+        return embedding.get("face_image")
+
+    image = get_decoded_image(job)
+    if image is None:
+        return None
+    embedding["face_image"] = crop_face_image(image, embedding["location"])
+    return embedding["face_image"]
+
+
+def reencodes_for_enrollment(job):
+    """Whether new persons of the job are enrolled with a different encoding than it was matched with"""
+    return encoding_settings(config.ENROLLMENT_ENCODING_PRESET) != encoding_settings(
+        job["encoding_preset"]
+    )
+
+
+def enrollment_encodings(job, faces):
+    """
+    Encodings stored for the job's new persons: re-encoded from the kept image
+    with ENROLLMENT_ENCODING_PRESET when it differs from the matching preset.
+    Faces too small in a variant are re-encoded from the original.
+    """
+    encodings = [face["embedding"]["encoding"] for face in faces]
+    if not reencodes_for_enrollment(job) or "image_bytes" not in job:
+        return encodings
+
+    image = get_decoded_image(job)
+    if image is None:
+        return encodings
+    locations = [face["embedding"]["location"] for face in faces]
+    small = [
+        needs_original_pixels(location, job.get("variant_scale", 1.0)) for location in locations
+    ]
+    landmark_model, num_jitters = encoding_settings(config.ENROLLMENT_ENCODING_PRESET)
+    with tracing.span("enrollmentEncode"):
+        reencoded = iter(
+            get_models().face_encodings(
+                image,
+                [location for location, is_small in zip(locations, small) if not is_small],
+                num_jitters=num_jitters,
+                model=landmark_model,
+            )
+        )
+        encodings = [
+            encoding if is_small else next(reencoded)
+            for encoding, is_small in zip(encodings, small)
+        ]
+
+        if any(small):
+            try:
+                original_encodings, _ = encode_original_faces(
+                    download_original_bytes(job),
+                    job["variant_size"],
+                    [location for location, is_small in zip(locations, small) if is_small],
+                    config.ENROLLMENT_ENCODING_PRESET,
+                )
+            except Exception as e:
+                # The matching encodings are kept for these faces
+                logger.error(f"Error re-encoding small faces from the original: {str(e)}")
+            else:
+                original_encodings = iter(original_encodings)
+                encodings = [
+                    next(original_encodings) if is_small else encoding
+                    for encoding, is_small in zip(encodings, small)
+                ]
+    return encodings
+
+
+class LocalVectorIndex:
+    """
+    In-memory copy of the person vectors stored in Pinecone, kept in one
+    contiguous float32 matrix for vectorized top-k search in a warm container.
+
+    Pinecone stays the source of truth: the cache fetches person ids created
+    since its last sync (ids are sequential `personN` values backed by the
+    UNKNOWN_PERSONS counter) and new persons are written through to it.
+    Persons merged or refined elsewhere are read from DynamoDB logs.
+    """
+
+    # Reserved ids not yet visible in Pinecone are retried within this window
+    PENDING_ID_WINDOW = 500
+
+    # Merges recorded by face_maintenance.merge_persons, one item per applied
+    # chunk, sorted by SK
+    MERGE_LOG_PK = "MERGED_PERSONS"
+
+    # Persons whose vectors refine_persons rewrote, one item per refinement,
+    # sorted by SK (update_log_key) and expired after UPDATE_LOG_TTL_SECONDS
+    UPDATE_LOG_PK = "UPDATED_PERSONS"
+    UPDATE_LOG_TTL_SECONDS = 86400
+
+    # Update log items are read again for this long, as clocks and commit
+    # order across containers can put a new item before one already read
+    UPDATE_LOG_LAG_SECONDS = 60
+
+    def __init__(self, max_vectors, dimension=128):
+        self.max_vectors = max_vectors
+        self.dimension = dimension
+        self.ids = []
+        self.positions = {}
+        self.size = 0
+        self.synced_through = 0
+        self.pending_ids = set()
+        self.last_refresh = 0.0
+        self.last_miss_refresh = 0.0
+        self.merged_through = None
+        self.updates_since = None
+        self.applied_updates = set()
+        self.stale_persons = set()
+        self.overflowed = False
+        self._vectors = np.empty((0, dimension), dtype=np.float32)
+        self._norms = np.empty(0, dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def _grow(self):
+        capacity = min(self.max_vectors, max(1024, 2 * len(self._vectors)))
+        vectors = np.empty((capacity, self.dimension), dtype=np.float32)
+        norms = np.empty(capacity, dtype=np.float32)
+        vectors[: self.size] = self._vectors[: self.size]
+        norms[: self.size] = self._norms[: self.size]
+        self._vectors, self._norms = vectors, norms
+
+    def add(self, items):
+        """Add or replace (id, values) pairs. Returns False once the cache is full."""
+        with self._lock:
+            for vector_id, values in items:
+                position = self.positions.get(vector_id)
+                if position is None:
+                    if self.size >= self.max_vectors:
+                        self.overflowed = True
+                        return False
+                    if self.size == len(self._vectors):
+                        self._grow()
+                    position = self.size
+                    self.size += 1
+                    self.positions[vector_id] = position
+                    self.ids.append(vector_id)
+                vector = np.asarray(values, dtype=np.float32)
+                self._vectors[position] = vector
+                self._norms[position] = np.linalg.norm(vector)
+        return True
+
+    def remove(self, vector_ids):
+        """Drop vectors by id, moving the last cached vector into each hole"""
+        with self._lock:
+            for vector_id in vector_ids:
+                position = self.positions.pop(vector_id, None)
+                if position is None:
+                    continue
+                last = self.size - 1
+                if position != last:
+                    self._vectors[position] = self._vectors[last]
+                    self._norms[position] = self._norms[last]
+                    self.ids[position] = self.ids[last]
+                    self.positions[self.ids[position]] = position
+                self.ids.pop()
+                self.size -= 1
+
+    def clear(self):
+        """Drop all cached vectors and release their memory"""
+        with self._lock:
+            self.ids = []
+            self.positions = {}
+            self.size = 0
+            self._vectors = np.empty((0, self.dimension), dtype=np.float32)
+            self._norms = np.empty(0, dtype=np.float32)
+
+    def apply_merges(self, table):
+        """
+        Evict persons merged away since the last sync and queue their
+        survivors, whose vectors changed, to be fetched again. The first
+        sync only notes where the merge log ends: its fetch sees the merges.
+        """
+        if self.merged_through is None:
+            response = table.query(
+                KeyConditionExpression=Key("PK").eq(self.MERGE_LOG_PK),
+                ScanIndexForward=False,
+                Limit=1,
+            )
+            items = response.get("Items", [])
+            self.merged_through = items[0]["SK"] if items else ""
+            return
+
+        condition = Key("PK").eq(self.MERGE_LOG_PK)
+        if self.merged_through:
+            condition = condition & Key("SK").gt(self.merged_through)
+        kwargs = {"KeyConditionExpression": condition}
+        while True:
+            response = table.query(**kwargs)
+            for item in response.get("Items", []):
+                for person, survivor in item.get("survivors", {}).items():
+                    self.remove(person_vector_ids(person))
+                    self.remove(person_vector_ids(survivor))
+                    self.pending_ids.add(int(survivor[len("person") :]))
+                self.merged_through = max(self.merged_through, item["SK"])
+            if "LastEvaluatedKey" not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def apply_updates(self, table):
+        """
+        Mark persons refined by any container since the last sync to be
+        fetched again. The first sync only notes the time: its fetch sees
+        every earlier update. A cache idle for longer than the log is kept
+        is reloaded.
+        """
+        now = time.time()
+        if self.updates_since is None:
+            self.updates_since = now
+            return
+        if now - self.updates_since > self.UPDATE_LOG_TTL_SECONDS - self.UPDATE_LOG_LAG_SECONDS:
+            logger.info("Local vector index missed refinements, reloading it")
+            self.clear()
+            self.synced_through = 0
+            self.pending_ids = set()
+            self.stale_persons = set()
+            self.updates_since = now
+            return
+
+        condition = Key("PK").eq(self.UPDATE_LOG_PK) & Key("SK").gt(
+            update_log_key(self.updates_since - self.UPDATE_LOG_LAG_SECONDS)
+        )
+        kwargs = {"KeyConditionExpression": condition}
+        while True:
+            response = table.query(**kwargs)
+            for item in response.get("Items", []):
+                if item["SK"] not in self.applied_updates:
+                    self.applied_updates.add(item["SK"])
+                    self.stale_persons.update(item.get("persons", []))
+            if "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        # Only keys the next query can return again are kept
+        floor = update_log_key(now - self.UPDATE_LOG_LAG_SECONDS)
+        self.applied_updates = {key for key in self.applied_updates if key > floor}
+        self.updates_since = now
+
+    def sync(self, index, table):
+        """
+        Fetch vectors for persons created since the last sync, and again for
+        refined persons, one chunk of requests at a time. Returns the number
+        added, or stops adding and marks the cache overflowed at max_vectors.
+        """
+        if self.overflowed:
+            return 0
+        self.apply_merges(table)
+        if config.MAX_PERSON_SAMPLES > 0:
+            self.apply_updates(table)
+        response = table.get_item(Key={"PK": "UNKNOWN_PERSONS", "SK": "UNKNOWN_PERSONS"})
+        person_limit = int(response.get("Item", {}).get("limit", 0))
+
+        wanted_numbers = sorted(self.pending_ids) + list(
+            range(self.synced_through + 1, person_limit + 1)
+        )
+        wanted_ids = [
+            vector_id
+            for number in wanted_numbers
+            if f"person{number}" not in self.positions
+            for vector_id in person_vector_ids(f"person{number}")
+        ]
+        # Cached persons whose centroid or samples changed are replaced
+        stale_persons = set(self.stale_persons)
+        wanted_ids += [
+            vector_id
+            for person_id in stale_persons
+            if person_id in self.positions
+            for vector_id in person_vector_ids(person_id)
+        ]
+        batch_size = config.LOCAL_INDEX_FETCH_BATCH_SIZE
+        chunks = [
+            wanted_ids[i : i + batch_size] for i in range(0, len(wanted_ids), batch_size)
+        ]
+
+        added = 0
+        if chunks:
+            concurrency = min(config.PINECONE_QUERY_CONCURRENCY, len(chunks))
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                # One round of concurrent fetches is held in memory at a time
+                for start in range(0, len(chunks), concurrency):
+                    round_chunks = chunks[start : start + concurrency]
+                    for response in executor.map(lambda ids: index.fetch(ids=ids), round_chunks):
+                        items = [
+                            (vector_id, vector.values)
+                            for vector_id, vector in response.vectors.items()
+                        ]
+                        if not self.add(items):
+                            logger.warning(
+                                f"Local vector index exceeded {self.max_vectors} vectors, "
+                                "disabled for this container"
                             )
-                            break
+                            return 0
+                        added += len(items)
+
+        self.pending_ids = {
+            number
+            for number in wanted_numbers
+            if f"person{number}" not in self.positions
+            and number > person_limit - self.PENDING_ID_WINDOW
+        }
+        self.stale_persons -= stale_persons
+        self.synced_through = max(self.synced_through, person_limit)
+        self.last_refresh = time.time()
+
+        logger.info(
+            f"Local vector index synced: {added} added, {self.size} cached, "
+            f"{len(self.pending_ids)} pending"
+        )
+        return added
+
+    def search(self, encodings, top_k):
+        """
+        Vectorized top-k search for a batch of encodings. Returns one list of
+        Pinecone-style matches ({"id", "score", "values"}) per encoding, where
+        score is the cosine similarity, as in the Pinecone index.
+        """
+        # sync grows, overwrites and swap-removes the arrays from other threads
+        with self._lock:
+            return self._search(encodings, top_k)
+
+    def _search(self, encodings, top_k):
+        if self.size == 0 or not len(encodings):
+            return [[] for _ in encodings]
+
+        vectors = self._vectors[: self.size]
+        norms = self._norms[: self.size]
+        queries = np.asarray(encodings, dtype=np.float32)
+        query_norms = np.linalg.norm(queries, axis=1)
+
+        dots = queries @ vectors.T
+        similarities = dots / np.maximum(np.outer(query_norms, norms), 1e-12)
+        if config.LOCAL_INDEX_METRIC == "euclidean":
+            # Negative squared distance, so larger is closer for both metrics
+            ranking = 2 * dots - norms**2 - (query_norms**2)[:, None]
         else:
-            # Original single-stage matching
-            for match in matches:
-                if match["score"] > config.PINECONE_SIMILARITY_THRESHOLD:
-                    known_face_encodings = match["values"]
-
-                    results = face_recognition.compare_faces(
-                        [known_face_encodings],
-                        embedding["encoding"],
-                        tolerance=tolerance_strict,
+            ranking = similarities
+
+        k = min(top_k, self.size)
+        top = np.argpartition(-ranking, k - 1, axis=1)[:, :k]
+
+        results = []
+        for row, candidates in enumerate(top):
+            ordered = candidates[np.argsort(-ranking[row, candidates])]
+            results.append(
+                [
+                    {
+                        "id": self.ids[position],
+                        "score": float(similarities[row, position]),
+                        "values": vectors[position].copy(),
+                    }
+                    for position in ordered
+                ]
+            )
+        return results
+
+
+class InMemoryIndex:
+    """
+    Pinecone-compatible index backed by a LocalVectorIndex, for running the
+    pipeline without Pinecone (VECTOR_INDEX=memory). Vectors only live as
+    long as the process, so this is meant for local runs and offline tools.
+    """
+
+    def __init__(self, max_vectors):
+        self.vectors = LocalVectorIndex(max_vectors)
+        self.metadata = {}
+
+    def query(self, vector, top_k, **kwargs):
+        return {"matches": self.vectors.search([vector], top_k)[0]}
+
+    def upsert(self, vectors):
+        self.vectors.add((vector["id"], vector["values"]) for vector in vectors)
+        for vector in vectors:
+            self.metadata[vector["id"]] = vector.get("metadata", {})
+        return {"upserted_count": len(vectors)}
+
+    def fetch(self, ids):
+        found = {}
+        with self.vectors._lock:
+            for vector_id in ids:
+                position = self.vectors.positions.get(vector_id)
+                if position is not None:
+                    found[vector_id] = SimpleNamespace(
+                        id=vector_id,
+                        values=self.vectors._vectors[position].tolist(),
+                        metadata=self.metadata.get(vector_id, {}),
                     )
+        return SimpleNamespace(vectors=found)
 
-                    if results[0]:
-                        found_match = True
-                        match_confidence = match["score"]
-                        matched_person = match["id"]
-                        matching_stage = "single"
-                        logger.info(
-                            f"Match found: {matched_person} (score: {match_confidence:.3f})"
-                        )
-                        break
 
-        return found_match, matched_person, match_confidence, matching_stage
+# Lazily loaded on the first invocation of a warm container
+_local_index = None
+_local_index_retry_at = 0.0
+
+
+def get_local_index():
+    """Return the warm-container vector cache, or None to query Pinecone directly"""
+    global _local_index, _local_index_retry_at
+
+    if not config.ENABLE_LOCAL_INDEX_CACHE or config.VECTOR_INDEX == "memory":
+        return None
+
+    now = time.time()
+    if _local_index is not None and _local_index.overflowed:
+        # Never refilled: each attempt would fetch every vector again
+        return None
+    if _local_index is None:
+        if now < _local_index_retry_at:
+            return None
+        local_index = LocalVectorIndex(config.LOCAL_INDEX_MAX_VECTORS)
+        try:
+            load_start = time.time()
+            local_index.sync(get_index(), get_table())
+            logger.info(
+                f"Loaded local vector index in {time.time() - load_start:.2f}s"
+            )
+            _local_index = local_index
+        except Exception as e:
+            logger.error(f"Error loading local vector index: {str(e)}")
+            _local_index_retry_at = now + config.LOCAL_INDEX_MISS_REFRESH_SECONDS
+            return None
+    elif now - _local_index.last_refresh > config.LOCAL_INDEX_REFRESH_SECONDS:
+        try:
+            _local_index.sync(get_index(), get_table())
+        except Exception as e:
+            logger.error(f"Error refreshing local vector index: {str(e)}")
+
+    if _local_index.overflowed:
+        _local_index.clear()
+        return None
+    return _local_index
+
+
+def update_log_key(timestamp):
+    """Sort key prefix of UPDATED_PERSONS log items, ordered by time"""
+    return f"{timestamp:017.6f}"
+
+
+def record_person_updates(person_ids):
+    """
+    Log refined persons, so the local vector index of every warm container
+    fetches their new vectors on its next sync. Returns the log item's key.
+    """
+    now = time.time()
+    log_key = f"{update_log_key(now)}#{uuid.uuid4().hex[:8]}"
+    get_table().put_item(
+        Item={
+            "PK": LocalVectorIndex.UPDATE_LOG_PK,
+            "SK": log_key,
+            "entityType": "UPDATED_PERSONS",
+            "persons": person_ids,
+            "ttl": int(now) + LocalVectorIndex.UPDATE_LOG_TTL_SECONDS,
+        }
+    )
+    return log_key
+
+
+def candidate_score_floor():
+    """Lowest Pinecone score any matching stage accepts"""
+    if config.ENABLE_MULTI_STAGE_MATCHING:
+        return min(config.PINECONE_SIMILARITY_THRESHOLD, config.RELAXED_SIMILARITY_THRESHOLD)
+    return config.PINECONE_SIMILARITY_THRESHOLD
+
+
+def search_local_index(local_index, embeddings):
+    """
+    Attach local top-k matches to each embedding. Faces without a usable
+    candidate may belong to persons created by another container since the
+    last sync, so they trigger a (rate-limited) refresh and a second search.
+    """
+    top_k = get_query_top_k()
+    encodings = [embedding["encoding"] for embedding in embeddings]
+    for embedding, matches in zip(
+        embeddings, local_index.search(encodings, get_vector_top_k(top_k))
+    ):
+        embedding["matches"] = person_matches(matches, top_k)
+
+    score_floor = candidate_score_floor()
+    misses = [
+        embedding
+        for embedding in embeddings
+        if not any(match["score"] > score_floor for match in embedding["matches"])
+    ]
+    now = time.time()
+    if not misses or now - local_index.last_miss_refresh < config.LOCAL_INDEX_MISS_REFRESH_SECONDS:
+        return
+
+    local_index.last_miss_refresh = now
+    try:
+        if not local_index.sync(get_index(), get_table()):
+            return
+    except Exception as e:
+        logger.error(f"Error refreshing local vector index: {str(e)}")
+        return
+
+    encodings = [embedding["encoding"] for embedding in misses]
+    for embedding, matches in zip(
+        misses, local_index.search(encodings, get_vector_top_k(top_k))
+    ):
+        embedding["matches"] = person_matches(matches, top_k)
+
+
+def get_query_top_k():
+    """
+    Number of candidates to fetch per face. When duplicate detection is on,
+    one query covers both the matching and the duplicate check.
+    """
+    if config.ENABLE_DUPLICATE_DETECTION:
+        return max(config.PINECONE_TOP_K, config.DUPLICATE_CHECK_SAMPLE_SIZE)
+    return config.PINECONE_TOP_K
+
+
+def person_vector_ids(person_id):
+    """Index ids of a person: the `personN` centroid and its `personN#k` samples"""
+    return [person_id] + [
+        f"{person_id}#{sample}" for sample in range(1, config.MAX_PERSON_SAMPLES + 1)
+    ]
+
+
+def person_matches(matches, top_k):
+    """
+    Best-scoring vector per person, as matches with the person id as "id"
+    (the vector id is kept as "vector_id"), at most top_k of them
+    """
+    if config.MAX_PERSON_SAMPLES <= 0:
+        return matches[:top_k]
+
+    persons = {}
+    for match in matches:
+        person_id = match["id"].split("#", 1)[0]
+        if person_id not in persons:
+            persons[person_id] = {
+                "id": person_id,
+                "vector_id": match["id"],
+                "score": match["score"],
+                "values": match["values"],
+            }
+            if len(persons) == top_k:
+                break
+    return list(persons.values())
+
+
+def get_vector_top_k(top_k):
+    """Vectors to fetch so that top_k distinct persons remain after person_matches"""
+    return top_k * (config.MAX_PERSON_SAMPLES + 1)
+
+
+def query_face_matches(index, encoding, top_k=None):
+    """Query Pinecone for the nearest known persons of one face encoding"""
+    top_k = top_k or get_query_top_k()
+    tracing.record_call("pinecone", "Query")
+    query_result = index.query(
+        vector=encoding.tolist(),
+        top_k=get_vector_top_k(top_k),
+        include_values=True,
+        include_metadata=True,
+    )
+    return person_matches(query_result.get("matches", []), top_k)
+
+
+def prefetch_face_matches(index, embeddings):
+    """
+    Query Pinecone for every embedding concurrently and attach the results as
+    embedding["matches"]. A failed query is attached as embedding["query_error"]
+    so only that face is skipped. Served from the local vector index when enabled.
+    """
+    pending = [embedding for embedding in embeddings if "matches" not in embedding]
+    if not pending:
+        return
+
+    query_start = time.time()
+
+    local_index = get_local_index()
+    if local_index is not None:
+        with tracing.span("localIndexSearch"):
+            search_local_index(local_index, pending)
+        search_time = time.time() - query_start
+        # One vectorized search serves every face; split its time evenly
+        for embedding in pending:
+            embedding["query_time"] = search_time / len(pending)
+        logger.info(
+            f"Searched local vector index for {len(pending)} faces in {search_time:.3f}s"
+        )
+        return
+
+    def query(embedding):
+        start = time.time()
+        try:
+            embedding["matches"] = query_face_matches(index, embedding["encoding"])
+        except Exception as e:
+            embedding["query_error"] = e
+        embedding["query_time"] = time.time() - start
+        tracing.record_stage("pineconeQuery", embedding["query_time"])
+
+    with ThreadPoolExecutor(
+        max_workers=min(config.PINECONE_QUERY_CONCURRENCY, len(pending))
+    ) as executor:
+        list(executor.map(query, pending))
+
+    logger.info(
+        f"Queried Pinecone for {len(pending)} faces in {time.time() - query_start:.3f}s"
+    )
+
+
+def compute_match_decisions(embeddings, tolerance_strict=None, tolerance_relaxed=None):
+    """
+    Vectorized multi-stage matching for a batch of faces.
+
+    Stacks the candidates of every face into a faces x candidates array,
+    computes all face distances in one operation and derives the strict,
+    relaxed and duplicate decisions from that single distance matrix.
+    Candidates are in score order, so each stage picks the first passing
+    candidate, as the former per-candidate compare_faces loops did.
+    Returns one decision dict per embedding.
+    """
+    if tolerance_strict is None:
+        tolerance_strict = config.FACE_RECOGNITION_TOLERANCE
+    if tolerance_relaxed is None:
+        tolerance_relaxed = config.RELAXED_TOLERANCE  # Fallback to more relaxed tolerance
+
+    decisions = [
+        {
+            "found_match": False,
+            "matched_person": None,
+            "match_confidence": 0.0,
+            "matching_stage": None,
+            "match_distance": None,
+            "potential_duplicates": [],
+        }
+        for _ in embeddings
+    ]
+
+    width = max((len(embedding["matches"]) for embedding in embeddings), default=0)
+    if width == 0:
+        return decisions
+
+    queries = np.asarray(
+        [embedding["encoding"] for embedding in embeddings], dtype=np.float64
+    )
+    candidates = np.zeros((len(embeddings), width, queries.shape[1]))
+    scores = np.full((len(embeddings), width), -np.inf)
+    for row, embedding in enumerate(embeddings):
+        matches = embedding["matches"]
+        if matches:
+            candidates[row, : len(matches)] = [match["values"] for match in matches]
+            scores[row, : len(matches)] = [match["score"] for match in matches]
+
+    # Same euclidean distance face_recognition.compare_faces thresholds on
+    distances = np.linalg.norm(candidates - queries[:, None, :], axis=2)
+
+    columns = np.arange(width)
+    in_top_k = columns < config.PINECONE_TOP_K
+    strict = (
+        in_top_k
+        & (scores > config.PINECONE_SIMILARITY_THRESHOLD)
+        & (distances <= tolerance_strict)
+    )
+
+    if config.ENABLE_MULTI_STAGE_MATCHING:
+        relaxed = (
+            in_top_k
+            & (scores > config.RELAXED_SIMILARITY_THRESHOLD)
+            & (distances <= tolerance_relaxed)
+        )
+        stages = [(strict, "strict"), (relaxed, "relaxed")]
+    else:
+        # Original single-stage matching
+        stages = [(strict, "single")]
+
+    matched = np.zeros(len(embeddings), dtype=bool)
+    for mask, stage in stages:
+        hits = mask.any(axis=1) & ~matched
+        first = mask.argmax(axis=1)
+        for row in np.flatnonzero(hits):
+            match = embeddings[row]["matches"][first[row]]
+            decisions[row].update(
+                found_match=True,
+                matched_person=match["id"],
+                match_confidence=match["score"],
+                matching_stage=stage,
+                match_distance=float(distances[row, first[row]]),
+            )
+        matched |= hits
+
+    if config.ENABLE_DUPLICATE_DETECTION:
+        # Very high similarity and very strict tolerance
+        duplicate = (
+            (columns < config.DUPLICATE_CHECK_SAMPLE_SIZE)
+            & (scores > config.DUPLICATE_SIMILARITY_THRESHOLD)
+            & (distances <= config.DUPLICATE_TOLERANCE)
+        )
+        for row, column in zip(*np.nonzero(duplicate)):
+            match = embeddings[row]["matches"][column]
+            decisions[row]["potential_duplicates"].append(
+                {"person_id": match["id"], "similarity": match["score"]}
+            )
+
+    return decisions
+
+
+def assign_match_decisions(embeddings):
+    """Compute match decisions for all queried embeddings without one yet"""
+    pending = [
+        embedding
+        for embedding in embeddings
+        if "matches" in embedding and "match_decision" not in embedding
+    ]
+    if not pending:
+        return
+
+    for embedding, decision in zip(pending, compute_match_decisions(pending)):
+        embedding["match_decision"] = decision
+
+
+def enhanced_face_matching(
+    embedding, index, tolerance_strict=None, tolerance_relaxed=None
+):
+    """
+    Multi-stage face matching with strict and relaxed thresholds.
+    Uses embedding["matches"] when they were prefetched, otherwise queries Pinecone.
+    """
+    try:
+        if "query_error" in embedding:
+            raise embedding["query_error"]
+        if "matches" not in embedding:
+            embedding["matches"] = query_face_matches(index, embedding["encoding"])
+
+        decision = compute_match_decisions(
+            [embedding], tolerance_strict, tolerance_relaxed
+        )[0]
+        embedding["match_decision"] = decision
+
+        if decision["found_match"]:
+            logger.info(
+                f"{decision['matching_stage'].capitalize()} match found: "
+                f"{decision['matched_person']} (score: {decision['match_confidence']:.3f})"
+            )
+
+        return (
+            decision["found_match"],
+            decision["matched_person"],
+            decision["match_confidence"],
+            decision["matching_stage"],
+        )
 
     except Exception as e:
         raise PersonMatchingError(f"Error in enhanced matching: {str(e)}")
 
 
-def check_for_duplicate_persons(new_embedding, existing_persons_sample=10):
+def check_for_duplicate_persons(new_embedding, existing_persons_sample=None, matches=None):
     """
-    Check if a new person might be a duplicate of existing persons
+    Check if a new person might be a duplicate of existing persons.
+    Reuses the matching query results when given, so no extra query is made.
     """
     if not config.ENABLE_DUPLICATE_DETECTION:
         return []
 
+    if existing_persons_sample is None:
+        existing_persons_sample = config.DUPLICATE_CHECK_SAMPLE_SIZE
+
     try:
-        # Query for similar persons with broader search
-        query_result = index.query(
-            vector=new_embedding.tolist(),
-            top_k=existing_persons_sample,
-            include_values=True,
-            include_metadata=True,
-        )
-
-        potential_duplicates = []
-        for match in query_result.get("matches", []):
-            # Check with very strict threshold for potential duplicates
-            if match["score"] > 0.9:  # Very high similarity
-                results = face_recognition.compare_faces(
-                    [match["values"]],
-                    new_embedding,
-                    tolerance=0.3,  # Very strict tolerance
-                )
+        if matches is None:
+            # Query for similar persons with broader search
+            matches = query_face_matches(
+                get_index(), new_embedding, top_k=existing_persons_sample
+            )
 
-                if results[0]:
-                    potential_duplicates.append(
-                        {"person_id": match["id"], "similarity": match["score"]}
-                    )
+        potential_duplicates = compute_match_decisions(
+            [{"encoding": new_embedding, "matches": matches[:existing_persons_sample]}]
+        )[0]["potential_duplicates"]
 
         if potential_duplicates:
             logger.warning(
@@ -450,386 +1903,904 @@ def check_for_duplicate_persons(new_embedding, existing_persons_sample=10):
         return []
 
 
-def get_new_person_id_for_insert(table):
-    """Get a new person ID by incrementing the counter"""
+def download_image_bytes(bucket_name, object_key, byte_range=None):
+    """Read an S3 object, or a byte range of it, into memory"""
+    request = {"Bucket": bucket_name, "Key": object_key}
+    if byte_range:
+        request["Range"] = byte_range
     try:
-        response = table.update_item(
-            Key={
-                "PK": "UNKNOWN_PERSONS",
-                "SK": "UNKNOWN_PERSONS",
-            },
-            UpdateExpression="SET #attrName = if_not_exists(#attrName, :start) + :val",
-            ExpressionAttributeNames={"#attrName": "limit"},
-            ExpressionAttributeValues={":val": 1, ":start": 0},
-            ReturnValues="ALL_NEW",
-        )
-        return response["Attributes"]["limit"]
+        with tracing.span("download"):
+            image_bytes = get_s3().get_object(**request)["Body"].read()
+        tracing.record_call("s3", "GetObject", received=len(image_bytes))
+        return image_bytes
     except Exception as e:
-        logger.error(f"Error getting new person ID: {str(e)}")
+        logger.error(f"Error downloading file {object_key}: {str(e)}")
         raise
 
 
-def insert_new_person_to_ddb(table, person_id, s3_key):
-    """Insert a new person record to DynamoDB"""
-    name = f"person{person_id}"
+def image_size(image_bytes):
+    """(width, height) from the header of encoded image bytes, or None if unreadable"""
     try:
-        response = table.put_item(
-            Item={
-                "PK": f"PERSON#{name}",
-                "SK": name,
-                "displayName": name,
-                "entityType": "PERSON",
-                "s3Key": s3_key,
-                "createdAt": int(time.time()),
-            }
-        )
-        logger.info(f"Inserted new person: {name}")
-        return response
-    except Exception as e:
-        logger.error(f"Error inserting person to DDB: {str(e)}")
-        raise
+        return Image.open(io.BytesIO(image_bytes)).size
+    except Exception:
+        return None
 
 
-def download_file(bucket_name, object_key, file_name):
-    """Download file from S3"""
-    try:
-        s3.download_file(bucket_name, object_key, file_name)
-        return file_name
-    except Exception as e:
-        logger.error(f"Error downloading file {object_key}: {str(e)}")
-        raise
+def variant_keeps_min_face_size(variant_scale):
+    """Whether MIN_FACE_SIZE faces of the original stay detectable in a variant at this scale"""
+    upsample_times = (
+        config.MAX_UPSAMPLE_TIMES if config.ENABLE_ADAPTIVE_DETECTION else config.UPSAMPLE_TIMES
+    )
+    return config.MIN_FACE_SIZE * variant_scale * 2**upsample_times >= DETECTOR_MIN_FACE_SIZE
 
 
-def get_original_s3_key(ksuid):
-    """Get the original S3 key from the KSUID"""
+def download_variant_bytes(bucket_name, object_key):
+    """Read a thumbnail variant into memory, or None if it has not been generated yet"""
     try:
-        response = table.query(
-            IndexName="entityType-PK-index",
-            KeyConditionExpression=Key("PK").eq(ksuid) & Key("entityType").eq("IMAGE"),
+        with tracing.span("download"):
+            image_bytes = get_s3().get_object(Bucket=bucket_name, Key=object_key)["Body"].read()
+    except ClientError as e:
+        # Without s3:ListBucket, S3 reports a missing key as AccessDenied
+        if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "AccessDenied"):
+            raise
+        return None
+    tracing.record_call("s3", "GetObject", received=len(image_bytes))
+    return image_bytes
+
+
+def download_detection_image(job):
+    """
+    Bytes of the image to detect the job's faces on. With
+    ENABLE_VARIANT_DETECTION, an original is replaced by its large variant
+    when a MIN_FACE_SIZE face stays detectable there. The original's header
+    is read first, so the variant is only downloaded when it will be used.
+    The variant's scale and size are then kept in job["variant_scale"] and
+    job["variant_size"].
+    """
+    bucket_name, object_key = job["bucket_name"], job["object_key"]
+    if (
+        not config.ENABLE_VARIANT_DETECTION
+        or job["processed_image_type"] != "original"
+        or job["is_profile_picture"]
+    ):
+        return download_image_bytes(bucket_name, object_key)
+
+    header = download_image_bytes(
+        bucket_name, object_key, byte_range=f"bytes=0-{ORIGINAL_HEADER_BYTES - 1}"
+    )
+
+    def original_bytes():
+        # A short read means the header range already holds the whole object
+        if len(header) < ORIGINAL_HEADER_BYTES:
+            return header
+        return download_image_bytes(bucket_name, object_key)
+
+    original_size = image_size(header)
+    if original_size is None:
+        logger.info(f"Could not read the size of {object_key}, detecting on the original")
+        return original_bytes()
+
+    # The large variant fits the original inside LARGE_VARIANT_LONG_EDGE
+    variant_key = f"processed/{job['file_name_without_ext']}_large.webp"
+    variant_scale = min(1.0, LARGE_VARIANT_LONG_EDGE / max(original_size))
+    if not variant_keeps_min_face_size(variant_scale):
+        logger.info(
+            f"{variant_key} would be too small (scale {variant_scale:.3f}) for "
+            f"{config.MIN_FACE_SIZE}px faces, detecting on the original"
         )
-        if "Items" in response and response["Items"]:
-            return response["Items"][0].get("s3Key")
-        else:
-            logger.warning(f"No item found for KSUID: {ksuid}")
-            return None
+        return original_bytes()
+
+    variant_bytes = download_variant_bytes(bucket_name, variant_key)
+    variant_size = variant_bytes and image_size(variant_bytes)
+    if not variant_size:
+        logger.info(f"No usable {variant_key} yet, detecting on the original")
+        return original_bytes()
+
+    expected_long_edge = max(original_size) * variant_scale
+    variant_scale = min(1.0, max(variant_size) / max(original_size))
+    # A variant generated with other settings is checked at its own scale
+    if abs(max(variant_size) - expected_long_edge) > 1 and not variant_keeps_min_face_size(
+        variant_scale
+    ):
+        logger.info(
+            f"{variant_key} is too small (scale {variant_scale:.3f}) for "
+            f"{config.MIN_FACE_SIZE}px faces, detecting on the original"
+        )
+        return original_bytes()
 
-    except Exception as e:
-        logger.error(f"Error retrieving original S3 key for KSUID {ksuid}: {str(e)}")
-        raise
+    job["variant_scale"] = variant_scale
+    job["variant_size"] = variant_size
+    tracing.count("VariantDetections")
+    logger.info(f"Detecting on {variant_key} (scale {variant_scale:.3f})")
+    return variant_bytes
 
 
-def check_if_unknown_persons_key_available():
-    """Ensure the UNKNOWN_PERSONS counter exists"""
-    try:
-        response = table.get_item(
-            Key={"PK": "UNKNOWN_PERSONS", "SK": "UNKNOWN_PERSONS"}
-        )
+def download_original_bytes(job):
+    """
+    The original of a job detected on a variant, for the faces it left
+    unencoded. Kept while new persons may still be re-encoded for enrollment.
+    """
+    if "original_bytes" in job:
+        return job["original_bytes"]
+    tracing.count("OriginalFetches")
+    image_bytes = download_image_bytes(job["bucket_name"], job["object_key"])
+    if reencodes_for_enrollment(job):
+        job["original_bytes"] = image_bytes
+    return image_bytes
 
-        if "Item" not in response:
-            table.put_item(
-                Item={
-                    "PK": "UNKNOWN_PERSONS",
-                    "SK": "UNKNOWN_PERSONS",
-                    "entityType": "UNKNOWN_PERSONS",
-                    "limit": 0,
-                }
+
+def image_content_hash(job, image_bytes):
+    """Detection cache identity of the job's image bytes; variants are cached per scale"""
+    content_hash = hashlib.sha256(image_bytes).hexdigest()
+    if job.get("variant_scale", 1.0) < 1.0:
+        content_hash += f"@{job['variant_scale']:.4f}"
+    return content_hash
+
+
+def get_detection_worker_count():
+    """Number of detection processes to run, defaulting to one per vCPU"""
+    if config.DETECTION_WORKERS > 0:
+        return config.DETECTION_WORKERS
+    return os.cpu_count() or 1
+
+
+def _detection_worker(conn, function, tasks):
+    """
+    Run detection and encoding for a slice of the batch in a forked process,
+    sending each outcome as soon as it is ready
+    """
+    for position, *arguments in tasks:
+        with tracing.capture() as trace:
+            detection, error = None, None
+            try:
+                detection = function(*arguments)
+            except Exception as e:
+                # Only send exceptions we know can be pickled back to the parent
+                error = e if isinstance(e, FaceRecognitionError) else FaceDetectionError(str(e))
+        try:
+            conn.send((position, detection, error, trace and trace.export()))
+        except Exception as e:
+            # send() pickles first, so a failure here leaves the pipe usable
+            conn.send(
+                (position, None, FaceDetectionError(f"Could not send detection result: {e}"), None)
             )
-            logger.info("Created UNKNOWN_PERSONS counter")
-    except Exception as e:
-        logger.error(f"Error checking/creating UNKNOWN_PERSONS key: {str(e)}")
-        raise
+    conn.close()
 
 
-def handler(event, context):
-    """Main Lambda handler function with unified face_recognition approach"""
-    logger.info(f"Event: {json.dumps(event)}")
-    logger.info(
-        f"Configuration: DETECTION_MODEL={config.FACE_DETECTION_MODEL}, "
-        f"PINECONE_THRESHOLD={config.PINECONE_SIMILARITY_THRESHOLD}, "
-        f"FACE_RECOGNITION_TOLERANCE={config.FACE_RECOGNITION_TOLERANCE}, "
-        f"SIZE_FILTERING={config.ENABLE_SIZE_FILTERING}"
-    )
+def _run_detections_serially(tasks, outcomes, jobs, function):
+    for position, *arguments in tasks:
+        try:
+            with tracing.bind_job(jobs.get(position)):
+                outcomes[position] = (function(*arguments), None)
+        except Exception as e:
+            outcomes[position] = (None, e)
 
-    try:
-        check_if_unknown_persons_key_available()
-        results = []
 
-        # Process each record in the event
-        for record in event["Records"]:
+def run_detection_pool(tasks, jobs=None, function=detect_and_encode_faces_unified):
+    """
+    Run detection and encoding for (position, *arguments) tasks across worker
+    processes and return {position: (detection, error)}, where detection is
+    function(*arguments). Workers are forked, so the image bytes reach them
+    without being copied through a pipe. Their trace measurements are
+    attributed to jobs[position] when given.
+
+    Lambda provides no /dev/shm, so multiprocessing.Pool and
+    ProcessPoolExecutor cannot be used; plain Process + Pipe works.
+
+    If a worker dies (out of memory, a crash in dlib), the image it was on
+    fails and the images it had not reached are detected in this process.
+    """
+    outcomes = {}
+    jobs = jobs or {}
+    workers = min(get_detection_worker_count(), len(tasks))
+
+    if workers <= 1:
+        _run_detections_serially(tasks, outcomes, jobs, function)
+        return outcomes
+
+    processes = {}
+    for worker_index in range(workers):
+        chunk = tasks[worker_index::workers]
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_detection_worker, args=(child_conn, function, chunk)
+        )
+        process.start()
+        child_conn.close()
+        processes[parent_conn] = (process, chunk)
+
+    logger.info(f"Started {workers} detection workers for {len(tasks)} images")
+
+    unfinished = []
+    while processes:
+        # Receive as outcomes arrive so large payloads cannot block a worker
+        for parent_conn in multiprocessing.connection.wait(list(processes)):
             try:
-                body = json.loads(record["body"])
-                
-                # Check if this is a profile picture processing request
-                is_profile_picture = body.get("isProfilePicture", False)
-                user_email = body.get("userEmail", None)
-
-                # Handle the new message format from thumbnail completion
-                if "largeImageKey" in body:
-                    bucket_name = body["bucketName"]
-                    large_image_key = body["largeImageKey"]
-                    file_name_without_ext = body["fileNameWithoutExt"]
-                    object_key = large_image_key
-                    logger.info(
-                        f"Processing large image: {bucket_name}/{large_image_key}"
+                position, detection, error, trace_data = parent_conn.recv()
+            except (EOFError, OSError):
+                process, chunk = processes.pop(parent_conn)
+                parent_conn.close()
+                process.join()
+                missing = [task for task in chunk if task[0] not in outcomes]
+                if missing:
+                    # Workers run their tasks in order, so the first is the one it died on
+                    logger.error(
+                        f"Detection worker exited unexpectedly (exit code {process.exitcode}), "
+                        f"retrying {len(missing) - 1} images it had not reached"
                     )
-                else:
-                    bucket_name = body["bucketName"]
-                    object_key = body["objectKey"]
-                    file_name_without_ext = object_key.split("/")[-1].split(".")[0]
-                    logger.info(
-                        f"Processing {'profile picture' if is_profile_picture else 'original image'}: {bucket_name}/{object_key}"
+                    outcomes[missing[0][0]] = (
+                        None,
+                        FaceDetectionError(
+                            f"Detection worker exited unexpectedly (exit code {process.exitcode})"
+                        ),
                     )
+                    unfinished.extend(missing[1:])
+                continue
+            outcomes[position] = (detection, error)
+            tracing.merge(trace_data, jobs.get(position))
 
-                start_time = time.time()
+    _run_detections_serially(unfinished, outcomes, jobs, function)
+    return outcomes
 
-                # Download file from S3
-                file_name = f"/tmp/{object_key.split('/')[-1]}"
-                download_file(bucket_name, object_key, file_name)
 
-                # Unified face detection and encoding using face_recognition
-                detected_faces, generated_embeddings, detection_time, encoding_time = (
-                    detect_and_encode_faces_unified(file_name, output_folder)
+def detect_job_image(job, image_bytes):
+    """Detect and encode the job's image, with small faces of a variant encoded from the original"""
+    preset = job["encoding_preset"]
+    detection = detect_and_encode_faces_unified(
+        image_bytes, preset, job.get("variant_scale", 1.0)
+    )
+    if has_unencoded_faces(detection):
+        detection = encode_from_original(
+            download_original_bytes(job), job["variant_size"], detection, preset
+        )
+    return detection
+
+
+def get_detection(job, image_bytes):
+    """Detection for one image, served from the content-hash cache when possible"""
+    preset = job["encoding_preset"]
+    if reencodes_for_enrollment(job):
+        # Kept so new persons can be re-encoded for enrollment
+        job["image_bytes"] = image_bytes
+    if not config.ENABLE_DETECTION_CACHE:
+        return detect_job_image(job, image_bytes)
+
+    content_hash = image_content_hash(job, image_bytes)
+    detection = lookup_cached_detections([content_hash], preset).get(content_hash)
+    if detection is not None:
+        logger.info(f"Detection cache hit for {job['object_key']}")
+        job["detection_cache"] = "hit"
+        # Kept so crops can be produced for new persons
+        job["image_bytes"] = image_bytes
+        return detection
+
+    job["detection_cache"] = "miss"
+    detection = detect_job_image(job, image_bytes)
+    store_cached_detections([(content_hash, detection)], preset)
+    return detection
+
+
+def detect_jobs_serially(jobs):
+    """Download, detect and encode one image at a time"""
+    for job in jobs:
+        try:
+            job["start_time"] = time.time()
+            with tracing.bind_job(job):
+                job["detection"] = get_detection(job, download_detection_image(job))
+        except Exception as e:
+            job["error"] = e
+
+
+def complete_variant_detections(jobs, outcomes):
+    """
+    Encode the faces that variant detections left unencoded from the jobs'
+    originals: download those originals concurrently, then encode in the
+    detection pool. `outcomes` maps positions in jobs to (detection, error).
+    """
+    positions = [
+        position
+        for position, (detection, error) in outcomes.items()
+        if error is None and has_unencoded_faces(detection)
+    ]
+    if not positions:
+        return
+
+    originals = {}
+    with ThreadPoolExecutor(
+        max_workers=min(config.DOWNLOAD_CONCURRENCY, len(positions))
+    ) as executor:
+        futures = {
+            executor.submit(
+                tracing.bound(jobs[position], download_original_bytes), jobs[position]
+            ): position
+            for position in positions
+        }
+        for future in as_completed(futures):
+            try:
+                originals[futures[future]] = future.result()
+            except Exception as e:
+                outcomes[futures[future]] = (None, e)
+
+    outcomes.update(
+        run_detection_pool(
+            [
+                (
+                    position,
+                    image_bytes,
+                    jobs[position]["variant_size"],
+                    outcomes[position][0],
+                    jobs[position]["encoding_preset"],
                 )
+                for position, image_bytes in originals.items()
+            ],
+            jobs=dict(enumerate(jobs)),
+            function=encode_from_original,
+        )
+    )
 
-                if not generated_embeddings:
-                    logger.info("No face encodings generated")
-                    continue
 
-                face_found = []
-                persons_not_found = []
-                matching_details = []
-
-                # Query Pinecone for each face encoding with enhanced matching
-                for i, embedding in enumerate(generated_embeddings):
-                    try:
-                        (
-                            found_match,
-                            matched_person,
-                            match_confidence,
-                            matching_stage,
-                        ) = enhanced_face_matching(embedding, index)
-
-                        if found_match:
-                            face_found.append(matched_person)
-                            matching_details.append(
-                                {
-                                    "person": matched_person,
-                                    "confidence": match_confidence,
-                                    "stage": matching_stage,
-                                    "face_size": embedding.get("size", {}),
-                                }
-                            )
-                            logger.info(
-                                f"Found match: {matched_person} with score: {match_confidence:.3f} (stage: {matching_stage})"
-                            )
-                        else:
-                            logger.info(
-                                f"Person not found in index. Adding new person for face {i + 1}"
-                            )
+def detect_jobs_in_batch(jobs):
+    """
+    Pipelined batch mode: download every image concurrently, then run
+    detection and encoding in a process pool. Sets job["detection"] or
+    job["error"].
+    """
+    batch_start = time.time()
+
+    # Stage 1: concurrent downloads
+    with ThreadPoolExecutor(
+        max_workers=min(config.DOWNLOAD_CONCURRENCY, len(jobs))
+    ) as executor:
+        futures = {}
+        for job in jobs:
+            job["start_time"] = time.time()
+            futures[executor.submit(tracing.bound(job, download_detection_image), job)] = job
+        for future in as_completed(futures):
+            try:
+                futures[future]["image_bytes"] = future.result()
+            except Exception as e:
+                futures[future]["error"] = e
+
+    downloaded = [job for job in jobs if "error" not in job]
+    download_time = time.time() - batch_start
+
+    # Repeated images skip detection and encoding entirely
+    outcomes = {}
+    cache_hits = 0
+    if config.ENABLE_DETECTION_CACHE:
+        for job in downloaded:
+            job["content_hash"] = image_content_hash(job, job["image_bytes"])
+        # Cache entries are per encoding preset, normally one per batch
+        cached = {}
+        with tracing.span("cacheLookup"):
+            for preset in {job["encoding_preset"] for job in downloaded}:
+                hits = lookup_cached_detections(
+                    [
+                        job["content_hash"]
+                        for job in downloaded
+                        if job["encoding_preset"] == preset
+                    ],
+                    preset,
+                )
+                cached.update(
+                    ((content_hash, preset), detection)
+                    for content_hash, detection in hits.items()
+                )
+        for position, job in enumerate(downloaded):
+            cache_key = (job["content_hash"], job["encoding_preset"])
+            if cache_key in cached:
+                job["detection_cache"] = "hit"
+                outcomes[position] = (cached[cache_key], None)
+            else:
+                job["detection_cache"] = "miss"
+        cache_hits = len(outcomes)
+
+    # Stage 2: detection and encoding across worker processes
+    detection_start = time.time()
+    outcomes.update(
+        run_detection_pool(
+            [
+                (
+                    position,
+                    job["image_bytes"],
+                    job["encoding_preset"],
+                    job.get("variant_scale", 1.0),
+                )
+                for position, job in enumerate(downloaded)
+                if position not in outcomes
+            ],
+            jobs=dict(enumerate(downloaded)),
+        )
+    )
+    complete_variant_detections(downloaded, outcomes)
+    detection_time = time.time() - detection_start
+
+    with tracing.span("cacheStore"):
+        for preset in {job["encoding_preset"] for job in downloaded}:
+            store_cached_detections(
+                [
+                    (job["content_hash"], outcomes[position][0])
+                    for position, job in enumerate(downloaded)
+                    if job["encoding_preset"] == preset
+                    and job.get("detection_cache") == "miss"
+                    and outcomes[position][1] is None
+                ],
+                preset,
+            )
 
-                            # Get new person ID
-                            person_id = get_new_person_id_for_insert(table)
-                            person_name = f"person{person_id}"
+    # Encoded images are no longer needed once faces are cropped and encoded,
+    # except for cache hits, which crop new persons' faces on demand, and
+    # images whose new persons are re-encoded for enrollment
+    for job in downloaded:
+        if job.get("detection_cache") != "hit" and not reencodes_for_enrollment(job):
+            job.pop("image_bytes", None)
 
-                            # Check for potential duplicates
-                            potential_duplicates = check_for_duplicate_persons(
-                                embedding["encoding"]
-                            )
+    logger.info(
+        f"Batch of {len(jobs)} images: downloads {download_time:.2f}s, "
+        f"detection/encoding {detection_time:.2f}s, "
+        f"detection cache hits {cache_hits}/{len(downloaded)}"
+    )
 
-                            # Upload face to S3
-                            if config.SAVE_DETECTED_FACES and detected_faces:
-                                person_file_name = os.path.join(
-                                    output_folder, embedding["filename"]
-                                )
-                                file_extension = embedding["filename"].split(".")[-1]
-                                s3_key = f"persons/{person_name}.{file_extension}"
-
-                                if os.path.exists(person_file_name):
-                                    s3.upload_file(
-                                        person_file_name, bucket_name, s3_key
-                                    )
-                                    logger.info(f"Uploaded face to S3: {s3_key}")
-                                else:
-                                    # Create a temporary face crop if file doesn't exist
-                                    s3_key = f"persons/{person_name}.jpg"
-                                    logger.warning(
-                                        f"Face file not found, using placeholder for S3 key: {s3_key}"
-                                    )
-                            else:
-                                s3_key = f"persons/{person_name}.jpg"
-
-                            # Insert to DynamoDB
-                            insert_new_person_to_ddb(table, person_id, s3_key)
-
-                            face_found.append(person_name)
-
-                            # Prepare for Pinecone upsert
-                            persons_not_found.append(
-                                {
-                                    "id": person_name,
-                                    "values": embedding["encoding"].tolist(),
-                                    # "metadata": {
-                                    #     "app": "photo",
-                                    #     "s3_key": s3_key,
-                                    #     "created_at": int(time.time()),
-                                    #     "detection_model": config.FACE_DETECTION_MODEL,
-                                    #     "face_size": embedding.get("size", {}),
-                                    #     "potential_duplicates": len(
-                                    #         potential_duplicates
-                                    #     ),
-                                    # },
-                                }
-                            )
+    for position, job in enumerate(downloaded):
+        detection, error = outcomes[position]
+        if error is not None:
+            job["error"] = error
+        else:
+            job["detection"] = detection
 
-                    except PersonMatchingError as e:
-                        logger.error(f"Error processing embedding {i}: {str(e)}")
-                        continue
-
-                # Upsert new persons to Pinecone
-                if persons_not_found:
-                    try:
-                        upsert_response = index.upsert(vectors=persons_not_found)
-                        logger.info(
-                            f"Upserted {len(persons_not_found)} new persons to Pinecone"
-                        )
-                        logger.info(f"Upsert response: {upsert_response}")
-                    except Exception as e:
-                        logger.error(f"Error upserting to Pinecone: {str(e)}")
-
-                # Clean up temporary files
-                if os.path.exists(file_name):
-                    os.remove(file_name)
-
-                # Handle profile picture processing vs regular image tagging
-                if is_profile_picture and user_email and face_found:
-                    # For profile pictures, associate the user with the first detected person
-                    matched_person = face_found[0]  # Take the first (and likely only) detected person
-                    
-                    try:
-                        # Update the user record to associate with the matched person
-                        table.update_item(
-                            Key={
-                                "PK": user_email,
-                                "SK": user_email
-                            },
-                            UpdateExpression="SET personId = :personId, updatedAt = :updatedAt",
-                            ExpressionAttributeValues={
-                                ":personId": matched_person,
-                                ":updatedAt": datetime.now().isoformat()
-                            }
-                        )
-                        
-                        logger.info(f"Associated user {user_email} with person {matched_person}")
-                        
-                    except Exception as e:
-                        logger.error(f"Error associating user {user_email} with person {matched_person}: {str(e)}")
-                        
-                elif not is_profile_picture:
-                    # Regular image processing - create tagging records
-                    kusid = file_name_without_ext
-                    # get original S3 key if available
-                    original_s3_key = get_original_s3_key(kusid)
-
-                    for person in face_found:
-                        try:
-                            table.put_item(
-                                Item={
-                                    "PK": kusid,
-                                    "SK": f"PERSON#{person}",
-                                    "entityType": f"TAGGING#{person}",
-                                    "s3Key": original_s3_key,
-                                    "createdAt": int(time.time()),
-                                    "images": {
-                                        "large": f"processed/{kusid}_large.webp",
-                                        "medium": f"processed/{kusid}_medium.webp",
-                                    },
-                                }
-                            )
-                        except Exception as e:
-                            logger.error(f"Error inserting tagging record: {str(e)}")
-
-                # Log processing metrics
-                metrics = log_processing_metrics(
-                    start_time,
-                    len(detected_faces),
-                    len(generated_embeddings),
-                    len(face_found),
-                    detection_time,
-                    encoding_time,
+
+def faces_from_embeddings(embeddings):
+    """Pipeline faces for matched embeddings; faces whose query failed are skipped"""
+    faces = []
+    for i, embedding in enumerate(embeddings):
+        if "query_error" in embedding:
+            logger.error(
+                f"Error processing embedding {i}: Error in enhanced matching: {str(embedding['query_error'])}"
+            )
+            continue
+
+        decision = embedding["match_decision"]
+        if decision["found_match"]:
+            logger.info(
+                f"Found match: {decision['matched_person']} with score: "
+                f"{decision['match_confidence']:.3f} (stage: {decision['matching_stage']})"
+            )
+        else:
+            logger.info(f"Person not found in index. Adding new person for face {i + 1}")
+            # Potential duplicates come from the same distance matrix
+            if decision["potential_duplicates"]:
+                logger.warning(
+                    f"Potential duplicate persons detected: {decision['potential_duplicates']}"
                 )
 
-                result = {
-                    "object_key": object_key,
-                    "persons_found": face_found,
-                    "time_taken": metrics["processing_time_seconds"],
-                    "detection_time": detection_time,
-                    "encoding_time": encoding_time,
-                    "faces_detected": len(detected_faces),
-                    "encodings_generated": len(generated_embeddings),
-                    "matching_details": matching_details,
-                    "processed_image_type": "large"
-                    if "largeImageKey" in body
-                    else "original",
-                    "detection_model": config.FACE_DETECTION_MODEL,
-                    "size_filtering_enabled": config.ENABLE_SIZE_FILTERING,
-                    "multi_stage_matching_enabled": config.ENABLE_MULTI_STAGE_MATCHING,
-                }
-                results.append(result)
+        faces.append(
+            {
+                "found": decision["found_match"],
+                "person_id": decision["matched_person"],
+                "confidence": decision["match_confidence"],
+                "stage": decision["matching_stage"],
+                "face_size": embedding.get("size", {}),
+                "embedding": embedding,
+            }
+        )
+    return faces
 
-                logger.info(f"Processing completed for {object_key}: {result}")
 
-            except (
-                FaceDetectionError,
-                EmbeddingGenerationError,
-                PersonMatchingError,
-            ) as e:
-                logger.error(f"Face recognition error processing record: {str(e)}")
-                results.append(
-                    {
-                        "error": str(e),
-                        "status": "failed",
-                        "error_type": type(e).__name__,
-                    }
+class RecentPersons:
+    """
+    Encodings of the persons this container created in the last
+    RECENT_PERSONS_SECONDS. Pinecone serves upserts only after a delay, so
+    a person seen again in the next batch would otherwise be created twice.
+    """
+
+    def __init__(self):
+        self.entries = []  # (created_at, person_id, encoding), oldest first
+        self._lock = threading.Lock()
+
+    def add(self, person_id, encoding):
+        with self._lock:
+            self.entries.append((time.time(), person_id, np.asarray(encoding)))
+            del self.entries[: -config.RECENT_PERSONS_MAX]
+
+    def current(self):
+        """[(person_id, encoding)] that have not expired"""
+        cutoff = time.time() - config.RECENT_PERSONS_SECONDS
+        with self._lock:
+            while self.entries and self.entries[0][0] < cutoff:
+                self.entries.pop(0)
+            return [(person_id, encoding) for _, person_id, encoding in self.entries]
+
+
+recent_persons = RecentPersons()
+
+
+def strict_similarity(encoding, others):
+    """
+    Cosine similarities of `encoding` to the rows of `others`, masked to -inf
+    where the pair fails the strict matching thresholds
+    """
+    others = np.asarray(others, dtype=np.float64)
+    distances = np.linalg.norm(others - encoding, axis=1)
+    similarities = others @ encoding / np.maximum(
+        np.linalg.norm(others, axis=1) * np.linalg.norm(encoding), 1e-12
+    )
+    passing = (similarities > config.PINECONE_SIMILARITY_THRESHOLD) & (
+        distances <= config.FACE_RECOGNITION_TOLERANCE
+    )
+    return np.where(passing, similarities, -np.inf)
+
+
+def cluster_new_faces(jobs):
+    """
+    Resolve the unmatched faces of a batch before persons are created.
+    A face that passes the strict thresholds against a recently created
+    person is matched to it (stage "recent"). The others are clustered
+    online in batch order: a face joins the cluster of the most similar
+    earlier face it passes against and points to that cluster's first face
+    with face["same_person_as"] (stage "batch"), so the batch creates one
+    person per cluster. Two faces of one image are never clustered.
+    """
+    if not config.ENABLE_BATCH_CLUSTERING:
+        return
+
+    unmatched = [
+        (job, face)
+        for job in jobs
+        if "error" not in job
+        for face in job["faces"]
+        if not face["found"]
+    ]
+    if not unmatched:
+        return
+
+    recent = recent_persons.current()
+    firsts = []  # (job, first face of the cluster)
+    members = []  # (cluster position, job, encoding) of every clustered face
+    recent_matches = batch_matches = 0
+    for job, face in unmatched:
+        encoding = face["embedding"]["encoding"]
+
+        if recent:
+            similarities = strict_similarity(encoding, [other for _, other in recent])
+            best = int(np.argmax(similarities))
+            if np.isfinite(similarities[best]):
+                face.update(
+                    found=True,
+                    person_id=recent[best][0],
+                    confidence=float(similarities[best]),
+                    stage="recent",
                 )
+                recent_matches += 1
                 continue
-            except Exception as e:
-                logger.error(f"Unexpected error processing record: {str(e)}")
-                results.append(
-                    {
-                        "error": str(e),
-                        "status": "failed",
-                        "error_type": "UnexpectedError",
-                    }
-                )
+
+        # Clusters already holding a face of this image are someone else
+        taken = {cluster for cluster, member_job, _ in members if member_job is job}
+        candidates = [member for member in members if member[0] not in taken]
+        if candidates:
+            similarities = strict_similarity(
+                encoding, [other for _, _, other in candidates]
+            )
+            best = int(np.argmax(similarities))
+            if np.isfinite(similarities[best]):
+                cluster = candidates[best][0]
+                face["same_person_as"] = firsts[cluster][1]
+                face.update(confidence=float(similarities[best]), stage="batch")
+                members.append((cluster, job, encoding))
+                batch_matches += 1
                 continue
 
-        return {
-            "statusCode": 200,
-            "body": json.dumps(
+        members.append((len(firsts), job, encoding))
+        firsts.append((job, face))
+
+    logger.info(
+        f"Unmatched faces: {len(unmatched)}, recently created persons matched: "
+        f"{recent_matches}, joined a batch cluster: {batch_matches}, "
+        f"new persons: {len(firsts)}"
+    )
+
+
+def new_person_vectors(person_id, encoding):
+    """Index vectors enrolling a new person"""
+    values = encoding.tolist()
+    if config.MAX_PERSON_SAMPLES <= 0:
+        return [{"id": person_id, "values": values}]
+    # The first face is both the centroid and the first sample
+    return [
+        {"id": person_id, "values": values, "metadata": {"count": 1, "samples": 1}},
+        {"id": f"{person_id}#1", "values": values, "metadata": {"person": person_id}},
+    ]
+
+
+def refine_persons(faces, index=None):
+    """
+    Fold confident matches into the matched persons: each `personN` centroid
+    becomes the running mean of every face merged into it, and faces unlike
+    the matched vector are kept as samples `personN#k`, up to
+    MAX_PERSON_SAMPLES. Concurrent updates of one person from different
+    containers are last-writer-wins; a lost face only slows the drift.
+    """
+    if config.MAX_PERSON_SAMPLES <= 0:
+        return
+
+    by_person = {}
+    for face in faces:
+        decision = face["embedding"].get("match_decision", {})
+        if (
+            face["found"]
+            and face["stage"] in ("strict", "single")
+            and face["confidence"] >= config.SAMPLE_MIN_CONFIDENCE
+        ):
+            by_person.setdefault(face["person_id"], []).append(
+                (face["embedding"]["encoding"], decision.get("match_distance"))
+            )
+    if not by_person:
+        return
+
+    try:
+        index = index or get_index()
+        person_ids = list(by_person)
+        batch_size = config.LOCAL_INDEX_FETCH_BATCH_SIZE
+        centroids = {}
+        for i in range(0, len(person_ids), batch_size):
+            tracing.record_call("pinecone", "Fetch")
+            centroids.update(index.fetch(ids=person_ids[i : i + batch_size]).vectors)
+
+        vectors = []
+        for person_id, merged in by_person.items():
+            centroid = centroids.get(person_id)
+            if centroid is None:
+                continue
+            metadata = dict(getattr(centroid, "metadata", None) or {})
+            # Persons enrolled before samples were kept have one merged face
+            count = int(metadata.get("count", 1))
+            samples = int(metadata.get("samples", 0))
+            mean = np.asarray(centroid.values, dtype=np.float64)
+            for encoding, distance in merged:
+                mean += (encoding - mean) / (count + 1)
+                count += 1
+                if samples < config.MAX_PERSON_SAMPLES and (
+                    distance is None or distance > config.SAMPLE_MIN_DISTANCE
+                ):
+                    samples += 1
+                    vectors.append(
+                        {
+                            "id": f"{person_id}#{samples}",
+                            "values": encoding.tolist(),
+                            "metadata": {"person": person_id},
+                        }
+                    )
+            vectors.append(
                 {
-                    "message": "Face recognition processing completed",
-                    "results": results,
-                    "configuration": {
-                        "detection_model": config.FACE_DETECTION_MODEL,
-                        "pinecone_similarity_threshold": config.PINECONE_SIMILARITY_THRESHOLD,
-                        "face_recognition_tolerance": config.FACE_RECOGNITION_TOLERANCE,
-                        "size_filtering_enabled": config.ENABLE_SIZE_FILTERING,
-                        "multi_stage_matching_enabled": config.ENABLE_MULTI_STAGE_MATCHING,
-                        "unified_detection_encoding": True,
-                    },
+                    "id": person_id,
+                    "values": mean.tolist(),
+                    "metadata": {**metadata, "count": count, "samples": samples},
                 }
-            ),
-        }
+            )
 
+        for i in range(0, len(vectors), 100):
+            tracing.record_call("pinecone", "Upsert")
+            index.upsert(vectors=vectors[i : i + 100])
+        if config.ENABLE_LOCAL_INDEX_CACHE and config.VECTOR_INDEX != "memory":
+            tracing.record_call("dynamodb", "PutItem")
+            log_key = record_person_updates(list(by_person))
+            if _local_index is not None:
+                # Written through here, so this container skips its own entry
+                _local_index.applied_updates.add(log_key)
+                _local_index.add((vector["id"], vector["values"]) for vector in vectors)
+        logger.info(
+            f"Refined {len(by_person)} persons with "
+            f"{sum(len(merged) for merged in by_person.values())} confident matches"
+        )
     except Exception as e:
-        logger.error(f"Handler error: {str(e)}")
+        # Matching results stand; only the refinement is lost
+        logger.error(f"Error refining person vectors: {str(e)}")
+
+
+class DlibBackend(RecognitionBackend):
+    """dlib detection and encoding, matched against Pinecone or the in-memory index"""
+
+    label = "face recognition"
+
+    def identify(self, jobs):
+        for job in jobs:
+            job["encoding_preset"] = job_encoding_preset(job)
+
+        if config.ENABLE_BATCH_PIPELINE and len(jobs) > 1:
+            detect_jobs_in_batch(jobs)
+        else:
+            detect_jobs_serially(jobs)
+
+        detected = [job for job in jobs if "error" not in job]
+
+        # Query the index for every face in the batch concurrently and
+        # match them all as one faces x candidates matrix
+        batch_embeddings = [
+            embedding for job in detected for embedding in job["detection"][1]
+        ]
+        prefetch_face_matches(get_index(), batch_embeddings)
+        assign_match_decisions(batch_embeddings)
+
+        for job in detected:
+            detected_faces, embeddings, detection_time, encoding_time = job["detection"]
+            if not embeddings:
+                logger.info("No face encodings generated")
+            job["faces"] = faces_from_embeddings(embeddings)
+            job["faces_detected"] = len(detected_faces)
+            job["encodings_generated"] = len(embeddings)
+            job["detection_time"] = detection_time
+            job["encoding_time"] = encoding_time
+            job["matching_time"] = sum(
+                embedding.get("query_time", 0.0) for embedding in embeddings
+            )
+
+        with tracing.span("clusterNewFaces"):
+            cluster_new_faces(detected)
+
+    def face_image(self, job, face):
+        return get_face_image(job, face["embedding"])
+
+    def enroll(self, job, faces):
+        encodings = enrollment_encodings(job, faces)
+        vectors = [
+            vector
+            for face, encoding in zip(faces, encodings)
+            for vector in new_person_vectors(face["person_id"], encoding)
+        ]
+        if config.ENABLE_BATCH_CLUSTERING:
+            for face in faces:
+                recent_persons.add(face["person_id"], face["embedding"]["encoding"])
+        try:
+            tracing.record_call("pinecone", "Upsert")
+            with tracing.span("pineconeUpsert"):
+                upsert_response = get_index().upsert(vectors=vectors)
+            logger.info(f"Upserted {len(faces)} new persons to Pinecone")
+            logger.info(f"Upsert response: {upsert_response}")
+
+            # Write through to the warm-container cache
+            if _local_index is not None:
+                _local_index.add((vector["id"], vector["values"]) for vector in vectors)
+        except Exception as e:
+            logger.error(f"Error upserting to Pinecone: {str(e)}")
+
+    def release(self, job):
+        # Encoded images are kept until here only for cache hits, which crop
+        # new persons' faces on demand, and for enrollment re-encoding
+        for key in ("image_bytes", "decoded_image", "detection"):
+            job.pop(key, None)
+
+    def learn(self, jobs):
+        with tracing.span("refinePersons"):
+            refine_persons([face for job in jobs for face in job["faces"]])
+
+    def result_fields(self, job):
         return {
-            "statusCode": 500,
-            "body": json.dumps(
-                {
-                    "message": "Error occurred during face recognition processing",
-                    "error": str(e),
-                    "error_type": type(e).__name__,
-                }
-            ),
+            "detection_model": config.FACE_DETECTION_MODEL,
+            "size_filtering_enabled": config.ENABLE_SIZE_FILTERING,
+            "multi_stage_matching_enabled": config.ENABLE_MULTI_STAGE_MATCHING,
+            "detection_cache": job.get("detection_cache"),
+            "encoding_preset": job.get("encoding_preset"),
+            "variant_scale": job.get("variant_scale"),
+        }
+
+    def configuration(self):
+        return {
+            "detection_model": config.FACE_DETECTION_MODEL,
+            "pinecone_similarity_threshold": config.PINECONE_SIMILARITY_THRESHOLD,
+            "face_recognition_tolerance": config.FACE_RECOGNITION_TOLERANCE,
+            "size_filtering_enabled": config.ENABLE_SIZE_FILTERING,
+            "multi_stage_matching_enabled": config.ENABLE_MULTI_STAGE_MATCHING,
+            "unified_detection_encoding": True,
+            "batch_pipeline_enabled": config.ENABLE_BATCH_PIPELINE,
+            "detection_cache_enabled": config.ENABLE_DETECTION_CACHE,
+            "encoding_preset": config.ENCODING_PRESET,
+            "profile_encoding_preset": config.PROFILE_ENCODING_PRESET,
+            "enrollment_encoding_preset": config.ENROLLMENT_ENCODING_PRESET,
+            "recognition_backend": config.RECOGNITION_BACKEND,
+            "vector_index": config.VECTOR_INDEX,
+            "max_person_samples": config.MAX_PERSON_SAMPLES,
+            "batch_clustering_enabled": config.ENABLE_BATCH_CLUSTERING,
+            "prefilter_enabled": prefilter.config.ENABLE_FACE_PREFILTER,
+            "variant_detection_enabled": config.ENABLE_VARIANT_DETECTION,
+        }
+
+
+class HybridBackend(DlibBackend):
+    """
+    dlib matching first. Only faces it is not confident about (new persons
+    and matches scoring below HYBRID_MIN_CONFIDENCE) are searched in the
+    Rekognition collection, and new persons are enrolled in both.
+    """
+
+    def __init__(self):
+        self.rekognition = RekognitionBackend()
+
+    def identify(self, jobs):
+        super().identify(jobs)
+
+        uncertain = [
+            (job, face)
+            for job in jobs
+            if "error" not in job
+            for face in job["faces"]
+            # Faces clustered with another new face follow that face's outcome
+            if "same_person_as" not in face
+            and (not face["found"] or face["confidence"] < config.HYBRID_MIN_CONFIDENCE)
+        ]
+
+        def search(pair):
+            job, face = pair
+            face_bytes = self.face_image(job, face)
+            if not face_bytes:
+                return None
+            try:
+                return search_face_by_image(face_bytes)
+            except Exception as e:
+                logger.error(f"Rekognition fallback search failed: {str(e)}")
+                return None
+
+        for (job, face), outcome in zip(uncertain, map_faces(search, uncertain)):
+            if outcome is None:
+                continue
+            job["rekognition_searches"] = job.get("rekognition_searches", 0) + 1
+            found, person_id, similarity, _ = outcome
+            if found:
+                logger.info(
+                    f"Rekognition match: {person_id} (similarity: {similarity:.2f}), "
+                    f"dlib: {face['person_id']} ({face['confidence']:.3f})"
+                )
+                # Similarity is 0-100; dlib confidences, and the thresholds on them, are 0-1
+                face.update(
+                    found=True,
+                    person_id=person_id,
+                    confidence=similarity / 100,
+                    stage="rekognition",
+                )
+
+    def enroll(self, job, faces):
+        super().enroll(job, faces)
+
+        # Index new persons in the collection too, so later fallbacks find them
+        crops = [(face, self.face_image(job, face)) for face in faces]
+        map_faces(
+            lambda crop: index_face(crop[1], crop[0]["person_id"]),
+            [crop for crop in crops if crop[1]],
+        )
+
+    def result_fields(self, job):
+        return {
+            **super().result_fields(job),
+            "rekognition_searches": job.get("rekognition_searches", 0),
+        }
+
+    def configuration(self):
+        return {
+            **super().configuration(),
+            **self.rekognition.configuration(),
+            "hybrid_min_confidence": config.HYBRID_MIN_CONFIDENCE,
         }
+
+
+backend = HybridBackend() if config.RECOGNITION_BACKEND == "hybrid" else DlibBackend()
+
+
+def handler(event, context):
+    """Main Lambda handler function with unified face_recognition approach"""
+    logger.info(
+        f"Configuration: DETECTION_MODEL={config.FACE_DETECTION_MODEL}, "
+        f"PINECONE_THRESHOLD={config.PINECONE_SIMILARITY_THRESHOLD}, "
+        f"FACE_RECOGNITION_TOLERANCE={config.FACE_RECOGNITION_TOLERANCE}, "
+        f"SIZE_FILTERING={config.ENABLE_SIZE_FILTERING}, "
+        f"BATCH_PIPELINE={config.ENABLE_BATCH_PIPELINE}, "
+        f"BACKEND={config.RECOGNITION_BACKEND}"
+    )
+    return handle_event(event, backend)
+
+
+def warmup_handler(event, context):
+    """Entry point that only loads the clients and models and runs a dummy inference"""
+    return handle_warmup(backend)
+
+
+if config.STARTUP_MODE == "eager":
+    # Use the container init phase instead of the first invocation
+    initialize_resources()
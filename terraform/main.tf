@@ -207,7 +207,7 @@ resource "aws_lambda_event_source_mapping" "thumbnail_generation_trigger" {
 resource "aws_lambda_event_source_mapping" "face_recognition_tagging_trigger" {
   event_source_arn = module.sns_sqs.face_recognition_queue_arn
   function_name    = var.use_aws_rekognition_service ? module.lambda.face_rekognition_lambda_arn : module.lambda.face_recognition_tagging_lambda_arn
-  batch_size       = 1
+  batch_size       = 10 # FIFO queue maximum; batches share detection workers and writes
   enabled          = true
 
   # Control concurrency at SQS event source mapping level
@@ -61,7 +61,11 @@ data "aws_iam_policy_document" "lambda_exec" {
       "rekognition:CreateCollection",
       "rekognition:DetectFaces",
       "rekognition:SearchFacesByImage",
-      "rekognition:IndexFaces"
+      "rekognition:IndexFaces",
+      "rekognition:SearchFaces",
+      "rekognition:DeleteFaces",
+      "rekognition:CreateUser",
+      "rekognition:AssociateFaces"
     ]
     resources = ["*"]
   }
@@ -14,7 +14,13 @@ module "face_rekognition" {
   function_name                  = "${var.prefix}-face-rekognition"
   handler                        = "lambda_function.handler"
   runtime                        = "python3.12"
-  source_path                    = "${path.module}/../../../src/lambdas/face_rekognition"
+  source_path = [
+    "${path.module}/../../../src/lambdas/face_rekognition",
+    {
+      path          = "${path.module}/../../../src/lambdas/face_pipeline"
+      prefix_in_zip = "face_pipeline"
+    }
+  ]
   create_role                    = false
   lambda_role                    = var.lambda_exec_role_arn
   timeout                        = 60